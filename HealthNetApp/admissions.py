@@ -0,0 +1,79 @@
+"""
+filename: admissions.py
+purpose: admit, transfer and discharge patients, recording each change as an
+AdmissionEvent (used by the admission statistics) and keeping each Hospital's
+admitted patient counter (Hospital.admitted_count) up to date in the same
+transaction
+"""
+
+from django.db import transaction
+from django.db.models import Count, F
+
+from .models import AdmissionEvent, Hospital, Patient
+
+
+def change_admission(patient, hospital, reason='', time=None):
+    '''
+    Set the hospital a patient is admitted to, and record the change.
+    :param patient: the Patient
+    :param hospital: the Hospital to admit the patient to, or None to discharge them
+    :param reason: the reason for an admission, as free text (e.g. from the admission form)
+    :param time: when it happened; defaults to now
+    :return: the new AdmissionEvent, or None if the patient was already there
+    '''
+    with transaction.atomic():
+        # lock the patient and read where they are now, so that two concurrent
+        # changes cannot both move them out of the same hospital
+        stored = Patient.objects.select_for_update().filter(pk=patient.pk).values_list(
+            'admitted_to_id', flat=True).first()
+        if stored != patient.admitted_to_id:
+            patient.admitted_to = Hospital.objects.filter(pk=stored).first()
+        from_hospital = patient.admitted_to
+        if from_hospital == hospital:
+            return None
+        if from_hospital is None:
+            action = AdmissionEvent.ADMIT
+        elif hospital is None:
+            action = AdmissionEvent.DISCHARGE
+        else:
+            action = AdmissionEvent.TRANSFER
+        event = AdmissionEvent(patient=patient, hospital=hospital, from_hospital=from_hospital, action=action)
+        if action == AdmissionEvent.ADMIT:
+            event.reason_code = AdmissionEvent.reason_code_for(reason)
+            event.reason_text = (reason or '')[:200]
+        if time is not None:
+            event.time = time
+        patient.admitted_to = hospital
+        patient.save()
+        event.save()
+        if from_hospital is not None:
+            Hospital.objects.filter(pk=from_hospital.pk, admitted_count__gt=0) \
+                .update(admitted_count=F('admitted_count') - 1)
+        if hospital is not None:
+            Hospital.objects.filter(pk=hospital.pk).update(admitted_count=F('admitted_count') + 1)
+    return event
+
+
+def admitted_counts():
+    '''
+    :return: list of (pk, name, number of patients admitted) of every hospital, by name
+    '''
+    return list(Hospital.objects.order_by('name', 'pk').values_list('pk', 'name', 'admitted_count'))
+
+
+def reconcile_admitted_counts():
+    '''
+    Recount the patients admitted to every hospital and fix the counters
+    that drifted (e.g. patients changed through the admin site).
+    :return: list of (hospital name, old count, new count) for every fixed counter
+    '''
+    fixed = []
+    with transaction.atomic():
+        actual = dict(Patient.objects.exclude(admitted_to=None).values_list('admitted_to')
+                      .annotate(count=Count('pk')).order_by())
+        for pk, name, stored in Hospital.objects.values_list('pk', 'name', 'admitted_count'):
+            count = actual.get(pk, 0)
+            if count != stored:
+                Hospital.objects.filter(pk=pk).update(admitted_count=count)
+                fixed.append((name, stored, count))
+    return fixed
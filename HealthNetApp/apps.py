@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class HealthnetappConfig(AppConfig):
     name = 'HealthNetApp'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,185 @@
+"""
+filename: census.py
+purpose: the number of patients admitted to each hospital over time. The
+AdmissionEvents are replayed once into hourly CensusCheckpoints, which are
+then extended with the events recorded since, so that the occupancy at a
+time or over a range is read from a few checkpoints instead of the whole
+admission history.
+"""
+
+import datetime
+
+from django.db import connection, transaction
+from django.db.models import Min, Max, Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .models import AdmissionEvent, CensusCheckpoint, CensusState, Hospital
+from .statistics import EpochSeconds
+
+HOUR = datetime.timedelta(hours=1)
+# Checkpoints are written this many at a time while replaying
+CHECKPOINT_BATCH_SIZE = 500
+
+
+def floor_hour(time):
+    '''
+    :return: the start of the (UTC) hour a time is in
+    '''
+    return time.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def epoch_hour(seconds):
+    '''
+    :param seconds: the start of an hour, in seconds since the epoch
+    :return: it as an aware datetime
+    '''
+    return datetime.datetime.fromtimestamp(seconds, timezone.utc)
+
+
+def apply_change(occupancy, hospital_pk, from_hospital_pk):
+    '''
+    Move one patient in a {hospital pk: occupancy} dict.
+    '''
+    if from_hospital_pk is not None:
+        occupancy[from_hospital_pk] = occupancy.get(from_hospital_pk, 0) - 1
+    if hospital_pk is not None:
+        occupancy[hospital_pk] = occupancy.get(hospital_pk, 0) + 1
+
+
+def occupancy_before(hour):
+    '''
+    The occupancy of every hospital at the end of the last checkpoint before an hour, in one query
+    (an index lookup per hospital).
+    :return: {hospital pk: occupancy}
+    '''
+    latest = RawSQL('SELECT occupancy FROM "{checkpoint}" WHERE hospital_id = "{hospital}"."id" AND hour < %s '
+                    'ORDER BY hour DESC LIMIT 1'.format(checkpoint=CensusCheckpoint._meta.db_table,
+                                                         hospital=Hospital._meta.db_table),
+                    (connection.ops.adapt_datetimefield_value(hour),))
+    return dict((pk, occupancy or 0) for pk, occupancy in
+                Hospital.objects.annotate(occupancy=latest).values_list('pk', 'occupancy'))
+
+
+def replay(hour):
+    '''
+    Rebuild the checkpoints from an hour on, by replaying the AdmissionEvents from then on over the
+    occupancy before it. Must be run inside a transaction.
+    :param hour: the start of an hour
+    :return: the number of events replayed
+    '''
+    occupancy = occupancy_before(hour)
+    CensusCheckpoint.objects.filter(hour__gte=hour).delete()
+    # times are read as seconds since the epoch, which is much cheaper than datetimes
+    events = AdmissionEvent.objects.filter(time__gte=hour).order_by('time', 'id').annotate(
+        seconds=EpochSeconds('time')).values_list('seconds', 'hospital_id', 'from_hospital_id')
+    # {(hospital pk, hour): occupancy at the end of the hour}; hours before the current one are final
+    pending = {}
+    current = None
+    replayed = 0
+    for seconds, hospital_pk, from_hospital_pk in events.iterator():
+        bucket = seconds - seconds % 3600
+        if bucket != current and len(pending) >= CHECKPOINT_BATCH_SIZE:
+            write_checkpoints(pending)
+            pending = {}
+        current = bucket
+        apply_change(occupancy, hospital_pk, from_hospital_pk)
+        for pk in (hospital_pk, from_hospital_pk):
+            if pk is not None:
+                pending[(pk, bucket)] = occupancy[pk]
+        replayed += 1
+    write_checkpoints(pending)
+    return replayed
+
+
+def write_checkpoints(pending):
+    CensusCheckpoint.objects.bulk_create(CensusCheckpoint(hospital_id=pk, hour=epoch_hour(hour), occupancy=occupancy)
+                                         for (pk, hour), occupancy in pending.items())
+
+
+def extend():
+    '''
+    Bring the checkpoints up to date with the AdmissionEvents recorded (or changed) since they were
+    last built. When nothing has changed this is two small queries.
+    :return: the number of events replayed
+    '''
+    with transaction.atomic():
+        state = CensusState.objects.select_for_update().get_or_create(pk=1)[0]
+        new = AdmissionEvent.objects.filter(pk__gt=state.last_event).aggregate(first=Min('time'), last=Max('pk'))
+        starts = [time for time in (new['first'], state.stale_from) if time is not None]
+        if not starts:
+            return 0
+        # events are usually recorded as they happen, so this is usually the current hour
+        replayed = replay(floor_hour(min(starts)))
+        state.last_event = max(new['last'] or 0, state.last_event)
+        state.stale_from = None
+        state.save()
+    return replayed
+
+
+def rebuild():
+    '''
+    Replay the whole admission history.
+    :return: the number of events replayed
+    '''
+    with transaction.atomic():
+        CensusState.objects.all().delete()
+        CensusCheckpoint.objects.all().delete()
+        return extend()
+
+
+def mark_stale(time):
+    '''
+    Have the next extend() rebuild the checkpoints from a time on, e.g. because an
+    AdmissionEvent from then was changed or deleted.
+    '''
+    CensusState.objects.filter(Q(stale_from=None) | Q(stale_from__gt=time)).update(stale_from=time)
+
+
+def occupancy_at(time):
+    '''
+    :param time: an aware datetime
+    :return: {hospital pk: the number of patients admitted there at that time}
+    '''
+    extend()
+    hour = floor_hour(time)
+    occupancy = occupancy_before(hour)
+    for hospital_pk, from_hospital_pk in AdmissionEvent.objects.filter(time__gte=hour, time__lte=time).order_by(
+            'time', 'id').values_list('hospital_id', 'from_hospital_id'):
+        apply_change(occupancy, hospital_pk, from_hospital_pk)
+    return occupancy
+
+
+def occupancy_series(start, end):
+    '''
+    The hourly occupancy of every hospital over a range of time.
+    :param start: an aware datetime
+    :param end: an aware datetime
+    :return: (list of the (UTC) hours from the one start is in to the one end is in,
+    {hospital pk: list of the occupancy at the end of each of those hours})
+    '''
+    extend()
+    first, last = floor_hour(start), floor_hour(end)
+    count = int((last - first) / HOUR) + 1 if last >= first else 0
+    hours = [first + i * HOUR for i in range(count)]
+    occupancy = occupancy_before(first)
+    first_seconds = int(first.timestamp())
+    changes = dict((pk, []) for pk in occupancy)
+    # read with a plain cursor: the ORM's per-row conversions cost more than the query for a long range
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT CAST(strftime('%%s', hour) AS INTEGER), hospital_id, occupancy FROM \"{}\" "
+                       "WHERE hour >= %s AND hour <= %s ORDER BY hour".format(CensusCheckpoint._meta.db_table),
+                       (connection.ops.adapt_datetimefield_value(first),
+                        connection.ops.adapt_datetimefield_value(last)))
+        for seconds, pk, value in cursor.fetchall():
+            changes.setdefault(pk, []).append(((seconds - first_seconds) // 3600, value))
+    series = {}
+    for pk, hospital_changes in changes.items():
+        values = []
+        value = occupancy.get(pk, 0)
+        for index, new_value in hospital_changes:
+            values.extend([value] * (index - len(values)))
+            value = new_value
+        values.extend([value] * (count - len(values)))
+        series[pk] = values
+    return hours, series
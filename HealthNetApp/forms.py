@@ -7,9 +7,12 @@ purpose: the forms for the HealthNetApp application
 from django import forms
 
 from django.forms import ModelForm, Textarea, ModelChoiceField, FileField
-from .models import Patient, Hospital, MedicalInformation, Appointment, Doctor, Person, Prescription, Message, MedicalTest
+from .models import Patient, Hospital, MedicalInformation, Appointment, Doctor, Person, Prescription, Message, MedicalTest, LogEntry
 from django.forms.widgets import FileInput
 from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
+from django.utils.encoding import force_text
+from django.utils.html import format_html
 
 '''
 Catch the exception thrown when creating a bad datetime (out of range,
@@ -20,6 +23,36 @@ This code is Chris' fault.
 import time, datetime
 
 
+class LookupSelect(forms.Select):
+    '''
+    A select box for a ModelChoiceField over a table too big to list in the
+    page. Only the selected option (if any) is rendered; the rest are
+    fetched from the lookup view as the user types (see remote-chosen.js).
+    The field still checks the submitted pk against its queryset.
+    '''
+
+    def __init__(self, kind, attrs=None):
+        super().__init__(attrs)
+        self.kind = kind
+
+    def render(self, name, value, attrs=None, choices=()):
+        attrs = dict(attrs or {}, **{'data-lookup-url': reverse('lookup', args=[self.kind])})
+        return super().render(name, value, attrs, choices)
+
+    def render_options(self, choices, selected_choices):
+        selected_choices = set(force_text(v) for v in selected_choices if v not in ('', None))
+        try:
+            selected = list(self.choices.queryset.filter(pk__in=selected_choices)) if selected_choices else []
+        except (ValueError, TypeError):
+            # a bound form with a junk pk; it fails validation anyway
+            selected = []
+        if not selected:
+            # a blank option so that Chosen shows its placeholder
+            return format_html('<option value=""></option>')
+        return '\n'.join(self.render_option(selected_choices, obj.pk, self.choices.field.label_from_instance(obj))
+                         for obj in selected)
+
+
 class RegisterForm(ModelForm):
     '''
     RegisterForm for a user registering an account
@@ -188,7 +221,7 @@ class PatientAppointmentForm(AppointmentForm):
     '''
     A form for patients - patients cannot sign up other users.
     '''
-    doctor = ModelChoiceField(queryset=Doctor.objects, empty_label=None)
+    doctor = ModelChoiceField(queryset=Doctor.objects, empty_label=None, widget=LookupSelect('doctors'))
     doctor.widget.attrs.update({'class': 'form-control'})
 
 
@@ -201,7 +234,7 @@ class DoctorAppointmentForm(AppointmentForm):
 
     doctor = ModelChoiceField(queryset=Doctor.objects, empty_label=None)
     doctor.widget.attrs.update({'class': 'form-control'})
-    patient = ModelChoiceField(queryset=Patient.objects.none(), empty_label=None)
+    patient = ModelChoiceField(queryset=Patient.objects.none(), empty_label=None, widget=LookupSelect('patients'))
     patient.widget.attrs.update({'class': 'form-control'})
     class Meta:
         model = Appointment
@@ -231,7 +264,7 @@ class MedicalTestForm(ModelForm):
 
 
 class MessageForm(forms.Form):
-    destination = ModelChoiceField(queryset=Person.objects, empty_label=None)
+    destination = ModelChoiceField(queryset=Person.objects, empty_label=None, widget=LookupSelect('people'))
     destination.widget.attrs.update({'class': 'chosen-select'})
     subject = forms.CharField(label='Subject',max_length=100)
     body = forms.CharField(label='Body',max_length=1000, widget=forms.Textarea)
@@ -248,3 +281,65 @@ class CustomDateForm(forms.Form):
     start.widget.attrs.update({'class': 'form-control'})
     end = forms.DateField(required=False)
     end.widget.attrs.update({'class': 'form-control'})
+
+
+class BroadcastForm(forms.Form):
+    '''
+    A message to everyone of one audience at a hospital
+    '''
+    audiences = (('staff', 'All staff'), ('patients', 'All patients (preferred or admitted)'))
+
+    hospital = ModelChoiceField(queryset=Hospital.objects, empty_label=None)
+    audience = forms.ChoiceField(choices=audiences)
+    subject = forms.CharField(label='Subject', max_length=100)
+    body = forms.CharField(label='Body', max_length=1000, widget=forms.Textarea)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Apply form-control class to every element in order to
+        # style with bootstrap
+        for myField in self.fields:
+            self.fields[myField].widget.attrs['class'] = 'form-control'
+
+
+class LogExportForm(forms.Form):
+    '''
+    Filters and output format for exporting the audit log
+    '''
+    format = forms.ChoiceField(choices=[('csv', 'CSV'), ('jsonl', 'JSON Lines')], required=False)
+    user = forms.ModelChoiceField(queryset=Person.objects, required=False)
+    action_type = forms.ChoiceField(choices=[('', 'Any')] + list(LogEntry.log_types), required=False)
+    thing_type = forms.ChoiceField(choices=[('', 'Any')] + list(LogEntry.thing_types), required=False)
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+    gzip = forms.BooleanField(required=False)
+
+
+class FreeSlotForm(forms.Form):
+    '''
+    Search for free appointment slots of one doctor, or of every doctor at a
+    hospital, over a range of days
+    '''
+    MAX_DAYS = 62
+
+    doctor = forms.ModelChoiceField(queryset=Doctor.objects, required=False)
+    hospital = forms.ModelChoiceField(queryset=Hospital.objects, required=False)
+    patient = forms.ModelChoiceField(queryset=Patient.objects, required=False)
+    start = forms.DateField()
+    end = forms.DateField(required=False)
+    duration = forms.TypedChoiceField(choices=[(d, d) for d in (15, 30, 45, 60)], coerce=int,
+                                      required=False, empty_value=None)
+
+    def clean(self):
+        data = super().clean()
+        if bool(data.get('doctor')) == bool(data.get('hospital')):
+            raise ValidationError('Give either a doctor or a hospital.')
+        start = data.get('start')
+        if start:
+            end = data.get('end') or start
+            if end < start:
+                raise ValidationError('The end date must not be before the start date.')
+            if (end - start).days >= self.MAX_DAYS:
+                raise ValidationError('Search at most {} days at a time.'.format(self.MAX_DAYS))
+            data['end'] = end
+        return data
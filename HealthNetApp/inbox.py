@@ -0,0 +1,180 @@
+"""
+filename: inbox.py
+purpose: send and read messages while keeping each Person's unread message
+counter (Person.unread_messages) and its cached copy up to date, and notify
+the people listening for their messages (see notifications.py)
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import Count, F, Max
+from django.utils import timezone
+
+from .models import Person, Message, Conversation
+from .notifications import hub
+from . import search
+
+
+def unread_cache_key(username):
+    return 'unread_messages:' + username
+
+
+def forget_unread_count(username):
+    '''
+    Drop the cached unread count of a user once the current transaction
+    commits, so that the next read sees the new value.
+    '''
+    transaction.on_commit(lambda: cache.delete(unread_cache_key(username)))
+
+
+def unread_count(username):
+    '''
+    Get the number of unread messages of a user. Served from the cache, so
+    this is usually free; on a miss, reads the counter column.
+    :param username: (string) the user's username
+    :return: int
+    '''
+    key = unread_cache_key(username)
+    count = cache.get(key)
+    if count is None:
+        count = Person.objects.filter(username=username).values_list('unread_messages', flat=True).first() or 0
+        cache.set(key, count, getattr(settings, 'UNREAD_CACHE_TIMEOUT', 300))
+    return count
+
+
+def publish_unread_count(person_pk, username):
+    '''
+    Tell the person's listeners their new unread count, once the current
+    transaction commits. Free when nobody is listening.
+    '''
+    def publish():
+        if hub.has_subscribers(person_pk):
+            hub.publish(person_pk, 'unread', {'count': unread_count(username)})
+    transaction.on_commit(publish)
+
+
+def publish_new_message(message):
+    '''
+    Tell the destination's listeners about a new message, once the current
+    transaction commits.
+    '''
+    def publish():
+        if hub.has_subscribers(message.destination_id):
+            hub.publish(message.destination_id, 'message', message_header(message))
+    transaction.on_commit(publish)
+
+
+def message_header(message):
+    '''
+    :return: dict describing a message for a 'message' event
+    '''
+    return {'pk': message.pk,
+            'source': str(message.source),
+            'subject': message.subject,
+            'date': message.date.isoformat(),
+            'url': reverse('viewmessage', args=[message.pk])}
+
+
+def send_message(source, destination, subject, body, conversation=None):
+    '''
+    Create a message and count it as unread for its destination.
+    :param source: the sending Person
+    :param destination: the receiving Person
+    :param conversation: the Conversation the message replies in, or None
+    to add it to the latest conversation between the two people with its
+    subject (or start one)
+    :return: the new Message
+    '''
+    date = timezone.now()
+    with transaction.atomic():
+        if conversation is None:
+            conversation = Conversation.for_message(source, destination, subject, date)
+        message = Message.objects.create(destination=destination,
+                                         source=source,
+                                         subject=subject,
+                                         body=body,
+                                         date=date,
+                                         conversation=conversation)
+        Person.objects.filter(pk=destination.pk).update(unread_messages=F('unread_messages') + 1)
+        forget_unread_count(destination.username)
+        publish_new_message(message)
+        publish_unread_count(destination.pk, destination.username)
+    return message
+
+
+def broadcast(source, recipients, subject, body, batch_size=500):
+    '''
+    Send the same message to many people at once. Messages are inserted
+    with bulk_create and unread counters bumped with one UPDATE per batch
+    of batch_size recipients, so the cost is a few statements per thousand
+    recipients rather than several per recipient. Broadcast messages do
+    not belong to a conversation; a reply starts one.
+    :param source: the sending Person
+    :param recipients: queryset of the receiving people (the sender is skipped)
+    :return: the number of messages sent
+    '''
+    date = timezone.now()
+    people = list(recipients.exclude(pk=source.pk).values_list('pk', 'username'))
+    created = []
+    with transaction.atomic():
+        for i in range(0, len(people), batch_size):
+            batch = people[i:i + batch_size]
+            Message.objects.bulk_create(Message(destination_id=pk, source=source, subject=subject,
+                                                body=body, date=date)
+                                        for pk, username in batch)
+            # bulk_create does not set the pks, but the transaction holds the database's
+            # write lock since the first insert, so the batch's messages got the last pks in a row
+            last = Message.objects.aggregate(last=Max('pk'))['last']
+            created.extend(range(last - len(batch) + 1, last + 1))
+            Person.objects.filter(pk__in=[pk for pk, username in batch]) \
+                .update(unread_messages=F('unread_messages') + 1)
+        # bulk_create sends no signals, so index the messages here
+        search.index(search.MESSAGE, created)
+        keys = [unread_cache_key(username) for pk, username in people]
+        transaction.on_commit(lambda: cache.delete_many(keys))
+        # the messages were created in the order of people
+        for (pk, username), message_pk in zip(people, created):
+            if hub.has_subscribers(pk):
+                publish_new_message(Message(pk=message_pk, destination_id=pk, source=source, subject=subject,
+                                            body=body, date=date))
+                publish_unread_count(pk, username)
+    return len(people)
+
+
+def mark_read(message):
+    '''
+    Mark a message as read. Only the first call for a message changes the
+    destination's unread count.
+    :param message: a Message
+    :return: True if the message was unread
+    '''
+    with transaction.atomic():
+        changed = Message.objects.filter(pk=message.pk, read=False).update(read=True)
+        if changed:
+            Person.objects.filter(pk=message.destination_id, unread_messages__gt=0) \
+                .update(unread_messages=F('unread_messages') - 1)
+            forget_unread_count(message.destination.username)
+            publish_unread_count(message.destination_id, message.destination.username)
+    message.read = True
+    return bool(changed)
+
+
+def reconcile_unread_counts():
+    '''
+    Recount everyone's unread messages and fix the counters that drifted
+    (e.g. messages changed through the admin site).
+    :return: list of (username, old count, new count) for every fixed counter
+    '''
+    actual = dict(Message.objects.filter(read=False).values_list('destination')
+                  .annotate(count=Count('id')).order_by())
+    fixed = []
+    with transaction.atomic():
+        for pk, username, stored in Person.objects.values_list('pk', 'username', 'unread_messages').iterator():
+            count = actual.get(pk, 0)
+            if count != stored:
+                Person.objects.filter(pk=pk).update(unread_messages=count)
+                forget_unread_count(username)
+                fixed.append((username, stored, count))
+    return fixed
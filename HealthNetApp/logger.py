@@ -1,10 +1,14 @@
-from .models import LogEntry, Person
-from django.db import models
+from .models import LogEntry, LogRollup, Person
+from django.conf import settings
+from django.db import models, transaction
 
-import datetime
+import atexit, csv, datetime, json, logging, threading, time, zlib
+from queue import Queue, Empty
 from django.utils.timezone import make_aware, get_default_timezone
 #from django.db import models.DoesNotExist
 
+logger = logging.getLogger(__name__)
+
 def log_event(username, action_type, thing_type,
 	thing_instance, thing_field, eventDescription):
 
@@ -29,16 +33,193 @@ def log_event(username, action_type, thing_type,
 	#EACH MODEL/OBJECT, LISTING ITS ATTRIBUTES, THEN CHECK THAT THE SPECIFIED
 	#ATTRIBUTE EXISTS FOR THE SPECIFIED MODEL/OBJECT
 
+	time_now = make_aware(datetime.datetime.now(), get_default_timezone())
+
+	#buffered mode: the entry is written later, in a batch, by the audit writer
+	writer = get_audit_writer()
+	if writer is not None:
+		writer.put(username, time_now, action_type, thing_type,
+			thing_instance, thing_field, eventDescription)
+		return
+
 	#create a new log entry with arguments
 	new_entry = LogEntry(user=Person.objects.get(username=username),
-					time=make_aware(datetime.datetime.now(), get_default_timezone()),
+					time=time_now,
 					action_type=action_type, thing_type=thing_type,
 					thing_instance=thing_instance, thing_field=thing_field,
 					eventDescription=eventDescription)
 
 #	new_entry = LogEntry(Person.objects.get(username=username), action_type, thing_type, thing_instance, thing_field, eventDescription)
 
-	new_entry.save()
+	with transaction.atomic():
+		new_entry.save()
+		LogRollup.record([new_entry])
+
+
+class AuditWriter(object):
+	'''
+	Buffers log events in an in-process queue and writes them to the database
+	with bulk_create, either when batch_size events are waiting or when
+	flush_interval seconds have passed, whichever comes first. The Person of
+	every event in a batch is looked up with a single query. A batch that
+	cannot be written is tried again by the next flushes, and dropped (and
+	counted) after max_attempts failures. The counters are only changed while
+	holding a lock: enqueued the put lock (so that put never waits for a
+	flush), and the others the flush lock.
+	'''
+
+	def __init__(self, batch_size=100, flush_interval=2.0, max_attempts=3):
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.max_attempts = max_attempts
+		self.queue = Queue()
+		#(failed attempts, events) of the batches that could not be written yet
+		self._failed = []
+		self._flush_lock = threading.Lock()
+		self._put_lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._stopping = threading.Event()
+		self._thread = None
+		self.enqueued = 0
+		self.written = 0
+		self.dropped = 0
+		self.errors = 0
+		self.flushes = 0
+		self.last_flush_ms = 0.0
+		self.max_flush_ms = 0.0
+
+	def start(self):
+		'''
+		Start the background flusher, and flush whatever is left on shutdown.
+		'''
+		self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+		self._thread.start()
+		atexit.register(self.close)
+
+	def put(self, username, time_logged, action_type, thing_type,
+		thing_instance, thing_field, eventDescription):
+		self.queue.put((username, time_logged, action_type, thing_type,
+			thing_instance, thing_field, eventDescription))
+		with self._put_lock:
+			self.enqueued += 1
+		if self.queue.qsize() >= self.batch_size:
+			self._wakeup.set()
+
+	def flush(self):
+		'''
+		Write every queued event to the database, and retry the batches that
+		failed before. Each batch is written on its own, so a bad batch does
+		not hold up the events queued after it.
+		:return: the number of LogEntry rows written
+		:raise: the last error, if a batch could not be written
+		'''
+		with self._flush_lock:
+			batch = []
+			while True:
+				try:
+					batch.append(self.queue.get_nowait())
+				except Empty:
+					break
+			pending = self._failed + ([(0, batch)] if batch else [])
+			self._failed = []
+			total = 0
+			error = None
+			for attempts, events in pending:
+				started = time.perf_counter()
+				try:
+					written = self._write(events)
+				except Exception as e:
+					error = e
+					self.errors += 1
+					if attempts + 1 < self.max_attempts:
+						self._failed.append((attempts + 1, events))
+					else:
+						self.dropped += len(events)
+						logger.error('audit writer dropped %d events after %d failed attempts',
+							len(events), attempts + 1)
+					continue
+				elapsed = (time.perf_counter() - started) * 1000
+				self.flushes += 1
+				self.written += written
+				self.dropped += len(events) - written
+				self.last_flush_ms = elapsed
+				self.max_flush_ms = max(self.max_flush_ms, elapsed)
+				total += written
+			if error is not None:
+				raise error
+			return total
+
+	def _write(self, batch):
+		usernames = set(event[0] for event in batch)
+		person_pks = dict(Person.objects.filter(username__in=usernames).values_list('username', 'pk'))
+		#events for usernames without a Person are dropped (and counted)
+		entries = [LogEntry(user_id=person_pks[username], time=time_logged,
+						action_type=action_type, thing_type=thing_type,
+						thing_instance=thing_instance, thing_field=thing_field,
+						eventDescription=eventDescription)
+			for (username, time_logged, action_type, thing_type,
+				thing_instance, thing_field, eventDescription) in batch
+			if username in person_pks]
+		with transaction.atomic():
+			LogEntry.objects.bulk_create(entries)
+			LogRollup.record(entries)
+		return len(entries)
+
+	def _run(self):
+		while not self._stopping.is_set():
+			self._wakeup.wait(self.flush_interval)
+			self._wakeup.clear()
+			try:
+				self.flush()
+			except Exception:
+				logger.exception('audit writer could not flush')
+
+	def close(self):
+		'''
+		Stop the background flusher and write any remaining events.
+		'''
+		self._stopping.set()
+		self._wakeup.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		self.flush()
+
+	def stats(self):
+		'''
+		:return: dict of counters for monitoring the writer. Every event ever
+		queued is either still queued, written, or dropped.
+		'''
+		return {'queue_depth': self.queue.qsize() + sum(len(events) for attempts, events in list(self._failed)),
+				'enqueued': self.enqueued,
+				'written': self.written,
+				'dropped': self.dropped,
+				'errors': self.errors,
+				'flushes': self.flushes,
+				'last_flush_ms': self.last_flush_ms,
+				'max_flush_ms': self.max_flush_ms}
+
+
+_audit_writer = None
+_audit_writer_lock = threading.Lock()
+
+def get_audit_writer():
+	'''
+	Get the process-wide AuditWriter, starting it on first use.
+	:return: AuditWriter, or None when AUDIT_LOG_BUFFERED is off and log
+	events are written synchronously
+	'''
+	global _audit_writer
+	if not getattr(settings, 'AUDIT_LOG_BUFFERED', False):
+		return None
+	if _audit_writer is None:
+		with _audit_writer_lock:
+			if _audit_writer is None:
+				writer = AuditWriter(getattr(settings, 'AUDIT_LOG_BATCH_SIZE', 100),
+					getattr(settings, 'AUDIT_LOG_FLUSH_INTERVAL', 2.0))
+				writer.start()
+				_audit_writer = writer
+	return _audit_writer
 
 
 def view_log_entries_by_username(username):
@@ -50,3 +231,69 @@ def view_log_entries_by_username(username):
 
 def view_log_entries_by_type(action_type):
 	return LogEntry.objects.filter(action_type=action_type)
+
+
+EXPORT_FIELDS = ['id', 'time', 'username', 'action_type', 'thing_type',
+	'thing_instance', 'thing_field', 'eventDescription']
+
+def iter_log_entries(queryset, chunk_size=2000):
+	'''
+	Iterate over a LogEntry queryset in primary key order, one chunk of
+	chunk_size rows per query, so that only one chunk is ever held in memory.
+	'''
+	queryset = queryset.select_related('user').order_by('pk')
+	last_pk = 0
+	while True:
+		chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size].iterator())
+		if not chunk:
+			return
+		for entry in chunk:
+			yield entry
+		last_pk = chunk[-1].pk
+
+
+def export_row(entry):
+	return [entry.pk, entry.time.isoformat(), entry.user.username, entry.action_type,
+		entry.thing_type, entry.thing_instance, entry.thing_field, entry.eventDescription]
+
+
+class _LineBuffer(object):
+	#a file-like object for csv.writer that hands back each written line
+	def write(self, value):
+		return value
+
+
+def export_csv(entries):
+	'''
+	Yield log entries as CSV text, starting with a header line.
+	'''
+	writer = csv.writer(_LineBuffer())
+	yield writer.writerow(EXPORT_FIELDS)
+	for entry in entries:
+		yield writer.writerow(export_row(entry))
+
+
+def export_jsonl(entries):
+	'''
+	Yield log entries as JSON Lines text, one object per entry.
+	'''
+	for entry in entries:
+		yield json.dumps(dict(zip(EXPORT_FIELDS, export_row(entry)))) + '\n'
+
+
+def gzip_stream(chunks, batch_size=64 * 1024):
+	'''
+	Gzip a stream of text chunks on the fly.
+	'''
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	pending = []
+	pending_size = 0
+	for chunk in chunks:
+		pending.append(chunk.encode('utf-8'))
+		pending_size += len(pending[-1])
+		if pending_size >= batch_size:
+			data = compressor.compress(b''.join(pending))
+			pending, pending_size = [], 0
+			if data:
+				yield data
+	yield compressor.compress(b''.join(pending)) + compressor.flush()
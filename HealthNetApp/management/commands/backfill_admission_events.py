@@ -0,0 +1,132 @@
+"""
+filename: backfill_admission_events.py
+purpose: create AdmissionEvents for the admissions, transfers and discharges
+that were only written to the audit log, before admissions were recorded
+"""
+
+import re
+from itertools import groupby
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+
+from HealthNetApp.models import AdmissionEvent, Hospital, LogEntry, Patient
+from HealthNetApp.statistics import invalidateStats
+
+# The descriptions written by admitPatient and emergency_register_patient.
+# Descriptions are cut at 200 characters, so the closing quote may be missing.
+ADMITTED = re.compile(r'^patient was admitted to (?P<hospital>.*?) with reason "(?P<reason>.*?)"?$', re.S)
+TRANSFERRED = re.compile(r'^the patient was transfered from (?P<hospitals>.*)$', re.S)
+DISCHARGED = re.compile(r'^the patient was discharged from (?P<hospital>.*)$', re.S)
+# An administrator picked a hospital (or none); the log does not say which
+CHANGED = 'the hospital the patient was addmitted to was changed'
+
+
+class Command(BaseCommand):
+    help = ('Create admission events from the admission log entries that do not have one. '
+            'Log entries written after the first recorded (not backfilled) admission event '
+            'are skipped, as their events were recorded when they happened. Hospitals picked '
+            'by an administrator are not logged; they are worked out from the next change '
+            'to the same patient, or from where the patient is admitted now.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='number of events to write per query')
+
+    def handle(self, *args, **options):
+        self.hospitals = dict(Hospital.objects.values_list('name', 'pk'))
+        patients = dict(Patient.objects.values_list('pk', 'admitted_to_id'))
+        done = set(AdmissionEvent.objects.exclude(log_entry=None).values_list('log_entry_id', flat=True))
+        cutoff = AdmissionEvent.objects.filter(log_entry=None).aggregate(first=Min('time'))['first']
+
+        entries = LogEntry.objects.filter(action_type='u', thing_type='p', thing_field='admitted_to').order_by(
+            'thing_instance', 'time', 'id').values_list('pk', 'thing_instance', 'time', 'eventDescription')
+
+        events = []
+        created = skipped = 0
+        for patient_pk, changes in groupby(entries.iterator(), lambda entry: entry[1]):
+            if patient_pk not in patients:
+                skipped += sum(1 for change in changes)
+                continue
+            for event in self.replay(patient_pk, list(changes), patients[patient_pk]):
+                if event is None:
+                    skipped += 1
+                elif event.log_entry_id not in done and (cutoff is None or event.time < cutoff):
+                    events.append(event)
+            if len(events) >= options['batch_size']:
+                created += self.write(events)
+                events = []
+        created += self.write(events)
+        self.stdout.write('created {} admission events, skipped {} log entries'.format(created, skipped))
+
+    def replay(self, patient_pk, changes, admitted_now):
+        '''
+        Work out the admission events of one patient from their log entries.
+        :param changes: (pk, patient pk, time, description) of the patient's log entries, oldest first
+        :param admitted_now: pk of the hospital the patient is admitted to now, or None
+        :return: list with an unsaved AdmissionEvent (or None, if it could not be parsed) per log entry
+        '''
+        parsed = [self.parse(description) for pk, patient, time, description in changes]
+        events = []
+        current = None
+        for i, ((pk, patient, time, description), change) in enumerate(zip(changes, parsed)):
+            if change is None:
+                events.append(None)
+                continue
+            action, hospital, from_hospital, reason = change
+            if action is None:
+                # an administrator's change: the next change says where the patient was
+                if i + 1 == len(parsed):
+                    hospital = admitted_now
+                elif parsed[i + 1] is not None and parsed[i + 1][0] is not None:
+                    hospital = parsed[i + 1][2]
+                else:
+                    events.append(None)
+                    continue
+                from_hospital = current
+                if from_hospital == hospital:
+                    events.append(None)
+                    continue
+                if from_hospital is None:
+                    action = AdmissionEvent.ADMIT
+                elif hospital is None:
+                    action = AdmissionEvent.DISCHARGE
+                else:
+                    action = AdmissionEvent.TRANSFER
+            events.append(AdmissionEvent(patient_id=patient_pk, hospital_id=hospital, from_hospital_id=from_hospital,
+                                         action=action, reason_code=AdmissionEvent.reason_code_for(reason)
+                                         if action == AdmissionEvent.ADMIT else 'none',
+                                         reason_text=reason, time=time, log_entry_id=pk))
+            current = hospital
+        return events
+
+    def parse(self, description):
+        '''
+        :return: (action, hospital pk, from hospital pk, reason text), with an action of None for an
+        administrator's change, or None if the description is not understood
+        '''
+        if description == CHANGED:
+            return (None, None, None, '')
+        match = ADMITTED.match(description)
+        if match and match.group('hospital') in self.hospitals:
+            return (AdmissionEvent.ADMIT, self.hospitals[match.group('hospital')], None, match.group('reason'))
+        match = DISCHARGED.match(description)
+        if match and match.group('hospital') in self.hospitals:
+            return (AdmissionEvent.DISCHARGE, None, self.hospitals[match.group('hospital')], '')
+        match = TRANSFERRED.match(description)
+        if match:
+            # hospital names may contain " to ", so try every split
+            parts = match.group('hospitals').split(' to ')
+            for i in range(1, len(parts)):
+                old, new = ' to '.join(parts[:i]), ' to '.join(parts[i:])
+                if old in self.hospitals and new in self.hospitals:
+                    return (AdmissionEvent.TRANSFER, self.hospitals[new], self.hospitals[old], '')
+        return None
+
+    def write(self, events):
+        with transaction.atomic():
+            AdmissionEvent.objects.bulk_create(events)
+            # bulk_create sends no signals
+            invalidateStats('admissions')
+        return len(events)
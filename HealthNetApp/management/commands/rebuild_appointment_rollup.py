@@ -0,0 +1,76 @@
+"""
+filename: rebuild_appointment_rollup.py
+purpose: recompute the AppointmentRollup daily totals from the Appointment table
+"""
+
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from HealthNetApp.models import Appointment, AppointmentRollup
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the daily appointment totals used by the appointment statistics, for '
+            'every day or for the days from --start to --end (inclusive). Appointments are '
+            'read in chunks of --chunk-size rows, so memory use does not grow with the table. '
+            'Appointments changed while the command runs, or by queryset updates that send '
+            'no signals, may be counted wrongly until the days are rebuilt again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='first day to rebuild (YYYY-MM-DD)')
+        parser.add_argument('--end', help='last day to rebuild (YYYY-MM-DD)')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='number of appointments to read per query')
+
+    def handle(self, *args, **options):
+        start = self.parse_day(options['start'])
+        end = self.parse_day(options['end'])
+
+        appointments = Appointment.objects.all()
+        rollups = AppointmentRollup.objects.all()
+        if start:
+            appointments = appointments.filter(start__gte=self.midnight(start))
+            rollups = rollups.filter(day__gte=start)
+        if end:
+            appointments = appointments.filter(start__lt=self.midnight(end + datetime.timedelta(days=1)))
+            rollups = rollups.filter(day__lte=end)
+
+        totals = {}
+        last_pk = 0
+        read = 0
+        while True:
+            chunk = list(appointments.filter(pk__gt=last_pk).order_by('pk').values_list(
+                'pk', 'start', 'end', 'hospital_id', 'doctor_id', 'patient_id')[:options['chunk_size']])
+            if not chunk:
+                break
+            for pk, start_time, end_time, hospital_id, doctor_id, patient_id in chunk:
+                key = (timezone.localtime(start_time).date(), hospital_id, doctor_id, patient_id)
+                count, minutes = totals.get(key, (0, 0))
+                totals[key] = (count + 1, minutes + int((end_time - start_time).total_seconds()) // 60)
+            last_pk = chunk[-1][0]
+            read += len(chunk)
+            self.stdout.write('read {} appointments'.format(read))
+
+        with transaction.atomic():
+            rollups.delete()
+            AppointmentRollup.objects.bulk_create(
+                AppointmentRollup(day=day, hospital_id=hospital_id, doctor_id=doctor_id,
+                                  patient_id=patient_id, count=count, minutes=minutes)
+                for (day, hospital_id, doctor_id, patient_id), (count, minutes) in sorted(totals.items()))
+        self.stdout.write('wrote {} rollup rows'.format(len(totals)))
+
+    def parse_day(self, value):
+        if value is None:
+            return None
+        day = parse_date(value)
+        if day is None:
+            raise CommandError('not a date: ' + value)
+        return day
+
+    def midnight(self, day):
+        return timezone.make_aware(datetime.datetime.combine(day, datetime.time()),
+                                   timezone.get_default_timezone())
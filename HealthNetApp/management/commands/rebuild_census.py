@@ -0,0 +1,17 @@
+"""
+filename: rebuild_census.py
+purpose: rebuild the hospital census checkpoints from the whole admission history
+"""
+
+from django.core.management.base import BaseCommand
+
+from HealthNetApp import census
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the hourly hospital occupancy checkpoints by replaying every admission event. '
+            'They are otherwise built on first use and extended as admissions are recorded; run this '
+            'after changing admission events in ways that send no signals (e.g. queryset updates).')
+
+    def handle(self, *args, **options):
+        self.stdout.write('replayed {} admission events'.format(census.rebuild()))
@@ -0,0 +1,75 @@
+"""
+filename: rebuild_log_rollup.py
+purpose: recompute the LogRollup daily counts from the LogEntry table
+"""
+
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from HealthNetApp.models import LogEntry, LogRollup
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the daily log entry counts used by the log statistics, for every day '
+            'or for the days from --start to --end (inclusive). Log entries are read in '
+            'chunks of --chunk-size rows, so memory use does not grow with the table. '
+            'Log events written while the command runs may be counted twice or not at all '
+            'for the days being rebuilt.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='first day to rebuild (YYYY-MM-DD)')
+        parser.add_argument('--end', help='last day to rebuild (YYYY-MM-DD)')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='number of log entries to read per query')
+
+    def handle(self, *args, **options):
+        start = self.parse_day(options['start'])
+        end = self.parse_day(options['end'])
+
+        entries = LogEntry.objects.all()
+        rollups = LogRollup.objects.all()
+        if start:
+            entries = entries.filter(time__gte=self.midnight(start))
+            rollups = rollups.filter(day__gte=start)
+        if end:
+            entries = entries.filter(time__lt=self.midnight(end + datetime.timedelta(days=1)))
+            rollups = rollups.filter(day__lte=end)
+
+        counts = {}
+        last_pk = 0
+        read = 0
+        while True:
+            chunk = list(entries.filter(pk__gt=last_pk).order_by('pk').values_list(
+                'pk', 'time', 'action_type', 'thing_type', 'thing_field')[:options['chunk_size']])
+            if not chunk:
+                break
+            for pk, time, action_type, thing_type, thing_field in chunk:
+                key = (timezone.localtime(time).date(), action_type, thing_type, thing_field)
+                counts[key] = counts.get(key, 0) + 1
+            last_pk = chunk[-1][0]
+            read += len(chunk)
+            self.stdout.write('read {} log entries'.format(read))
+
+        with transaction.atomic():
+            rollups.delete()
+            LogRollup.objects.bulk_create(
+                LogRollup(day=day, action_type=action_type, thing_type=thing_type,
+                          thing_field=thing_field, count=count)
+                for (day, action_type, thing_type, thing_field), count in sorted(counts.items()))
+        self.stdout.write('wrote {} rollup rows'.format(len(counts)))
+
+    def parse_day(self, value):
+        if value is None:
+            return None
+        day = parse_date(value)
+        if day is None:
+            raise CommandError('not a date: ' + value)
+        return day
+
+    def midnight(self, day):
+        return timezone.make_aware(datetime.datetime.combine(day, datetime.time()),
+                                   timezone.get_default_timezone())
@@ -0,0 +1,24 @@
+"""
+filename: rebuild_search_index.py
+purpose: rebuild the full-text search index from the records it covers
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from HealthNetApp import search
+
+KIND_NAMES = {search.HISTORY: 'medical histories', search.TEST: 'medical tests',
+              search.PRESCRIPTION: 'prescriptions', search.MESSAGE: 'messages'}
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the full-text search index of medical histories, medical tests, prescriptions and '
+            'messages. It is otherwise kept up to date as they are saved; run this after changing them '
+            'in ways that send no signals (e.g. queryset updates or bulk inserts).')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            counts = search.rebuild()
+        self.stdout.write('indexed ' + ', '.join('{} {}'.format(counts[kind], KIND_NAMES[kind])
+                                                 for kind in search.KINDS))
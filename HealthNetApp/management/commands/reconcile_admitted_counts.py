@@ -0,0 +1,19 @@
+"""
+filename: reconcile_admitted_counts.py
+purpose: repair the per-hospital admitted patient counters
+"""
+
+from django.core.management.base import BaseCommand
+
+from HealthNetApp.admissions import reconcile_admitted_counts
+
+
+class Command(BaseCommand):
+    help = ('Recount the patients admitted to every hospital and fix the admitted patient '
+            'counters that have drifted, e.g. after patients were edited through the admin site.')
+
+    def handle(self, *args, **options):
+        fixed = reconcile_admitted_counts()
+        for name, old, new in fixed:
+            self.stdout.write('{}: {} -> {}'.format(name, old, new))
+        self.stdout.write('fixed {} admitted patient counters'.format(len(fixed)))
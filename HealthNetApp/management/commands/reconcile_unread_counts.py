@@ -0,0 +1,19 @@
+"""
+filename: reconcile_unread_counts.py
+purpose: repair the per-person unread message counters
+"""
+
+from django.core.management.base import BaseCommand
+
+from HealthNetApp.inbox import reconcile_unread_counts
+
+
+class Command(BaseCommand):
+    help = ('Recount every person\'s unread messages and fix the unread message counters '
+            'that have drifted, e.g. after messages were edited through the admin site.')
+
+    def handle(self, *args, **options):
+        fixed = reconcile_unread_counts()
+        for username, old, new in fixed:
+            self.stdout.write('{}: {} -> {}'.format(username, old, new))
+        self.stdout.write('fixed {} unread message counters'.format(len(fixed)))
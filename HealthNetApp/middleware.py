@@ -0,0 +1,18 @@
+"""
+filename: middleware.py
+purpose: request middleware for the HealthNetApp application
+"""
+
+from django.utils.functional import SimpleLazyObject
+
+from .principal import get_principal
+
+
+class PrincipalMiddleware(object):
+    '''
+    Attach the resolved Principal of the logged-in user to the request as
+    request.principal. Must come after AuthenticationMiddleware.
+    '''
+
+    def process_request(self, request):
+        request.principal = SimpleLazyObject(lambda: get_principal(request.user))
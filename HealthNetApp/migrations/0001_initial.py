@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 17:34
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Appointment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(verbose_name='Appointment Start Time')),
+                ('end', models.DateTimeField(verbose_name='Appointment End Time')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Hospital',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LogEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+                ('action_type', models.CharField(choices=[('c', 'Create'), ('r', 'Read'), ('u', 'Update'), ('d', 'Delete')], max_length=1)),
+                ('thing_type', models.CharField(choices=[('p', 'patient'), ('d', 'doctor'), ('n', 'nurse'), ('a', 'administrator'), ('v', 'appointment'), ('h', 'hospital'), ('r', 'prescription'), ('t', 'medical test'), ('m', 'message')], max_length=1)),
+                ('thing_instance', models.IntegerField()),
+                ('thing_field', models.CharField(max_length=25)),
+                ('eventDescription', models.CharField(max_length=200)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MedicalInformation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('history', models.TextField(max_length=1000)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MedicalTest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=50)),
+                ('testDate', models.DateField()),
+                ('results', models.TextField(max_length=1000)),
+                ('pending', models.IntegerField(null=True)),
+                ('pictures', models.FileField(default='Uploading a Picture', upload_to='testPics/%Y/%m/%d')),
+                ('pictures1', models.FileField(default='Uploading a Second Picture', upload_to='testPics/%Y/%m/%d')),
+                ('pictures2', models.FileField(default='Uploading a Third Picture', upload_to='testPics/%Y/%m/%d')),
+                ('pictures3', models.FileField(default='Uploading a Fourth Picture', upload_to='testPics/%Y/%m/%d')),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Hospital')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=100)),
+                ('body', models.CharField(max_length=1000)),
+                ('read', models.BooleanField(default=False)),
+                ('date', models.DateTimeField(verbose_name='Time sent')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Person',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('date_of_birth', models.DateField(verbose_name='Date of Birth')),
+                ('contact_information', models.CharField(max_length=200)),
+                ('username', models.CharField(max_length=30)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Prescription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('end_Date', models.DateField()),
+                ('start_Date', models.DateField()),
+                ('usage', models.CharField(max_length=200)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Administrator',
+            fields=[
+                ('person_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='HealthNetApp.Person')),
+            ],
+            bases=('HealthNetApp.person',),
+        ),
+        migrations.CreateModel(
+            name='MedicalProfessional',
+            fields=[
+                ('person_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='HealthNetApp.Person')),
+            ],
+            bases=('HealthNetApp.person',),
+        ),
+        migrations.CreateModel(
+            name='Patient',
+            fields=[
+                ('person_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='HealthNetApp.Person')),
+                ('insurance_id', models.CharField(max_length=15)),
+                ('emergency_contact', models.CharField(max_length=200)),
+                ('admitted_to', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='admitted_to', to='HealthNetApp.Hospital')),
+                ('medical_information', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.MedicalInformation')),
+                ('preferred_hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Hospital')),
+            ],
+            bases=('HealthNetApp.person',),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='destination',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='destination', to='HealthNetApp.Person'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='source',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='source', to='HealthNetApp.Person'),
+        ),
+        migrations.AddField(
+            model_name='logentry',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Person'),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='hospital',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Hospital'),
+        ),
+        migrations.CreateModel(
+            name='Doctor',
+            fields=[
+                ('medicalprofessional_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='HealthNetApp.MedicalProfessional')),
+            ],
+            bases=('HealthNetApp.medicalprofessional',),
+        ),
+        migrations.CreateModel(
+            name='Nurse',
+            fields=[
+                ('medicalprofessional_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='HealthNetApp.MedicalProfessional')),
+            ],
+            bases=('HealthNetApp.medicalprofessional',),
+        ),
+        migrations.AddField(
+            model_name='prescription',
+            name='prescribed_To',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Patient'),
+        ),
+        migrations.AddField(
+            model_name='medicaltest',
+            name='patient',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Patient'),
+        ),
+        migrations.AddField(
+            model_name='medicalprofessional',
+            name='hospital',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Hospital'),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='patient',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Patient'),
+        ),
+        migrations.AddField(
+            model_name='prescription',
+            name='prescribed_By',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Doctor'),
+        ),
+        migrations.AddField(
+            model_name='medicaltest',
+            name='doctor',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Doctor'),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='doctor',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Doctor'),
+        ),
+    ]
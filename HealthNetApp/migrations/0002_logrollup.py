@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 17:35
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('action_type', models.CharField(choices=[('c', 'Create'), ('r', 'Read'), ('u', 'Update'), ('d', 'Delete')], max_length=1)),
+                ('thing_type', models.CharField(choices=[('p', 'patient'), ('d', 'doctor'), ('n', 'nurse'), ('a', 'administrator'), ('v', 'appointment'), ('h', 'hospital'), ('r', 'prescription'), ('t', 'medical test'), ('m', 'message')], max_length=1)),
+                ('thing_field', models.CharField(max_length=25)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='logrollup',
+            unique_together=set([('day', 'action_type', 'thing_type', 'thing_field')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 17:36
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0002_logrollup'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='logentry',
+            index_together=set([('user', 'time', 'id'), ('time', 'id')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 17:37
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0003_logentry_time_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='appointment',
+            index_together=set([('patient', 'end', 'start'), ('doctor', 'end', 'start')]),
+        ),
+    ]
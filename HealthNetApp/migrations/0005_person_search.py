@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 17:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_search_name(apps, schema_editor):
+    # Person.save() keeps search_name up to date from now on
+    Person = apps.get_model('HealthNetApp', 'Person')
+    for pk, name in Person.objects.values_list('pk', 'name').iterator():
+        Person.objects.filter(pk=pk).update(search_name=name.lower())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0004_appointment_conflict_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='search_name',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='person',
+            name='username',
+            field=models.CharField(db_index=True, max_length=30),
+        ),
+        migrations.RunPython(fill_search_name, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 17:45
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0005_person_search'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='appointment',
+            index_together=set([('doctor', 'end', 'start'), ('patient', 'end', 'start'), ('end', 'start'), ('start', 'end'), ('hospital', 'end', 'start')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='logentry',
+            index_together=set([('time', 'id'), ('action_type', 'thing_type', 'time'), ('user', 'time', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('destination', 'read', 'date'), ('destination', 'date', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='prescription',
+            index_together=set([('start_Date', 'name')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 17:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_unread(apps, schema_editor):
+    Person = apps.get_model('HealthNetApp', 'Person')
+    Message = apps.get_model('HealthNetApp', 'Message')
+    unread = Message.objects.filter(read=False).values_list('destination').annotate(count=Count('id')).order_by()
+    for pk, count in unread:
+        Person.objects.filter(pk=pk).update(unread_messages=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0006_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='unread_messages',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_unread, migrations.RunPython.noop),
+    ]
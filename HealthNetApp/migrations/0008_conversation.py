@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 17:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+
+
+def thread_messages(apps, schema_editor):
+    '''
+    Put every existing message in a conversation: one per pair of people
+    and subject (ignoring "Re: " prefixes), as Conversation.for_message does.
+    '''
+    Conversation = apps.get_model('HealthNetApp', 'Conversation')
+    Message = apps.get_model('HealthNetApp', 'Message')
+    threads = {}
+    for pk, source, destination, subject, date in Message.objects.order_by('date', 'id') \
+            .values_list('pk', 'source_id', 'destination_id', 'subject', 'date').iterator():
+        subject = re.sub(r'^(\s*re:\s*)+', '', subject, flags=re.IGNORECASE).strip()
+        key = (min(source, destination), max(source, destination), subject)
+        if key not in threads:
+            threads[key] = (Conversation.objects.create(first_id=key[0], second_id=key[1], subject=subject,
+                                                        started=date), [])
+        threads[key][1].append(pk)
+    for conversation, pks in threads.values():
+        # in chunks, to stay under SQLite's limit on query parameters
+        for i in range(0, len(pks), 500):
+            Message.objects.filter(pk__in=pks[i:i + 500]).update(conversation=conversation)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0007_person_unread_messages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=100)),
+                ('started', models.DateTimeField()),
+                ('first', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='HealthNetApp.Person')),
+                ('second', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='HealthNetApp.Person')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='HealthNetApp.Conversation'),
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('destination', 'date', 'id'), ('conversation', 'date', 'id'), ('destination', 'read', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='conversation',
+            index_together=set([('first', 'second', 'subject')]),
+        ),
+        migrations.RunPython(thread_messages, migrations.RunPython.noop),
+    ]
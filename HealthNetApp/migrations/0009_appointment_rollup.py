@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 17:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def fill_rollup(apps, schema_editor):
+    Appointment = apps.get_model('HealthNetApp', 'Appointment')
+    AppointmentRollup = apps.get_model('HealthNetApp', 'AppointmentRollup')
+    totals = {}
+    for start, end, hospital_id, doctor_id, patient_id in Appointment.objects.values_list(
+            'start', 'end', 'hospital_id', 'doctor_id', 'patient_id').iterator():
+        key = (timezone.localtime(start).date(), hospital_id, doctor_id, patient_id)
+        count, minutes = totals.get(key, (0, 0))
+        totals[key] = (count + 1, minutes + int((end - start).total_seconds()) // 60)
+    AppointmentRollup.objects.bulk_create(
+        AppointmentRollup(day=day, hospital_id=hospital_id, doctor_id=doctor_id, patient_id=patient_id,
+                          count=count, minutes=minutes)
+        for (day, hospital_id, doctor_id, patient_id), (count, minutes) in sorted(totals.items()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0008_conversation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+                ('minutes', models.IntegerField(default=0)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Doctor')),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Hospital')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='HealthNetApp.Patient')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='appointmentrollup',
+            unique_together=set([('day', 'hospital', 'doctor', 'patient')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='appointmentrollup',
+            index_together=set([('day', 'patient', 'count', 'minutes')]),
+        ),
+        migrations.RunPython(fill_rollup, migrations.RunPython.noop),
+    ]
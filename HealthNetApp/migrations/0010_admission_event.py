@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 18:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0009_appointment_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdmissionEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('a', 'Admit'), ('t', 'Transfer'), ('d', 'Discharge')], max_length=1)),
+                ('reason_code', models.CharField(choices=[('none', 'None'), ('emergency surgery', 'Emergency Surgery'), ('scheduled surgery', 'Scheduled Surgery'), ('scheduled checkup', 'Scheduled Checkup'), ('other emergency', 'Other Emergency'), ('other scheduled appointment', 'Other Scheduled Appointment'), ('emergency', 'Emergency Registration'), ('other', 'Other')], default='none', max_length=30)),
+                ('reason_text', models.CharField(blank=True, default='', max_length=200)),
+                ('time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('from_hospital', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='HealthNetApp.Hospital')),
+                ('hospital', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='HealthNetApp.Hospital')),
+                ('log_entry', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='HealthNetApp.LogEntry')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='admission_events', to='HealthNetApp.Patient')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='admissionevent',
+            index_together=set([('action', 'time', 'reason_code'), ('patient', 'time'), ('action', 'time', 'hospital')]),
+        ),
+    ]
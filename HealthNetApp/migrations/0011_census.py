@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 18:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0010_admission_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CensusCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('occupancy', models.IntegerField()),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='HealthNetApp.Hospital')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CensusState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_event', models.IntegerField(default=0)),
+                ('stale_from', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='admissionevent',
+            index_together=set([('patient', 'time'), ('action', 'time', 'hospital'), ('time', 'id'), ('action', 'time', 'reason_code')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='censuscheckpoint',
+            unique_together=set([('hospital', 'hour')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='censuscheckpoint',
+            index_together=set([('hour', 'hospital', 'occupancy')]),
+        ),
+    ]
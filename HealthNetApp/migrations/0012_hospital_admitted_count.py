@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 18:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_admitted(apps, schema_editor):
+    Hospital = apps.get_model('HealthNetApp', 'Hospital')
+    Patient = apps.get_model('HealthNetApp', 'Patient')
+    for hospital_id, count in Patient.objects.exclude(admitted_to=None).values_list('admitted_to') \
+            .annotate(count=Count('pk')).order_by():
+        Hospital.objects.filter(pk=hospital_id).update(admitted_count=count)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0011_census'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hospital',
+            name='admitted_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_admitted, migrations.RunPython.noop),
+    ]
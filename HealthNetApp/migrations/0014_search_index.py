@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# The full-text index used by search.py. A document's rowid is the position
+# of its kind in search.KINDS * 2 ** 40 plus its object's pk.
+CREATE_INDEX = '''
+CREATE VIRTUAL TABLE "HealthNetApp_searchindex" USING fts5(
+    title, body, people, patient UNINDEXED,
+    tokenize = 'porter unicode61'
+)
+'''
+
+FILL_INDEX = [
+    '''INSERT INTO "HealthNetApp_searchindex" (rowid, title, body, people, patient)
+       SELECT p.person_ptr_id, '', i.history, '', p.person_ptr_id
+       FROM "HealthNetApp_patient" p JOIN "HealthNetApp_medicalinformation" i ON i.id = p.medical_information_id
+       WHERE i.history != '' ''',
+    '''INSERT INTO "HealthNetApp_searchindex" (rowid, title, body, people, patient)
+       SELECT 1099511627776 + id, title, results, '', patient_id FROM "HealthNetApp_medicaltest"
+       WHERE title != '' OR results != '' ''',
+    '''INSERT INTO "HealthNetApp_searchindex" (rowid, title, body, people, patient)
+       SELECT 2199023255552 + id, name, usage, '', "prescribed_To_id" FROM "HealthNetApp_prescription"
+       WHERE name != '' OR usage != '' ''',
+    '''INSERT INTO "HealthNetApp_searchindex" (rowid, title, body, people)
+       SELECT 3298534883328 + id, subject, body, 'u' || source_id || ' u' || destination_id
+       FROM "HealthNetApp_message"
+       WHERE subject != '' OR body != '' ''',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNetApp', '0013_unread_inbox_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL([CREATE_INDEX], ['DROP TABLE "HealthNetApp_searchindex"']),
+        migrations.RunSQL(FILL_INDEX, migrations.RunSQL.noop),
+    ]
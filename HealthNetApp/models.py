@@ -5,8 +5,8 @@ purpose: the model classes for the HealthNetApp application
 """
 
 import datetime, re, copy
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q, Count, Min, Sum, F
 from django.utils import timezone
 
 # ToDo: on_delete fields
@@ -15,17 +15,62 @@ from django.utils import timezone
 # todo: __str__ on lots of models
 
 
+# sorts after every other character, so [prefix, prefix + PREFIX_END) is the
+# range of strings that start with prefix
+PREFIX_END = '\U0010ffff'
+
+
 class Person(models.Model):
     name = models.CharField(max_length=50)
     date_of_birth = models.DateField('Date of Birth')
     contact_information = models.CharField(max_length=200)
-    username = models.CharField(max_length=30)#.lower()
+    username = models.CharField(max_length=30, db_index=True)#.lower()
+    # lower-cased copy of name, kept up to date by save(), so that name
+    # searches can use an index instead of a case-insensitive scan
+    search_name = models.CharField(max_length=50, db_index=True, editable=False, default='')
+    # number of unread messages sent to this person, kept up to date by
+    # inbox.py (and repaired by the reconcile_unread_counts command)
+    unread_messages = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
 
-    def get_messages(self):
-        return Message.objects.filter(destination=self).order_by('-date')
+    def save(self, *args, **kwargs):
+        self.search_name = self.name.lower()
+        super().save(*args, **kwargs)
+
+    def search(queryset, query, match='prefix'):
+        '''
+        Filter a queryset of people by name or username.
+        Prefix matches are index range scans on search_name and username;
+        substring matches have to scan, but are still returned in
+        search_name order so that a LIMIT can stop early.
+        :param queryset: Person (or Person subclass) queryset
+        :param query: the search text; empty matches everyone
+        :param match: 'prefix' or 'contains'
+        :return: the filtered queryset, ordered by name
+        '''
+        query = query.strip()
+        if query:
+            if match == 'contains':
+                queryset = queryset.filter(Q(search_name__contains=query.lower()) |
+                                           Q(username__icontains=query))
+            else:
+                # written as ranges: SQLite will not use an index for LIKE ... ESCAPE
+                queryset = queryset.filter(Q(search_name__gte=query.lower(),
+                                             search_name__lt=query.lower() + PREFIX_END) |
+                                           Q(username__gte=query, username__lt=query + PREFIX_END))
+        return queryset.order_by('search_name', 'pk')
+
+    def get_messages(self, unread_only=False):
+        '''
+        :param unread_only: only the messages that have not been read
+        :return: queryset of the messages sent to this person, newest first, with their senders
+        '''
+        messages = Message.objects.filter(destination=self)
+        if unread_only:
+            messages = messages.filter(read=False)
+        return messages.select_related('source').order_by('-date', '-id')
 
 
 class MedicalInformation(models.Model):
@@ -38,10 +83,25 @@ class MedicalInformation(models.Model):
 
 class Hospital(models.Model):
     name = models.CharField(max_length=50)
+    # number of patients admitted here, kept up to date by admissions.py
+    # (and repaired by the reconcile_admitted_counts command)
+    admitted_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
 
+    def staff(self):
+        '''
+        :return: queryset of the doctors and nurses working at this hospital
+        '''
+        return MedicalProfessional.objects.filter(hospital=self)
+
+    def patients(self):
+        '''
+        :return: queryset of the patients who prefer or are admitted to this hospital
+        '''
+        return Patient.objects.filter(Q(preferred_hospital=self) | Q(admitted_to=self))
+
 
 class Patient(Person):
     preferred_hospital = models.ForeignKey(Hospital)
@@ -168,6 +228,16 @@ class Appointment(models.Model):
     hospital = models.ForeignKey(Hospital)
     patient = models.ForeignKey(Patient)
 
+    class Meta:
+        index_together = [
+            # For finding conflicting appointments (see anyconflicts)
+            ('doctor', 'end', 'start'), ('patient', 'end', 'start'),
+            # Nurse.list_appointments and hospital-wide listings
+            ('hospital', 'end', 'start'),
+            # date ranges: statistics (start >= x, end <= y) and calendars (end > x)
+            ('start', 'end'), ('end', 'start'),
+        ]
+
     def conflicts(self, other):
         '''
         Check to see if two appointments are overlapping
@@ -175,7 +245,7 @@ class Appointment(models.Model):
         :param other: Another instance of Appointment
         :return: boolean
         '''
-        if not (self.patient == other.patient or self.doctor == other.doctor):
+        if not (self.patient_id == other.patient_id or self.doctor_id == other.doctor_id):
             return False
         if self.start.date() != other.start.date():
             return False
@@ -188,18 +258,28 @@ class Appointment(models.Model):
         return False
 
     def anyconflicts(self):
-        for appt in Appointment.objects.filter(Q(doctor=self.doctor) | Q(patient=self.patient)):
-            if appt == self: continue
-            if self.conflicts(appt):
-                return appt
-        return False
+        '''
+        Find another appointment that conflicts with this one, in the same
+        sense as conflicts(): it shares the doctor or the patient and the
+        two time ranges overlap, touching endpoints included.
+        This is a single query. Appointments never span more than one day,
+        so only those ending within a day of this one can overlap it, which
+        bounds the index range that is searched.
+        :return: the earliest conflicting Appointment, or False
+        '''
+        overlapping = Appointment.objects.filter(Q(doctor_id=self.doctor_id) | Q(patient_id=self.patient_id),
+                                                 end__gte=self.start,
+                                                 end__lt=self.end + datetime.timedelta(days=1),
+                                                 start__lte=self.end)
+        if self.pk is not None:
+            overlapping = overlapping.exclude(pk=self.pk)
+        return overlapping.order_by('start', 'id').first() or False
 
     def time_errors(self):
         '''
         Check start and end times for any problems.
         :return: Error message if invalid; None if valid
         '''
-        print('**', self.start.time())
         min = datetime.time(8, 0)
         max = datetime.time(18, 0)
         if not((min <= self.start.time() < max) and (min < self.end.time() <= max)):
@@ -216,6 +296,91 @@ class Appointment(models.Model):
 
 
 
+class AppointmentRollup(models.Model):
+    '''
+    The number and total length of the appointments a patient has with a
+    doctor at a hospital on one (local) day: a daily fact table that the
+    appointment statistics read instead of scanning Appointment.
+    Receivers in signals.py keep these current as appointments are created,
+    moved and cancelled; the rebuild_appointment_rollup management command
+    recomputes them from the Appointment table.
+    '''
+    day = models.DateField()
+    hospital = models.ForeignKey(Hospital)
+    doctor = models.ForeignKey(Doctor)
+    patient = models.ForeignKey(Patient)
+    count = models.IntegerField(default=0)
+    minutes = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'hospital', 'doctor', 'patient')
+        # statistics read a range of days, grouped by patient, without
+        # visiting the table
+        index_together = [('day', 'patient', 'count', 'minutes')]
+
+    def __str__(self):
+        return '{} {} with {} at {}: {} ({} minutes)'.format(self.day, self.patient_id, self.doctor_id,
+                                                            self.hospital_id, self.count, self.minutes)
+
+    def key(appointment):
+        '''
+        :param appointment: an Appointment
+        :return: the (day, hospital_id, doctor_id, patient_id) it is counted under
+        '''
+        return (timezone.localtime(appointment.start).date(), appointment.hospital_id,
+                appointment.doctor_id, appointment.patient_id)
+
+    def minutes_of(appointment):
+        '''
+        :return: the length of an appointment in whole minutes
+        '''
+        return int((appointment.end - appointment.start).total_seconds()) // 60
+
+    def add(key, count, minutes):
+        '''
+        Add to (or, with negative numbers, take from) the totals of one row.
+        Rows whose count drops to zero are deleted.
+        :param key: (day, hospital_id, doctor_id, patient_id)
+        '''
+        day, hospital_id, doctor_id, patient_id = key
+        rows = AppointmentRollup.objects.filter(day=day, hospital_id=hospital_id,
+                                                doctor_id=doctor_id, patient_id=patient_id)
+        with transaction.atomic():
+            if rows.update(count=F('count') + count, minutes=F('minutes') + minutes):
+                if count < 0:
+                    rows.filter(count__lte=0).delete()
+                return
+            if count <= 0:
+                # nothing to take from, e.g. the row went with a deleted patient
+                return
+            try:
+                with transaction.atomic():
+                    AppointmentRollup.objects.create(day=day, hospital_id=hospital_id, doctor_id=doctor_id,
+                                                     patient_id=patient_id, count=count, minutes=minutes)
+            except IntegrityError:
+                # Someone else created the row in the meantime
+                rows.update(count=F('count') + count, minutes=F('minutes') + minutes)
+
+    def record(old, new):
+        '''
+        Move an appointment's contribution from its old row to its new one.
+        :param old: the Appointment as it was stored before, or None if it is new
+        :param new: the Appointment as it is stored now, or None if it was deleted
+        '''
+        old_key = AppointmentRollup.key(old) if old is not None else None
+        new_key = AppointmentRollup.key(new) if new is not None else None
+        old_minutes = AppointmentRollup.minutes_of(old) if old is not None else 0
+        new_minutes = AppointmentRollup.minutes_of(new) if new is not None else 0
+        if old_key == new_key:
+            if old_minutes != new_minutes:
+                AppointmentRollup.add(new_key, 0, new_minutes - old_minutes)
+            return
+        if old_key is not None:
+            AppointmentRollup.add(old_key, -1, -old_minutes)
+        if new_key is not None:
+            AppointmentRollup.add(new_key, 1, new_minutes)
+
+
 class Prescription(models.Model):
     prescribed_By = models.ForeignKey(Doctor)
     prescribed_To = models.ForeignKey(Patient)
@@ -224,6 +389,10 @@ class Prescription(models.Model):
     start_Date = models.DateField()
     usage = models.CharField(max_length=200)
 
+    class Meta:
+        # For prescriptionStats: a date range, grouped by name
+        index_together = [('start_Date', 'name')]
+
     def __str__(self):
         return str(self.prescribed_To) + ' should follow these directions: \n'+ self.usage + '\nMedication: '+ self.name + '\nuntil ' + self.end_Date.isoformat() + '.\nContact '+ str(self.prescribed_By) + ' with any questions.'
 
@@ -245,56 +414,285 @@ class LogEntry(models.Model):
     # TODO: make this snake case
     eventDescription = models.CharField(max_length=200)
 
+    class Meta:
+        index_together = [
+            # For paging through the log newest-first, overall and per user
+            ('time', 'id'), ('user', 'time', 'id'),
+            # For filtering by kind of event over a time range (statistics, export)
+            ('action_type', 'thing_type', 'time'),
+        ]
+
     def __str__(self):
         return self.user.username + ' ' + self.get_action_type_display() + ' ' + self.thing_type
 
+    # The noun displayed in the d3Statistics tree for each thing_type.
+    # Medical tests and messages are not shown.
+    tree_nouns = {'p': "Patient", 'd': "Doctor", 'n': "Nurse", 'a': "Administrator",
+                  'v': "Appointment", 'h': "Hospital", 'r': "Prescription"}
+
     def parse(dateRange):
+        '''
+        Build the d3Statistics tree (verb -> noun -> count) of the log entries
+        in a date range. The counting is done by the database, in one query.
+        :param dateRange: [start, end], or None for every log entry
+        :return: nested lists of the form [label, [count, 1], {children}]
+        '''
         if dateRange == None:
             logs = LogEntry.objects.all()
         else:
             logs = LogEntry.objects.filter(time__range=(dateRange[0], dateRange[1]))
 
+        # Ordering by each group's first entry keeps the tree in the same
+        # order as walking the log entries one at a time.
+        counts = logs.values_list('action_type', 'thing_type').annotate(
+            count=Count('id'), first=Min('id')).order_by('first')
+        return LogEntry.buildTree(counts)
+
+    def buildTree(counts):
+        '''
+        Build the d3Statistics tree from log entry counts.
+        :param counts: iterable of (action_type, thing_type, count, ...) tuples
+        :return: nested lists of the form [label, [count, 1], {children}]
+        '''
         logList =   [" Log ",[0,0],{}]
+        verbs = dict(LogEntry.log_types)
 
-        for log in logs:
-            elements = str(log).split(' ')
-            if(elements[2] == 'p'):
-                logList = LogEntry.parseLog(logList, elements[1] ,"Patient")
-            elif(elements[2] == 'd'):
-                logList =  LogEntry.parseLog(logList, elements[1] ,"Doctor")
-            elif(elements[2] == 'n'):
-                logList =  LogEntry.parseLog(logList, elements[1] ,"Nurse")
-            elif(elements[2] == 'a'):
-                logList =  LogEntry.parseLog(logList, elements[1] ,"Administrator")
-            elif(elements[2] == 'v'):
-                logList = LogEntry.parseLog(logList, elements[1] ,"Appointment")
-            elif(elements[2] == 'h'):
-                logList =  LogEntry.parseLog(logList, elements[1] ,"Hospital")
-            elif(elements[2] == 'r'):
-                logList = LogEntry.parseLog(logList, elements[1] ,"Prescription")
+        for action_type, thing_type, count, *rest in counts:
+            if thing_type in LogEntry.tree_nouns:
+                logList = LogEntry.parseLog(logList, verbs.get(action_type, action_type),
+                                            LogEntry.tree_nouns[thing_type], count)
         return logList
 
-    def parseLog(logList, verb, noun):
-        logList[1][0] = logList[1][0] + 1
+    def parseLog(logList, verb, noun, count=1):
+        logList[1][0] = logList[1][0] + count
         logList[0] = " Logs "
-        logList[2] = LogEntry.parseVerb(logList[2], verb, noun)
+        logList[2] = LogEntry.parseVerb(logList[2], verb, noun, count)
         return logList
-    def parseVerb(verbDic, verb, noun):
+    def parseVerb(verbDic, verb, noun, count=1):
         if(verb in verbDic):
-            verbDic[verb][1][0] += 1
+            verbDic[verb][1][0] += count
             verbDic[verb][0] = " "+ verb + " Logs"
+        elif(count > 1):
+            verbDic[verb] = [" "+ verb + " Logs", [count,1], {}]
         else:
             verbDic[verb] = [" "+ verb + " Log", [1,1], {}]
-        verbDic[verb][2] = LogEntry.parseNoun(verbDic[verb][2], verb, noun)
+        verbDic[verb][2] = LogEntry.parseNoun(verbDic[verb][2], verb, noun, count)
         return verbDic
-    def parseNoun(nounDic, verb, noun):
+    def parseNoun(nounDic, verb, noun, count=1):
         if(noun in nounDic):
-            nounDic[noun][1][0] += 1
+            nounDic[noun][1][0] += count
             nounDic[noun][0] = " "+ verb +" Logs For "+noun+ "s "
+        elif(count > 1):
+            nounDic[noun]= [" "+ verb +" Logs For "+noun + "s ", [count,1], {}]
         else:
             nounDic[noun]= [" "+ verb +" Log For "+noun + "s ", [1,1], {}]
         return nounDic
 
+class LogRollup(models.Model):
+    '''
+    The number of log entries of one kind written on one (local) day.
+    log_event keeps these counts current; the rebuild_log_rollup management
+    command recomputes them from the LogEntry table.
+    '''
+    day = models.DateField()
+    action_type = models.CharField(choices=LogEntry.log_types, max_length=1)
+    thing_type = models.CharField(choices=LogEntry.thing_types, max_length=1)
+    thing_field = models.CharField(max_length=25)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'action_type', 'thing_type', 'thing_field')
+
+    def __str__(self):
+        return '{} {} {} {}: {}'.format(self.day, self.get_action_type_display(),
+                                        self.thing_type, self.thing_field, self.count)
+
+    def key(entry):
+        '''
+        :param entry: a LogEntry
+        :return: the (day, action_type, thing_type, thing_field) it is counted under
+        '''
+        return (timezone.localtime(entry.time).date(), entry.action_type,
+                entry.thing_type, entry.thing_field)
+
+    def record(entries):
+        '''
+        Add newly written log entries to the rollup counts. Should be called
+        inside the same transaction that saved the entries.
+        :param entries: iterable of LogEntry
+        '''
+        counts = {}
+        for entry in entries:
+            key = LogRollup.key(entry)
+            counts[key] = counts.get(key, 0) + 1
+        for (day, action_type, thing_type, thing_field), count in counts.items():
+            rows = LogRollup.objects.filter(day=day, action_type=action_type,
+                                            thing_type=thing_type, thing_field=thing_field)
+            if rows.update(count=F('count') + count):
+                continue
+            try:
+                with transaction.atomic():
+                    LogRollup.objects.create(day=day, action_type=action_type, thing_type=thing_type,
+                                             thing_field=thing_field, count=count)
+            except IntegrityError:
+                # Someone else created the row in the meantime
+                rows.update(count=F('count') + count)
+
+    def parse(dateRange):
+        '''
+        Build the d3Statistics tree from the rollup counts, counting whole
+        days from dateRange[0] up to (but not including) dateRange[1].
+        :param dateRange: [start, end] dates, or None for every day
+        :return: the same structure as LogEntry.parse
+        '''
+        if dateRange == None:
+            rollups = LogRollup.objects.all()
+        else:
+            rollups = LogRollup.objects.filter(day__gte=dateRange[0], day__lt=dateRange[1])
+        counts = rollups.values_list('action_type', 'thing_type').annotate(
+            count=Sum('count'), first=Min('id')).order_by('first')
+        return LogEntry.buildTree(counts)
+
+class AdmissionEvent(models.Model):
+    '''
+    One change to the hospital a patient is admitted to: an admission, a
+    transfer between hospitals or a discharge. Written by admissions.py
+    alongside the audit log entry; backfill_admission_events creates them
+    for admissions that were only logged.
+    '''
+    ADMIT = 'a'
+    TRANSFER = 't'
+    DISCHARGE = 'd'
+    actions = ((ADMIT, 'Admit'), (TRANSFER, 'Transfer'), (DISCHARGE, 'Discharge'))
+    # The reasons offered by the admission form, and 'emergency' for
+    # emergency registrations
+    reasons = (('none', 'None'), ('emergency surgery', 'Emergency Surgery'),
+               ('scheduled surgery', 'Scheduled Surgery'), ('scheduled checkup', 'Scheduled Checkup'),
+               ('other emergency', 'Other Emergency'),
+               ('other scheduled appointment', 'Other Scheduled Appointment'),
+               ('emergency', 'Emergency Registration'), ('other', 'Other'))
+
+    patient = models.ForeignKey(Patient, related_name='admission_events')
+    # the hospital admitted to, or None for a discharge
+    hospital = models.ForeignKey(Hospital, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    # the hospital the patient left, or None for an admission
+    from_hospital = models.ForeignKey(Hospital, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    action = models.CharField(choices=actions, max_length=1)
+    reason_code = models.CharField(choices=reasons, max_length=30, default='none')
+    reason_text = models.CharField(max_length=200, blank=True, default='')
+    time = models.DateTimeField(default=timezone.now)
+    # the audit log entry this was recovered from, for backfilled events
+    log_entry = models.OneToOneField(LogEntry, null=True, blank=True, on_delete=models.SET_NULL,
+                                     related_name='+')
+
+    class Meta:
+        index_together = [
+            # statistics: admissions over a time range, grouped by reason or hospital
+            ('action', 'time', 'reason_code'), ('action', 'time', 'hospital'),
+            # a patient's admission history
+            ('patient', 'time'),
+            # replaying every hospital's admissions in order (see census.py)
+            ('time', 'id'),
+        ]
+
+    def __str__(self):
+        return '{} {} {}'.format(self.time, self.get_action_display(), self.patient_id)
+
+    def reason_code_for(text):
+        '''
+        :param text: a free text admission reason, e.g. from the admission form
+        :return: the matching reason code; 'none' if there is no reason and 'other' if it is not one of ours
+        '''
+        text = (text or '').strip().lower()
+        if text in ('', 'none'):
+            return 'none'
+        if text in dict(AdmissionEvent.reasons):
+            return text
+        return 'other'
+
+
+class CensusCheckpoint(models.Model):
+    '''
+    The number of patients admitted to a hospital at the end of an hour
+    (UTC), for the hours in which it changed. Built and extended from the
+    AdmissionEvents by census.py.
+    '''
+    hospital = models.ForeignKey(Hospital, related_name='+')
+    # the start of the hour
+    hour = models.DateTimeField()
+    occupancy = models.IntegerField()
+
+    class Meta:
+        unique_together = ('hospital', 'hour')
+        # occupancy series read every hospital's checkpoints over a range of hours
+        index_together = [('hour', 'hospital', 'occupancy')]
+
+    def __str__(self):
+        return '{} {}: {}'.format(self.hospital_id, self.hour, self.occupancy)
+
+
+class CensusState(models.Model):
+    '''
+    How far the census checkpoints have been built: a single row.
+    '''
+    # AdmissionEvents up to this pk have been replayed
+    last_event = models.IntegerField(default=0)
+    # events from this time on were changed or deleted since they were
+    # replayed, so the checkpoints from then on must be rebuilt
+    stale_from = models.DateTimeField(null=True, blank=True)
+
+
+class Conversation(models.Model):
+    '''
+    A thread of messages between two people, with a common subject.
+    first is always the participant with the lower pk.
+    '''
+    subject = models.CharField(max_length=100)
+    first = models.ForeignKey(Person, related_name='+')
+    second = models.ForeignKey(Person, related_name='+')
+    started = models.DateTimeField()
+
+    class Meta:
+        index_together = [('first', 'second', 'subject')]
+
+    def __str__(self):
+        return self.subject
+
+    def thread_subject(subject):
+        '''
+        The subject of the thread a message belongs to: its subject without
+        any "Re: " prefixes.
+        :param subject: a message subject
+        :return: string
+        '''
+        return re.sub(r'^(\s*re:\s*)+', '', subject, flags=re.IGNORECASE).strip()
+
+    def participants(source_pk, destination_pk):
+        '''
+        :return: the (first, second) participant pks of a conversation
+        between two people, in either direction
+        '''
+        return min(source_pk, destination_pk), max(source_pk, destination_pk)
+
+    def for_message(source, destination, subject, date):
+        '''
+        Find the latest conversation between two people with the subject of
+        a new message, or start one.
+        :return: Conversation
+        '''
+        first, second = Conversation.participants(source.pk, destination.pk)
+        subject = Conversation.thread_subject(subject)
+        conversation = Conversation.objects.filter(first_id=first, second_id=second, subject=subject) \
+            .order_by('-started', '-id').first()
+        if conversation is None:
+            conversation = Conversation.objects.create(first_id=first, second_id=second, subject=subject,
+                                                       started=date)
+        return conversation
+
+    def has_participant(self, person):
+        return person.pk in (self.first_id, self.second_id)
+
+
 class Message(models.Model):
     source = models.ForeignKey(Person, related_name='source')
     destination = models.ForeignKey(Person, related_name='destination')
@@ -302,3 +700,12 @@ class Message(models.Model):
     body = models.CharField(max_length=1000)
     read = models.BooleanField(default=False)
     date = models.DateTimeField('Time sent')
+    conversation = models.ForeignKey(Conversation, null=True, blank=True, related_name='messages')
+
+    class Meta:
+        index_together = [
+            # For inboxes (newest first, read backwards), unread-only inboxes and unread counts
+            ('destination', 'date', 'id'), ('destination', 'read', 'date', 'id'),
+            # For reading a conversation newest first
+            ('conversation', 'date', 'id'),
+        ]
@@ -0,0 +1,94 @@
+"""
+filename: notifications.py
+purpose: an in-process publish/subscribe hub that pushes message events to
+the browsers of logged-in people (see views.message_events)
+"""
+
+import json, threading
+from queue import Queue, Empty, Full
+
+
+class Subscription(object):
+    '''
+    One listener's queue of events for one person. Events that arrive while
+    the queue is full are dropped; the unread count event carries the whole
+    count, so a listener that misses some still ends up showing the right
+    number.
+    '''
+
+    def __init__(self, hub, person_pk, max_events=100):
+        self.hub = hub
+        self.person_pk = person_pk
+        self.queue = Queue(max_events)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            pass
+
+    def get(self, timeout):
+        '''
+        Wait for the next event.
+        :param timeout: seconds to wait
+        :return: (event name, data) or None if nothing arrived in time
+        '''
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class Hub(object):
+    '''
+    Routes events to every Subscription of a person. Only listeners in the
+    same process see an event, so with several worker processes a person
+    is only notified by the process that handled the change.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def subscribe(self, person_pk):
+        subscription = Subscription(self, person_pk)
+        with self._lock:
+            self._subscriptions.setdefault(person_pk, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            listeners = self._subscriptions.get(subscription.person_pk)
+            if listeners is not None:
+                listeners.discard(subscription)
+                if not listeners:
+                    del self._subscriptions[subscription.person_pk]
+
+    def has_subscribers(self, person_pk):
+        return person_pk in self._subscriptions
+
+    def publish(self, person_pk, event, data):
+        '''
+        Send an event to everyone listening for a person.
+        :param event: the event name, e.g. 'unread'
+        :param data: JSON-serializable event data
+        :return: the number of listeners it was sent to
+        '''
+        with self._lock:
+            listeners = list(self._subscriptions.get(person_pk, ()))
+        for subscription in listeners:
+            subscription.put((event, data))
+        return len(listeners)
+
+
+hub = Hub()
+
+
+def format_event(event, data):
+    '''
+    Encode an event in the Server-Sent Events wire format.
+    '''
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
@@ -0,0 +1,105 @@
+"""
+filename: pagination.py
+purpose: cursor (keyset) pagination for long, newest-first listings such as
+the audit log and message inboxes
+"""
+
+import base64, json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class KeysetPage(object):
+    '''
+    One page of a KeysetPaginator. Iterating it yields the page's objects.
+    next_cursor / previous_cursor are opaque tokens for the neighbouring
+    pages, or None when there is no such page.
+    '''
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator(object):
+    '''
+    Paginate a queryset newest-first on (field, id), where field is a
+    DateTimeField. Each page is fetched with a single range query that
+    continues from the edge of the previous page, so it costs the same
+    however deep into the listing it is, and no COUNT(*) is needed. For the
+    query to be an index range scan there should be an index on
+    (<filter columns>, field, id). The cursor condition is written as
+    "field <= v AND (field < v OR id < pk)" rather than a plain OR so that
+    the database can seek straight to v.
+    '''
+
+    def __init__(self, queryset, per_page, field):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.field = field
+
+    def page(self, cursor=None):
+        '''
+        :param cursor: a token from a previous page, or None for the first page.
+        Invalid tokens also give the first page.
+        :return: KeysetPage
+        '''
+        position = self.decode(cursor)
+        field = self.field
+        if position is None:
+            rows = list(self.queryset.order_by('-' + field, '-id')[:self.per_page + 1])
+            more, rows = len(rows) > self.per_page, rows[:self.per_page]
+            return KeysetPage(rows, self.encode(rows[-1], 'next') if more else None, None)
+
+        value, pk, direction = position
+        if direction == 'next':
+            # rows older than the cursor
+            rows = list(self.queryset.filter(**{field + '__lte': value})
+                        .filter(Q(**{field + '__lt': value}) | Q(id__lt=pk))
+                        .order_by('-' + field, '-id')[:self.per_page + 1])
+            more, rows = len(rows) > self.per_page, rows[:self.per_page]
+            next_cursor = self.encode(rows[-1], 'next') if more else None
+            previous_cursor = self.encode(rows[0], 'previous') if rows else None
+        else:
+            # rows newer than the cursor, fetched oldest-first and then flipped
+            rows = list(self.queryset.filter(**{field + '__gte': value})
+                        .filter(Q(**{field + '__gt': value}) | Q(id__gt=pk))
+                        .order_by(field, 'id')[:self.per_page + 1])
+            more, rows = len(rows) > self.per_page, rows[:self.per_page]
+            rows.reverse()
+            previous_cursor = self.encode(rows[0], 'previous') if more else None
+            next_cursor = self.encode(rows[-1], 'next') if rows else None
+        if not rows:
+            # out of range (e.g. the rows around the cursor were deleted)
+            return self.page()
+        return KeysetPage(rows, next_cursor, previous_cursor)
+
+    def encode(self, obj, direction):
+        data = json.dumps([getattr(obj, self.field).isoformat(), obj.pk, direction])
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode(self, cursor):
+        if not cursor:
+            return None
+        try:
+            value, pk, direction = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            value = parse_datetime(value)
+        except (ValueError, TypeError):
+            return None
+        if value is None or not isinstance(pk, int) or direction not in ('next', 'previous'):
+            return None
+        return value, pk, direction
@@ -0,0 +1,109 @@
+"""
+filename: principal.py
+purpose: resolve who a logged-in user is (their groups and their Person record)
+once per request, so that views, helpers and template filters can share it
+"""
+
+from django.contrib.auth.models import Group
+from django.shortcuts import get_object_or_404
+from django.utils.functional import cached_property
+
+from .models import Patient, Nurse, Doctor, Administrator
+
+
+class Principal(object):
+    '''
+    The resolved identity of a Django auth user. The user's group names and
+    their concrete Person subclass are each loaded at most once, the first
+    time they are needed.
+    '''
+
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def groups(self):
+        '''
+        :return: frozenset of the names of every group the user belongs to
+        '''
+        if not self.user.is_authenticated():
+            return frozenset()
+        return frozenset(self.user.groups.values_list('name', flat=True))
+
+    @cached_property
+    def all_groups(self):
+        '''
+        :return: frozenset of the names of every group in the system
+        '''
+        return frozenset(Group.objects.values_list('name', flat=True))
+
+    def in_group(self, group):
+        '''
+        :param group: (string) The group name
+        :return: True iff the user is part of the given group
+        '''
+        return group in self.groups
+
+    @cached_property
+    def thing_type(self):
+        '''
+        The LogEntry thing_type of the user.
+        :return: One of 'p', 'n', 'd', or 'a'
+        '''
+        if self.in_group('Patients'):
+            return 'p'
+        elif self.in_group('Nurses'):
+            return 'n'
+        elif self.in_group('Doctors'):
+            return 'd'
+        else:
+            return 'a'
+
+    @cached_property
+    def person(self):
+        '''
+        The Patient, Nurse, Doctor or Administrator matching the user, or
+        None if the user has no such record.
+        '''
+        model = {'p': Patient, 'n': Nurse, 'd': Doctor}.get(self.thing_type)
+        if model is None:
+            if not self.user.is_superuser:
+                return None
+            model = Administrator
+        return model.objects.filter(username=self.user.username).first()
+
+    @property
+    def pkid(self):
+        '''
+        The primary key to log actions of this user against.
+        :return: A primary key, or 0 for administrators
+        '''
+        if self.thing_type == 'a':
+            #todo: actually return the person associated with the administrator
+            return 0
+        return self.person.pk
+
+    def get_person_or_404(self, model):
+        '''
+        Get the user's record as an instance of the given Person model,
+        reusing the already-resolved person when it has that type.
+        :param model: Patient, Nurse, Doctor, Administrator, ...
+        :return: an instance of model; raises Http404 if there is none
+        '''
+        if isinstance(self.person, model):
+            return self.person
+        return get_object_or_404(model, username=self.user.username)
+
+
+def get_principal(user):
+    '''
+    Get the Principal for a user, creating and caching it on the user object
+    so that every caller within the same request shares it.
+    :param user: A Django auth.models.User (usually request.user)
+    :return: Principal
+    '''
+    try:
+        return user._principal
+    except AttributeError:
+        user._principal = Principal(user)
+        return user._principal
@@ -0,0 +1,106 @@
+"""
+filename: scheduling.py
+purpose: find the free appointment slots of doctors, following the same
+rules as Appointment.time_errors
+"""
+
+import datetime
+
+from django.utils.timezone import make_aware, get_default_timezone, localtime, utc
+
+# Appointments start on a quarter hour between OPENING and CLOSING and last
+# one of DURATIONS minutes (see Appointment.time_errors)
+OPENING = datetime.time(8, 0)
+CLOSING = datetime.time(18, 0)
+DURATIONS = (15, 30, 45, 60)
+STEP = datetime.timedelta(minutes=15)
+
+
+def merge_bookings(bookings):
+    '''
+    Merge booked time ranges into disjoint blocks.
+    :param bookings: iterable of (start, end) datetimes, sorted by start
+    :return: list of (start, end), sorted, where no two blocks overlap or touch
+    '''
+    blocks = []
+    for start, end in bookings:
+        if blocks and start <= blocks[-1][1]:
+            if end > blocks[-1][1]:
+                blocks[-1] = (blocks[-1][0], end)
+        else:
+            blocks.append((start, end))
+    return blocks
+
+
+def free_slots(blocks, day, duration, not_before):
+    '''
+    Sweep one day's grid of candidate slots against the booked blocks.
+    As with Appointment.conflicts, a slot that touches a booking (ends when
+    it starts or starts when it ends) is not free.
+    :param blocks: disjoint, sorted (start, end) ranges, as from merge_bookings
+    :param day: a date
+    :param duration: slot length in minutes
+    :param not_before: slots starting before this datetime are skipped
+    :return: list of (start, end) datetimes, in local time
+    '''
+    tz = get_default_timezone()
+    length = datetime.timedelta(minutes=duration)
+    # sweep in UTC, like the bookings from the database; comparing datetimes
+    # with different tzinfos is several times slower
+    opening = make_aware(datetime.datetime.combine(day, OPENING), tz).astimezone(utc)
+    closing = make_aware(datetime.datetime.combine(day, CLOSING), tz).astimezone(utc)
+    not_before = not_before.astimezone(utc)
+    slots = []
+    i = 0
+    start = opening
+    while start + length <= closing:
+        end = start + length
+        # blocks that end before this slot starts cannot touch any later slot
+        while i < len(blocks) and blocks[i][1] < start:
+            i += 1
+        if i < len(blocks) and blocks[i][0] <= end:
+            # skip to the first grid time after this block ends
+            start += STEP * ((blocks[i][1] - start) // STEP + 1)
+            continue
+        if start >= not_before:
+            slots.append((localtime(start, tz), localtime(end, tz)))
+        start += STEP
+    return slots
+
+
+def find_free_slots(bookings, doctors, first_day, last_day, durations, not_before):
+    '''
+    Find the free slots of several doctors over a range of days.
+    :param bookings: (doctor_pk or None, start, end) tuples sorted by start.
+    A doctor_pk of None blocks the time for every doctor (e.g. the patient's
+    own appointments).
+    :param doctors: the doctors to search
+    :param first_day: first date to search
+    :param last_day: last date to search (inclusive)
+    :param durations: slot lengths, in minutes
+    :param not_before: no slot may start before this datetime
+    :return: list of (doctor, start, end, duration), ordered by doctor then start
+    '''
+    by_doctor = dict((doctor.pk, []) for doctor in doctors)
+    shared = []
+    for doctor_pk, start, end in bookings:
+        if doctor_pk is None:
+            shared.append((start, end))
+        elif doctor_pk in by_doctor:
+            by_doctor[doctor_pk].append((start, end))
+
+    found = []
+    for doctor in doctors:
+        # bookings never cross midnight, so each day can be swept on its own
+        blocks_by_day = {}
+        for start, end in merge_bookings(sorted(by_doctor[doctor.pk] + shared)):
+            for day in set((localtime(start).date(), localtime(end).date())):
+                blocks_by_day.setdefault(day, []).append((start, end))
+        day = first_day
+        while day <= last_day:
+            for duration in durations:
+                for start, end in free_slots(blocks_by_day.get(day, []), day, duration, not_before):
+                    found.append((doctor, start, end, duration))
+            day += datetime.timedelta(days=1)
+    found.sort(key=lambda slot: (slot[0].pk, slot[1], slot[3]))
+    return found
@@ -0,0 +1,270 @@
+"""
+filename: search.py
+purpose: full-text search over patients' medical histories, test results,
+prescriptions and messages. Each of them is a document in an SQLite FTS5
+table (created by migration 0014) that signals.py keeps in step with the
+models, and that the rebuild_search_index command can rebuild.
+"""
+
+import html, re
+
+from django.db import connection
+
+from .models import Patient, MedicalTest, Prescription, Message
+
+TABLE = 'HealthNetApp_searchindex'
+
+# Document kinds. The documents of each kind have their own range of rowids:
+# a document's rowid is the position of its kind * KIND_SPAN plus its
+# object's pk, so that it can be replaced or removed by rowid, and a search
+# can be limited to one kind (and to its newest documents) by rowid.
+HISTORY, TEST, PRESCRIPTION, MESSAGE = 'h', 't', 'p', 'm'
+KINDS = (HISTORY, TEST, PRESCRIPTION, MESSAGE)
+KIND_SPAN = 2 ** 40
+
+# Ranking costs a few microseconds per matching document, so a word found in
+# a large share of millions of documents would take seconds to rank. Only the
+# newest RANK_WINDOW matches of each kind are ranked; older ones follow all
+# the ranked matches, unranked and newest first.
+RANK_WINDOW = 5000
+# Checking whether a match is in scope (e.g. one of a nurse's patients) reads
+# its row, so the ranked matches in scope are only looked for among the newest
+# SCAN_WINDOW matches of each kind.
+SCAN_WINDOW = 4 * RANK_WINDOW
+# The scope of a search that every document is in
+UNSCOPED = ('', [])
+# A match in a document's title counts this many times as much as one in its body
+TITLE_WEIGHT = 4.0
+# Roughly how many words each snippet shows
+SNIPPET_TOKENS = 16
+# Documents read and written per query
+BATCH_SIZE = 500
+
+# Mark matches in titles and snippets; replaced by <mark> tags after they are escaped
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+
+def rowid(kind, pk):
+    return KINDS.index(kind) * KIND_SPAN + pk
+
+
+def split_rowid(value):
+    '''
+    :return: (kind, pk) of a document's rowid
+    '''
+    return KINDS[value // KIND_SPAN], value % KIND_SPAN
+
+
+def person_token(pk):
+    '''
+    :return: the word standing for a person in the people column of their messages
+    '''
+    return 'u{}'.format(pk)
+
+
+def documents(kind, pks=None):
+    '''
+    The documents of one kind, read from their models.
+    :param pks: the pks of the objects to read, or None for all of them
+    :return: iterator of (rowid, title, body, people, patient pk); objects with no text are skipped
+    '''
+    if kind == HISTORY:
+        # a patient's history document has the patient's pk
+        rows = Patient.objects.values_list('pk', 'medical_information__history')
+        make = lambda pk, history: ('', history, '', pk)
+    elif kind == TEST:
+        rows = MedicalTest.objects.values_list('pk', 'title', 'results', 'patient_id')
+        make = lambda pk, title, results, patient: (title, results, '', patient)
+    elif kind == PRESCRIPTION:
+        rows = Prescription.objects.values_list('pk', 'name', 'usage', 'prescribed_To_id')
+        make = lambda pk, name, usage, patient: (name, usage, '', patient)
+    else:
+        rows = Message.objects.values_list('pk', 'subject', 'body', 'source_id', 'destination_id')
+        make = lambda pk, subject, body, source, destination: (
+            subject, body, person_token(source) + ' ' + person_token(destination), None)
+    if pks is not None:
+        rows = rows.filter(pk__in=pks)
+    for row in rows.order_by().iterator():
+        title, body, people, patient = make(*row)
+        if title or body:
+            yield (rowid(kind, row[0]), title or '', body or '', people, patient)
+
+
+def write(cursor, docs):
+    cursor.executemany('INSERT INTO "{}" (rowid, title, body, people, patient) '
+                       'VALUES (%s, %s, %s, %s, %s)'.format(TABLE), docs)
+
+
+def index(kind, pks):
+    '''
+    (Re)index some objects of one kind, e.g. after they were saved. Objects
+    that no longer exist are removed from the index.
+    :param pks: iterable of the objects' pks
+    '''
+    pks = list(pks)
+    with connection.cursor() as cursor:
+        for i in range(0, len(pks), BATCH_SIZE):
+            batch = pks[i:i + BATCH_SIZE]
+            remove_rows(cursor, [rowid(kind, pk) for pk in batch])
+            write(cursor, list(documents(kind, batch)))
+
+
+def remove(kind, pks):
+    '''
+    Remove some objects of one kind from the index, e.g. after they were deleted.
+    '''
+    rowids = [rowid(kind, pk) for pk in pks]
+    with connection.cursor() as cursor:
+        for i in range(0, len(rowids), BATCH_SIZE):
+            remove_rows(cursor, rowids[i:i + BATCH_SIZE])
+
+
+def remove_rows(cursor, rowids):
+    if rowids:
+        cursor.execute('DELETE FROM "{}" WHERE rowid IN ({})'.format(TABLE, ', '.join(['%s'] * len(rowids))),
+                       rowids)
+
+
+def rebuild():
+    '''
+    Index every document again from scratch. Must be run inside a transaction.
+    :return: {kind: number of documents indexed}
+    '''
+    counts = {}
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM "{}"'.format(TABLE))
+        for kind in KINDS:
+            counts[kind] = 0
+            batch = []
+            for doc in documents(kind):
+                batch.append(doc)
+                if len(batch) == BATCH_SIZE:
+                    write(cursor, batch)
+                    counts[kind] += len(batch)
+                    batch = []
+            write(cursor, batch)
+            counts[kind] += len(batch)
+        # merge the index's segments, which makes searches faster
+        cursor.execute('INSERT INTO "{0}" ("{0}") VALUES (\'optimize\')'.format(TABLE))
+    return counts
+
+
+def match_expression(text):
+    '''
+    Turn search text into an FTS5 query that matches documents with every
+    word of it in their title or body. Words are quoted, so operators and
+    punctuation in the text are never interpreted.
+    :return: the query, or '' if the text has no words
+    '''
+    words = re.findall(r'\w+', text)
+    if not words:
+        return ''
+    return '{title body} : (' + ' '.join('"{}"'.format(word) for word in words) + ')'
+
+
+def highlight(text):
+    '''
+    :return: a title or snippet as HTML, with its matches in <mark> tags
+    '''
+    return html.escape(text).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def matching(expression, low, high, scope):
+    '''
+    :param scope: (SQL, params) of a condition the documents must also meet, e.g. on their patient
+    :return: (SQL, params) of the WHERE clause matching documents with rowids in [low, high)
+    '''
+    sql, params = scope
+    return ('"{0}" MATCH %s AND rowid >= %s AND rowid < %s'.format(TABLE) + sql,
+            [expression, low, high] + params)
+
+
+def newest(cursor, where, n):
+    '''
+    :param where: (SQL, params) of a WHERE clause
+    :return: the rowid of the nth newest document it matches, or None if it matches fewer
+    '''
+    sql, params = where
+    cursor.execute('SELECT rowid FROM "{}" WHERE {} ORDER BY rowid DESC LIMIT 1 OFFSET %s'.format(TABLE, sql),
+                   params + [n - 1])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def window_start(cursor, expression, kind, scope):
+    '''
+    :return: the lowest rowid of the newest RANK_WINDOW documents of a kind that match and are in
+    scope, among its newest SCAN_WINDOW matches
+    '''
+    low = rowid(kind, 0)
+    high = low + KIND_SPAN
+    if scope[0]:
+        # walks the matches' rowids only, which is cheap
+        floor = newest(cursor, matching(expression, low, high, UNSCOPED), SCAN_WINDOW)
+        if floor is not None:
+            low = floor
+    start = newest(cursor, matching(expression, low, high, scope), RANK_WINDOW)
+    return low if start is None else start
+
+
+def fetch(cursor, clauses, score, order, limit, offset):
+    '''
+    One page of the documents matching any of some WHERE clauses.
+    :param score: (SQL, params) of the score column
+    :return: list of (rowid, patient pk, title, snippet, score)
+    '''
+    selects = []
+    params = []
+    for where, where_params in clauses:
+        selects.append('SELECT rowid, patient, highlight("{0}", 0, %s, %s), snippet("{0}", 1, %s, %s, %s, %s), '
+                       '{1} AS score FROM "{0}" WHERE {2}'.format(TABLE, score[0], where))
+        params.extend([MATCH_START, MATCH_END, MATCH_START, MATCH_END, '...', SNIPPET_TOKENS] + score[1] + where_params)
+    cursor.execute(' UNION ALL '.join(selects) + ' ORDER BY {} LIMIT %s OFFSET %s'.format(order),
+                   params + [limit, offset])
+    return cursor.fetchall()
+
+
+def search(text, person_pk, patients=None, kind=None, limit=20, offset=0):
+    '''
+    The documents matching search text: the newest RANK_WINDOW matches of
+    each kind, best first (by BM25), then any older matches, newest first.
+    :param person_pk: the searching person's pk; only messages they sent or received are searched
+    :param patients: Patient queryset of the patients whose records (histories, tests and
+    prescriptions) may be searched, or None for every patient's
+    :param kind: only search documents of this kind (one of KINDS), or None for every kind
+    :return: list of (kind, pk, patient pk or None, title HTML, snippet HTML, score); lower scores
+    are better, and older matches have a score of None
+    '''
+    expression = match_expression(text)
+    if not expression:
+        return []
+    if patients is not None:
+        patients_sql, patients_params = patients.values_list('pk').order_by().query.sql_with_params()
+        scoped = (' AND patient IN ({})'.format(patients_sql), list(patients_params))
+    ranked = []
+    older = []
+    with connection.cursor() as cursor:
+        for searched in KINDS if kind is None else (kind,):
+            query = expression
+            if searched == MESSAGE:
+                # the person's own messages are found by the index, before ranking
+                query = '{} AND people : "{}"'.format(expression, person_token(person_pk))
+            scope = scoped if searched != MESSAGE and patients is not None else UNSCOPED
+            low = rowid(searched, 0)
+            start = window_start(cursor, query, searched, scope)
+            ranked.append(matching(query, start, low + KIND_SPAN, scope))
+            if start > low:
+                older.append(matching(query, low, start, scope))
+        rows = fetch(cursor, ranked, ('bm25("{}", %s, 1.0, 0.0)'.format(TABLE), [TITLE_WEIGHT]), 'score',
+                     limit, offset)
+        if len(rows) < limit and older:
+            # the page runs past the ranked matches; the older ones come next
+            skip = 0
+            if not rows:
+                for where, params in ranked:
+                    cursor.execute('SELECT COUNT(*) FROM "{}" WHERE {}'.format(TABLE, where), params)
+                    offset -= cursor.fetchone()[0]
+                skip = max(offset, 0)
+            rows += fetch(cursor, older, ('NULL', []), 'rowid DESC', limit - len(rows), skip)
+    return [split_rowid(value) + (patient, highlight(title), highlight(snippet), score)
+            for value, patient, title, snippet, score in rows]
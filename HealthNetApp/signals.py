@@ -0,0 +1,111 @@
+"""
+filename: signals.py
+purpose: keep derived data (the statistics cache, the appointment rollup, the
+census checkpoints, the admitted patient counters and the search index) in step
+with the models it is computed from. Connected in apps.HealthnetappConfig.ready.
+"""
+
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Appointment, AppointmentRollup, Prescription, AdmissionEvent, Hospital, Patient, \
+    MedicalInformation, MedicalTest, Message
+from . import census, search
+from .statistics import invalidateStats
+
+
+@receiver(pre_save, sender=Appointment)
+def appointment_saving(sender, instance, **kwargs):
+    # the stored version is needed to move the appointment out of its old
+    # rollup row when it is rescheduled
+    instance._stored = Appointment.objects.filter(pk=instance.pk).first() if instance.pk else None
+
+
+@receiver(post_save, sender=Appointment)
+def appointment_saved(sender, instance, **kwargs):
+    AppointmentRollup.record(getattr(instance, '_stored', None), instance)
+    instance._stored = None
+    invalidateStats('appointments')
+
+
+@receiver(post_delete, sender=Appointment)
+def appointment_deleted(sender, instance, **kwargs):
+    AppointmentRollup.record(instance, None)
+    invalidateStats('appointments')
+
+
+@receiver([post_save, post_delete], sender=Prescription)
+def prescription_changed(sender, **kwargs):
+    invalidateStats('prescriptions')
+
+
+@receiver(pre_save, sender=AdmissionEvent)
+def admission_saving(sender, instance, **kwargs):
+    instance._stored_time = AdmissionEvent.objects.filter(pk=instance.pk).values_list(
+        'time', flat=True).first() if instance.pk else None
+
+
+@receiver(post_save, sender=AdmissionEvent)
+def admission_saved(sender, instance, created, **kwargs):
+    # new events are picked up by census.extend; changed ones must be replayed
+    if not created:
+        stored_time = getattr(instance, '_stored_time', None)
+        census.mark_stale(min(instance.time, stored_time) if stored_time else instance.time)
+    invalidateStats('admissions')
+
+
+@receiver(post_delete, sender=AdmissionEvent)
+def admission_deleted(sender, instance, **kwargs):
+    census.mark_stale(instance.time)
+    invalidateStats('admissions')
+
+
+@receiver(post_delete, sender=Patient)
+def patient_deleted(sender, instance, **kwargs):
+    # admissions.py counts admissions; a deleted patient leaves their hospital
+    if instance.admitted_to_id is not None:
+        Hospital.objects.filter(pk=instance.admitted_to_id, admitted_count__gt=0) \
+            .update(admitted_count=F('admitted_count') - 1)
+    search.remove(search.HISTORY, [instance.pk])
+
+
+@receiver(post_save, sender=Patient)
+def patient_saved(sender, instance, **kwargs):
+    # a patient's history is indexed as theirs, and may have been given to them here
+    search.index(search.HISTORY, [instance.pk])
+
+
+@receiver(post_save, sender=MedicalInformation)
+def medical_information_saved(sender, instance, **kwargs):
+    search.index(search.HISTORY, Patient.objects.filter(medical_information=instance).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=MedicalTest)
+def medical_test_saved(sender, instance, **kwargs):
+    search.index(search.TEST, [instance.pk])
+
+
+@receiver(post_delete, sender=MedicalTest)
+def medical_test_deleted(sender, instance, **kwargs):
+    search.remove(search.TEST, [instance.pk])
+
+
+@receiver(post_save, sender=Prescription)
+def prescription_saved(sender, instance, **kwargs):
+    search.index(search.PRESCRIPTION, [instance.pk])
+
+
+@receiver(post_delete, sender=Prescription)
+def prescription_deleted(sender, instance, **kwargs):
+    search.remove(search.PRESCRIPTION, [instance.pk])
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, **kwargs):
+    search.index(search.MESSAGE, [instance.pk])
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    search.remove(search.MESSAGE, [instance.pk])
@@ -0,0 +1,58 @@
+/*
+ * filename: remote-chosen.js
+ * purpose: a remote mode for Chosen. The select box of a LookupSelect form
+ * field (forms.py) only contains the selected option; its other options are
+ * fetched from the URL in its data-lookup-url attribute as the user types
+ * into the Chosen search box.
+ */
+function remoteChosen(selector) {
+    var select = $(selector);
+    if (!select.length) {
+        return;
+    }
+    var url = select.data('lookup-url');
+    select.chosen({search_contains: true, no_results_text: 'No matches for'});
+    if (url === undefined) {
+        // not a LookupSelect: every option is already in the page
+        return;
+    }
+    var chosen = select.data('chosen');
+    var search = chosen.search_field;
+    var timer = null;
+    var seq = 0;
+
+    function update(text) {
+        var mine = ++seq;
+        $.getJSON(url, {q: text}, function (data) {
+            if (mine != seq) {
+                return; // the user has typed more since
+            }
+            var selected = select.val();
+            select.find('option').not(':selected').remove();
+            $.each(data.results, function (i, item) {
+                if (String(item.pk) != selected) {
+                    select.append($('<option>').val(item.pk).text(item.name));
+                }
+            });
+            select.trigger('chosen:updated');
+            // updating Chosen clears its search box
+            search.val(text);
+            chosen.winnow_results();
+        });
+    }
+
+    search.on('keyup', function (event) {
+        // leave the keys Chosen uses to move between and pick results alone
+        if ($.inArray(event.which, [9, 13, 16, 17, 18, 27, 38, 40, 91]) >= 0) {
+            return;
+        }
+        var text = search.val();
+        clearTimeout(timer);
+        timer = setTimeout(function () { update(text); }, 250);
+    });
+    select.on('chosen:showing_dropdown', function () {
+        if (select.find('option[value!=""]').length < 2) {
+            update(search.val());
+        }
+    });
+}
@@ -1,9 +1,12 @@
-from django.db.models import Count, Avg
-from .models import Appointment, Prescription, LogEntry
-from itertools import groupby
-import math
-from collections import Counter
-from django.http import Http404
+from django.db.models import Count, Avg, Sum, Func, IntegerField
+from .models import Appointment, AppointmentRollup, Prescription, AdmissionEvent, Hospital
+import datetime, time
+import numpy as np
+from itertools import islice
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
 
 def getAppointments(start, end):
     try:
@@ -18,50 +21,216 @@ def prescriptionStats(start, end):
     # Filters all prescription within date range, and aggregates a count of every unique prescription.
     return prescriptions.filter(start_Date__gte=start,start_Date__lte=end).annotate(count=Count('name')).order_by('-count')
 
+def getAppointmentRollups(start, end):
+    # The daily totals of the appointments getAppointments(start, end) finds: appointments never
+    # cross midnight, so those are the ones starting on a day from start up to (not including) end
+    return AppointmentRollup.objects.filter(day__gte=start, day__lt=end)
+
 def patientAppointmentStats(start, end):
-    return getAppointments(start,end).values_list('patient__name').annotate(count=Count('patient')).order_by('-count')
+    return getAppointmentRollups(start, end).values_list('patient__name').annotate(
+        appointments=Sum('count')).order_by('-appointments')
 
 def patientAppointmentLengthStats(start, end):
-    appointments = getAppointments(start, end).order_by('patient__name').values_list('patient__name', 'end', 'start').order_by('patient__name')
-    avgApptLength = []
-
-    # Groups every appointment by unique patient, and returns an iterator for each patient's appointments (apps)
-    for patient, appt in groupby(appointments, lambda x: x[0]):
-        counter = 0
-        sum = 0
-
-        # Iterates iterator and calculates average for each patient
-        for duration in appt:
-            counter += 1
-
-            # Calculates the duration of each appointment (end time - start time) and adds to running total
-            sum += (duration[1]-duration[2]).seconds/60
+    # Totals every patient's appointments in range from the daily totals
+    appointments = getAppointmentRollups(start, end).values_list('patient__name').annotate(
+        appointments=Sum('count'), total=Sum('minutes')).order_by('patient__name')
 
-        # Each patient's average is saved in a 2D array
-        avgApptLength.append([patient, str(int(sum/counter))+' Minutes'])
-    return avgApptLength
+    # Each patient's average is saved in a 2D array
+    return [[patient, str(int(total/count))+' Minutes'] for patient, count, total in appointments]
 
 
 def hospitalAppointmentStats(start, end):
-    # Filters appointments by date, aggregates amount of appointments for each unique patient, and averages those counts
-    return getAppointments(start,end).values_list('patient__name').annotate(count=Count('patient')).aggregate(average=Avg('count'))['average']
+    # Aggregates amount of appointments for each unique patient within date range, and averages those counts
+    return getAppointmentRollups(start, end).values_list('patient__name').annotate(
+        appointments=Sum('count')).aggregate(average=Avg('appointments'))['average']
 
 def hospitalAppointmentLengthStats(start, end):
-    appointmentTimes = getAppointments(start,end).values_list('end', 'start')
-    if len(appointmentTimes) > 0:
-        # Calculates duration of each appointment within date range and appends to list
-        durations = [(times[0]-times[1]).seconds/60 for times in appointmentTimes]
-        # ToDo: math.fsum because sum wont work???
+    # Totals the duration of every appointment within date range
+    totals = getAppointmentRollups(start, end).aggregate(total=Sum('minutes'), appointments=Sum('count'))
+    if totals['appointments']:
         # Calculates average duration
-        return str(math.fsum(durations)/len(durations)) + ' Minutes'
+        return str(totals['total']/totals['appointments']) + ' Minutes'
     return '0 Minutes'
 
+class EpochSeconds(Func):
+    '''
+    A datetime column as whole seconds since 1970-01-01 UTC, computed by the
+    database. Written for SQLite, which stores datetimes as UTC text.
+    '''
+
+    def __init__(self, expression, **extra):
+        super(EpochSeconds, self).__init__(expression, output_field=IntegerField(), **extra)
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return "CAST(strftime('%%s', {}) AS INTEGER)".format(sql), params
+
+# Rows are read from the database this many at a time
+DISTRIBUTION_CHUNK_SIZE = 10000
+# Width of the appointment length histogram bins, in minutes
+HISTOGRAM_BIN_MINUTES = 15
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def appointmentArrays(start, end, chunk_size=DISTRIBUTION_CHUNK_SIZE):
+    '''
+    Stream every appointment in range into NumPy arrays, a chunk of rows at a time.
+    :return: (hospital pks, start times as UTC seconds since the epoch, lengths in minutes)
+    '''
+    appointments = getAppointments(start, end).annotate(
+        start_seconds=EpochSeconds('start'), end_seconds=EpochSeconds('end')).values_list(
+        'hospital_id', 'start_seconds', 'end_seconds')
+    rows = np.empty((appointments.count(), 3), dtype=np.int64)
+    filled = 0
+    iterator = appointments.iterator()
+    while filled < len(rows):
+        # appointments booked since the count are left out
+        chunk = list(islice(iterator, min(chunk_size, len(rows) - filled)))
+        if not chunk:
+            break
+        rows[filled:filled + len(chunk)] = chunk
+        filled += len(chunk)
+    rows = rows[:filled]
+    return rows[:, 0], rows[:, 1], (rows[:, 2] - rows[:, 1]) / 60
+
+def localSeconds(seconds):
+    '''
+    Convert UTC seconds since the epoch to local wall clock seconds since the epoch.
+    UTC offsets only change on the hour, so the time zone is looked up once per distinct hour.
+    '''
+    tz = timezone.get_default_timezone()
+    hours, index = np.unique(seconds // 3600, return_inverse=True)
+    offsets = np.array([datetime.datetime.fromtimestamp(int(hour) * 3600, tz).utcoffset().total_seconds()
+                        for hour in hours], dtype=np.int64)
+    return seconds + offsets[index]
+
+def appointmentDistributions(start, end):
+    '''
+    Distributions of the appointments in range, for planning around the long tail rather than the mean.
+    :return: dict with
+        'count': the number of appointments
+        'length': median, p90 and p99 appointment length in minutes (None if there are no appointments)
+        'heatmap': {'days': weekday names, 'counts': 7 x 24 appointments starting in each local hour of the week}
+        'histograms': {'bins': lower bin edges in minutes, 'hospitals': [{'pk', 'name', 'counts'}]}
+    '''
+    hospitals, starts, minutes = appointmentArrays(start, end)
+
+    length = None
+    if len(minutes):
+        median, p90, p99 = np.percentile(minutes, [50, 90, 99])
+        length = {'median': float(median), 'p90': float(p90), 'p99': float(p99)}
+
+    # 1970-01-01 was a Thursday
+    local = localSeconds(starts)
+    weekdays = (local // 86400 + 3) % 7
+    hours = local % 86400 // 3600
+    heatmap = np.bincount(weekdays * 24 + hours, minlength=7 * 24).reshape(7, 24)
+
+    bins = (minutes // HISTOGRAM_BIN_MINUTES).astype(np.int64)
+    bin_count = int(bins.max()) + 1 if len(bins) else 0
+    hospital_pks, hospital_index = np.unique(hospitals, return_inverse=True)
+    counts = np.bincount(hospital_index * bin_count + bins,
+                         minlength=len(hospital_pks) * bin_count).reshape(len(hospital_pks), bin_count)
+    names = dict(Hospital.objects.filter(pk__in=hospital_pks.tolist()).values_list('pk', 'name'))
+
+    return {'count': len(minutes),
+            'length': length,
+            'heatmap': {'days': WEEKDAYS, 'counts': heatmap.tolist()},
+            'histograms': {'bins': [HISTOGRAM_BIN_MINUTES * i for i in range(bin_count)],
+                           'hospitals': [{'pk': pk, 'name': names.get(pk, ''), 'counts': row}
+                                         for pk, row in zip(hospital_pks.tolist(), counts.tolist())]}}
+
+def getAdmissions(start, end, *actions):
+    return AdmissionEvent.objects.filter(action__in=actions, time__gte=start, time__lte=end)
+
 def hospitalAdmissionReasons(start, end):
-    logs = LogEntry.objects.filter(time__gte=start, time__lte=end, action_type='u', thing_type='p', thing_field='admitted_to', eventDescription__icontains='reason').values_list('eventDescription', flat=True)
-    AdmissionReasons = []
-    temp =list(Counter(logs).items())
-    for reason in list(Counter(logs).items()):
-        index = reason[0].find('reason')+8
-        AdmissionReasons.append([reason[0][index:-1], reason[1]])
-    return AdmissionReasons
+    # Counts the admissions within date range by reason, in the database
+    reasons = getAdmissions(start, end, AdmissionEvent.ADMIT).values_list('reason_code').annotate(
+        count=Count('id')).order_by('-count', 'reason_code')
+    labels = dict(AdmissionEvent.reasons)
+    return [[labels.get(code, code), count] for code, count in reasons]
+
+def hospitalAdmissionCounts(start, end):
+    # Counts the patients admitted or transferred to each hospital within date range
+    return list(getAdmissions(start, end, AdmissionEvent.ADMIT, AdmissionEvent.TRANSFER).values_list(
+        'hospital__name').annotate(count=Count('id')).order_by('-count', 'hospital__name'))
+
+
+# Statistics cache
+# Results are cached per (metric, start, end). Each metric depends on one
+# source of data, and every cache key includes that source's generation
+# number; bumping the generation (see signals.py) makes every cached result
+# of the source unreachable at once, without having to find the keys.
+
+STATS_SOURCES = {
+    'prescriptions': 'prescriptions',
+    'PatientAppointments': 'appointments',
+    'staylength': 'appointments',
+    'AppointmentAverages': 'appointments',
+    'AppointmentDistributions': 'appointments',
+    'AdmissionReasons': 'admissions',
+    'AdmissionCounts': 'admissions',
+}
+
+def statsGeneration(source):
+    key = 'stats:generation:' + source
+    generation = cache.get(key)
+    if generation is None:
+        # start from the clock, so that a generation lost from the cache is
+        # never reused for older results
+        cache.add(key, int(time.time() * 1000), None)
+        generation = cache.get(key)
+    return generation
+
+def invalidateStats(source):
+    '''
+    Drop every cached statistic computed from a source of data, once the
+    current transaction commits.
+    :param source: 'appointments', 'prescriptions' or 'admissions'
+    '''
+    def bump():
+        key = 'stats:generation:' + source
+        try:
+            cache.incr(key)
+        except ValueError:
+            statsGeneration(source)
+    transaction.on_commit(bump)
+
+def countStatsLookup(outcome):
+    key = 'stats:' + outcome
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, 1, None)
+
+def cachedStat(metric, start, end, compute):
+    '''
+    Get a statistic from the cache, or compute and cache it.
+    :param metric: a key of STATS_SOURCES
+    :param start: the first day of the range (a date)
+    :param end: the last day of the range (a date)
+    :param compute: function computing the statistic; its result must be picklable
+    :return: the statistic
+    '''
+    key = 'stats:{}:{}:{}:{}'.format(metric, statsGeneration(STATS_SOURCES[metric]),
+                                     start.isoformat(), end.isoformat())
+    cached = cache.get(key)
+    if cached is not None:
+        countStatsLookup('hits')
+        return cached[0]
+    countStatsLookup('misses')
+    # wrapped, so that a result of None is cached too
+    value = compute()
+    cache.set(key, (value,), getattr(settings, 'STATS_CACHE_TIMEOUT', 3600))
+    return value
+
+def statsCacheCounters():
+    '''
+    :return: dict of the statistics cache hit and miss counts
+    '''
+    hits = cache.get('stats:hits') or 0
+    misses = cache.get('stats:misses') or 0
+    return {'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else None}
 
@@ -1,29 +1,33 @@
 #http://stackoverflow.com/questions/4577513/how-do-i-change-a-django-template-based-on-the-users-group
 from django import template
-from django.contrib.auth.models import Group
-from django.shortcuts import get_object_or_404
-from HealthNetApp.models import Person
+from HealthNetApp.forms import LookupSelect
+from HealthNetApp.inbox import unread_count
+from HealthNetApp.principal import get_principal
 from django.utils import timezone
 
 register = template.Library()
 @register.filter(name='has_group')
 def has_group(user, group_name):
-    try:
-        group = Group.objects.get(name=group_name)
-    except:
-        return False  # group doesn't exist, so for sure the user isn't part of the group
+    principal = get_principal(user)
+    if principal.in_group(group_name):
+        return True
 
-    # for superuser or staff, always return True
+    # for superuser or staff, always return True, as long as the group exists
     if user.is_superuser or user.is_staff:
-        return True
+        return group_name in principal.all_groups
 
-    return user.groups.filter(name=group_name).exists()
+    return False
 
 @register.filter(name='new_message')
 def new_message(user):
-    person = get_object_or_404(Person, username=user.username)
-    return person.get_messages().filter(read=False).count()
+    # cached; see inbox.unread_count
+    return unread_count(user.username)
     
 @register.filter(name='in_past')
 def in_past(time):
-    return int(time < timezone.now())
\ No newline at end of file
+    return int(time < timezone.now())
+
+@register.filter(name='is_lookup')
+def is_lookup(field):
+    # a LookupSelect fills its options from the lookup view; see remote-chosen.js
+    return isinstance(field.field.widget, LookupSelect)
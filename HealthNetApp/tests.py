@@ -1,3 +1,1540 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 
 # Create your tests here.
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count, Q
+from django.template import Context, Template
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from io import StringIO
+from unittest import mock
+import csv, datetime, gzip, itertools, json, math, numpy, random, threading
+from . import admissions, census, inbox, notifications, search, statistics
+from .forms import MessageForm, DoctorAppointmentForm
+from .inbox import unread_count
+from .logger import AuditWriter, log_event, iter_log_entries, EXPORT_FIELDS
+from .models import Person, Hospital, Patient, Doctor, Nurse, MedicalInformation, LogEntry, LogRollup, \
+    AdmissionEvent, Appointment, AppointmentRollup, CensusCheckpoint, Message, Conversation, Administrator, MedicalProfessional, \
+    MedicalTest, Prescription
+from .notifications import Hub
+from .pagination import KeysetPaginator
+from .principal import Principal, get_principal
+from .scheduling import merge_bookings, free_slots, DURATIONS
+
+
+def make_user(username, group=None, **kwargs):
+    '''
+    Create a Django user (password "pw") in the given group.
+    '''
+    user = User.objects.create_user(username, '', 'pw', **kwargs)
+    if group:
+        user.groups.add(Group.objects.get_or_create(name=group)[0])
+    return user
+
+
+def make_patient(username, hospital, name=None, admitted_to=None):
+    return Patient.objects.create(name=name or username,
+                                  date_of_birth="1985-01-01",
+                                  contact_information="phone",
+                                  username=username,
+                                  preferred_hospital=hospital,
+                                  admitted_to=admitted_to,
+                                  insurance_id=0,
+                                  medical_information=MedicalInformation.objects.create(history=""),
+                                  emergency_contact="mommy")
+
+
+def make_staff(model, username, hospital, name=None):
+    return model.objects.create(name=name or username,
+                                date_of_birth="1985-01-01",
+                                contact_information="phone",
+                                username=username,
+                                hospital=hospital)
+
+
+def group_queries(queries):
+    return [q for q in queries if 'auth_user_groups' in q['sql']]
+
+
+class testPrincipal(TestCase):
+    def setUp(self):
+        for name in ('Patients', 'Nurses', 'Doctors'):
+            Group.objects.create(name=name)
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.nurse = make_staff(Nurse, "nursey", self.hosp)
+        self.nurse_user = make_user("nursey", 'Nurses')
+        self.patient = make_patient("patty", self.hosp)
+        self.patient_user = make_user("patty", 'Patients')
+        self.admin_user = make_user("boss", is_superuser=True, is_staff=True)
+
+    def test_thing_type_and_person(self):
+        principal = Principal(self.nurse_user)
+        self.assertEqual(principal.thing_type, 'n')
+        self.assertEqual(principal.person, self.nurse)
+        self.assertEqual(principal.pkid, self.nurse.pk)
+        principal = Principal(self.patient_user)
+        self.assertEqual(principal.thing_type, 'p')
+        self.assertEqual(principal.pkid, self.patient.pk)
+        principal = Principal(self.admin_user)
+        self.assertEqual(principal.thing_type, 'a')
+        self.assertEqual(principal.pkid, 0)
+
+    def test_groups_loaded_once(self):
+        principal = get_principal(self.nurse_user)
+        with CaptureQueriesContext(connection) as ctx:
+            for _ in range(5):
+                principal.in_group('Nurses')
+                principal.in_group('Doctors')
+                principal.thing_type
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertIs(get_principal(self.nurse_user), principal)
+
+    def test_get_person_or_404_reuses_person(self):
+        principal = get_principal(self.nurse_user)
+        principal.person
+        with self.assertNumQueries(0):
+            self.assertEqual(principal.get_person_or_404(Nurse), self.nurse)
+            self.assertEqual(principal.get_person_or_404(Person).pk, self.nurse.pk)
+
+    def test_list_patients_resolves_groups_once(self):
+        self.client.login(username="nursey", password="pw")
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/app/listpatients/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "patty")
+        self.assertEqual(len(group_queries(ctx.captured_queries)), 1)
+
+    def test_has_group_filter(self):
+        from .templatetags.utils_extras import has_group
+        self.assertTrue(has_group(self.nurse_user, 'Nurses'))
+        self.assertFalse(has_group(self.nurse_user, 'Doctors'))
+        self.assertTrue(has_group(self.admin_user, 'Doctors'))
+        self.assertFalse(has_group(self.admin_user, 'Janitors'))
+
+
+class testAuditWriter(TestCase):
+    def setUp(self):
+        Person.objects.create(name="Dave", date_of_birth="1990-04-01",
+                              contact_information="none", username="dave")
+        Person.objects.create(name="Bill", date_of_birth="1990-04-01",
+                              contact_information="none", username="bill")
+
+    def put(self, writer, username, i):
+        writer.put(username, timezone.now(), 'r', 'p', i, 'N/A', 'event %d' % i)
+
+    def test_log_event_is_synchronous_by_default(self):
+        log_event('dave', 'r', 'p', 1, 'N/A', 'user has logged in')
+        self.assertEqual(LogEntry.objects.get().user.username, 'dave')
+
+    def test_concurrent_puts_are_counted(self):
+        writer = AuditWriter(batch_size=10 ** 6)
+        threads = [threading.Thread(target=lambda: [self.put(writer, 'dave', i) for i in range(2000)])
+                   for t in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = writer.stats()
+        self.assertEqual(stats['enqueued'], 8000)
+        self.assertEqual(stats['queue_depth'], 8000)
+
+    def test_flush_writes_batch(self):
+        writer = AuditWriter(batch_size=10)
+        for i in range(5):
+            self.put(writer, 'dave', i)
+            self.put(writer, 'bill', i)
+        self.assertEqual(LogEntry.objects.count(), 0)
+        self.assertEqual(writer.stats()['queue_depth'], 10)
+        # one query to resolve users, one bulk insert
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(writer.flush(), 10)
+        sql = [q['sql'] for q in ctx.captured_queries]
+        self.assertEqual(len([q for q in sql if q.startswith('SELECT') and 'HealthNetApp_person' in q]), 1)
+        self.assertEqual(len([q for q in sql if q.startswith('INSERT INTO "HealthNetApp_logentry"')]), 1)
+        self.assertEqual(LogEntry.objects.filter(user__username='bill').count(), 5)
+        stats = writer.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['written'], 10)
+        self.assertEqual(stats['flushes'], 1)
+
+    def test_unknown_user_is_dropped_and_counted(self):
+        writer = AuditWriter()
+        self.put(writer, 'dave', 1)
+        self.put(writer, 'nobody', 2)
+        writer.flush()
+        stats = writer.stats()
+        self.assertEqual(stats['written'], 1)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['enqueued'], stats['written'] + stats['dropped'])
+
+    def test_failed_batch_is_retried_then_dropped(self):
+        writer = AuditWriter(max_attempts=2)
+        self.put(writer, 'dave', 1)
+        with mock.patch.object(writer, '_write', side_effect=ValueError('bad batch')):
+            self.assertRaises(ValueError, writer.flush)
+            self.assertEqual(writer.stats()['queue_depth'], 1)
+            self.assertRaises(ValueError, writer.flush)
+        # the bad batch is gone, and does not hold up the events after it
+        self.put(writer, 'bill', 2)
+        self.assertEqual(writer.flush(), 1)
+        stats = writer.stats()
+        self.assertEqual((stats['errors'], stats['dropped'], stats['written'], stats['queue_depth']), (2, 1, 1, 0))
+        self.assertEqual(stats['enqueued'], stats['written'] + stats['dropped'])
+
+    def test_buffered_log_event(self):
+        writer = AuditWriter()
+        with mock.patch('HealthNetApp.logger.get_audit_writer', return_value=writer):
+            log_event('dave', 'r', 'p', 1, 'N/A', 'user has logged in')
+        self.assertEqual(LogEntry.objects.count(), 0)
+        writer.close()
+        self.assertEqual(LogEntry.objects.count(), 1)
+
+
+class testLogEntryParse(TestCase):
+    def setUp(self):
+        dave = Person.objects.create(name="Dave", date_of_birth="1990-04-01",
+                                     contact_information="none", username="dave")
+        now = timezone.now()
+        for action_type, thing_type in (('r', 'p'), ('c', 'v'), ('r', 'p'), ('r', 'm'),
+                                        ('r', 'd'), ('c', 'v'), ('c', 'v'), ('u', 'p')):
+            LogEntry.objects.create(user=dave, time=now, action_type=action_type,
+                                    thing_type=thing_type, thing_instance=1,
+                                    thing_field='N/A', eventDescription='')
+
+    def test_tree(self):
+        with self.assertNumQueries(1):
+            tree = LogEntry.parse(None)
+        self.assertEqual(tree, [" Logs ", [7, 0], {
+            'Read': [" Read Logs", [3, 1], {
+                'Patient': [" Read Logs For Patients ", [2, 1], {}],
+                'Doctor': [" Read Log For Doctors ", [1, 1], {}]}],
+            'Create': [" Create Logs", [3, 1], {
+                'Appointment': [" Create Logs For Appointments ", [3, 1], {}]}],
+            'Update': [" Update Log", [1, 1], {
+                'Patient': [" Update Log For Patients ", [1, 1], {}]}]}])
+        self.assertEqual(list(tree[2]), ['Read', 'Create', 'Update'])
+        self.assertEqual(list(tree[2]['Read'][2]), ['Patient', 'Doctor'])
+
+    def test_empty_range(self):
+        self.assertEqual(LogEntry.parse(['2000-01-01', '2000-01-02']), [" Log ", [0, 0], {}])
+
+
+class testLogRollup(TestCase):
+    def setUp(self):
+        Person.objects.create(name="Dave", date_of_birth="1990-04-01",
+                              contact_information="none", username="dave")
+        for action_type, thing_type in (('r', 'p'), ('c', 'v'), ('r', 'p'), ('r', 'm'), ('u', 'p')):
+            log_event('dave', action_type, thing_type, 1, 'N/A', '')
+
+    def test_log_event_updates_rollup(self):
+        today = timezone.localtime(timezone.now()).date()
+        rollup = LogRollup.objects.get(action_type='r', thing_type='p')
+        self.assertEqual((rollup.day, rollup.count), (today, 2))
+        self.assertEqual(LogRollup.objects.count(), 4)
+
+    def test_parse_matches_log_entries(self):
+        today = timezone.localtime(timezone.now()).date()
+        tomorrow = today + datetime.timedelta(days=1)
+        self.assertEqual(LogRollup.parse([today, tomorrow]), LogEntry.parse(None))
+        self.assertEqual(LogRollup.parse([tomorrow, tomorrow]), [" Log ", [0, 0], {}])
+
+    def test_rebuild_command(self):
+        expected = sorted(LogRollup.objects.values_list('day', 'action_type', 'thing_type', 'thing_field', 'count'))
+        LogRollup.objects.update(count=42)
+        call_command('rebuild_log_rollup', chunk_size=2, stdout=StringIO())
+        self.assertEqual(sorted(LogRollup.objects.values_list('day', 'action_type', 'thing_type', 'thing_field', 'count')),
+                         expected)
+
+
+class testKeysetPaginator(TestCase):
+    def setUp(self):
+        dave = Person.objects.create(name="Dave", date_of_birth="1990-04-01",
+                                     contact_information="none", username="dave")
+        now = timezone.now()
+        # pairs of entries share a timestamp, to exercise the id tie-breaker
+        for i in range(25):
+            LogEntry.objects.create(user=dave, time=now - datetime.timedelta(minutes=i // 2),
+                                    action_type='r', thing_type='p', thing_instance=i,
+                                    thing_field='N/A', eventDescription='')
+        self.expected = list(LogEntry.objects.order_by('-time', '-id'))
+
+    def test_walk_forwards_and_backwards(self):
+        paginator = KeysetPaginator(LogEntry.objects.all(), 10, 'time')
+        pages = [paginator.page()]
+        self.assertFalse(pages[0].has_previous())
+        while pages[-1].has_next():
+            with self.assertNumQueries(1):
+                pages.append(paginator.page(pages[-1].next_cursor))
+        self.assertEqual([len(p) for p in pages], [10, 10, 5])
+        self.assertEqual([e for p in pages for e in p], self.expected)
+        back = paginator.page(pages[2].previous_cursor)
+        self.assertEqual(list(back), list(pages[1]))
+        back = paginator.page(back.previous_cursor)
+        self.assertEqual(list(back), list(pages[0]))
+        self.assertFalse(back.has_previous())
+
+    def test_bad_cursor_gives_first_page(self):
+        paginator = KeysetPaginator(LogEntry.objects.all(), 10, 'time')
+        self.assertEqual(list(paginator.page('garbage')), self.expected[:10])
+
+    def test_view_logs(self):
+        make_user("boss", is_superuser=True, is_staff=True)
+        self.client.login(username="boss", password="pw")
+        response = self.client.get('/app/view_logs/')
+        self.assertEqual(list(response.context['log_entries']), self.expected[:10])
+        response = self.client.get('/app/view_logs/', {'cursor': response.context['log_entries'].next_cursor})
+        self.assertEqual(list(response.context['log_entries']), self.expected[10:20])
+
+
+class testExportLogs(TestCase):
+    def setUp(self):
+        self.dave = Person.objects.create(name="Dave", date_of_birth="1990-04-01",
+                                          contact_information="none", username="dave")
+        bill = Person.objects.create(name="Bill", date_of_birth="1990-04-01",
+                                     contact_information="none", username="bill")
+        now = timezone.now()
+        for i in range(30):
+            LogEntry.objects.create(user=self.dave if i % 3 else bill, time=now, action_type='cr'[i % 2],
+                                    thing_type='p', thing_instance=i, thing_field='N/A',
+                                    eventDescription='event, "%d"' % i)
+        Person.objects.create(name="Boss", date_of_birth="1990-04-01",
+                              contact_information="none", username="boss")
+        make_user("boss", is_superuser=True, is_staff=True)
+        self.client.login(username="boss", password="pw")
+
+    def test_csv(self):
+        response = self.client.get('/app/export_logs/', {'format': 'csv', 'user': self.dave.pk, 'action_type': 'r'})
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], EXPORT_FIELDS)
+        expected = LogEntry.objects.filter(user=self.dave, action_type='r').order_by('pk')
+        self.assertEqual([int(r[0]) for r in rows[1:]], [e.pk for e in expected])
+        self.assertEqual(rows[1][7], expected[0].eventDescription)
+
+    def test_jsonl_gzip(self):
+        response = self.client.get('/app/export_logs/', {'format': 'jsonl', 'thing_type': 'p', 'gzip': '1'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(len(lines), 30)
+        self.assertEqual(json.loads(lines[0])['username'], 'bill')
+
+    def test_chunked_queries(self):
+        with self.assertNumQueries(4):
+            entries = list(iter_log_entries(LogEntry.objects.all(), chunk_size=10))
+        self.assertEqual(len(entries), 30)
+
+    def test_admin_only(self):
+        make_user("patty", 'Patients')
+        self.client.login(username="patty", password="pw")
+        self.assertEqual(self.client.get('/app/export_logs/').status_code, 302)
+
+
+class testAppointmentConflicts(TestCase):
+    def setUp(self):
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.doctors = [make_staff(Doctor, "doc%d" % i, self.hosp) for i in range(2)]
+        self.patients = [make_patient("pat%d" % i, self.hosp) for i in range(3)]
+        self.rng = random.Random(7)
+        self.day = datetime.datetime(2030, 3, 4, tzinfo=datetime.timezone.utc)
+        for i in range(40):
+            self.random_appointment().save()
+
+    def random_appointment(self):
+        # 13:00-23:00 UTC is within 08:00-18:00 in America/New_York
+        start = self.day + datetime.timedelta(days=self.rng.randrange(2), hours=13,
+                                              minutes=15 * self.rng.randrange(36))
+        return Appointment(start=start,
+                           end=start + datetime.timedelta(minutes=self.rng.choice((15, 30, 45, 60))),
+                           doctor=self.rng.choice(self.doctors), hospital=self.hosp,
+                           patient=self.rng.choice(self.patients))
+
+    def brute_force(self, appt):
+        return [other for other in Appointment.objects.order_by('start', 'id')
+                if other.pk != appt.pk and appt.conflicts(other)]
+
+    def test_matches_conflicts(self):
+        candidates = [self.random_appointment() for _ in range(60)] + list(Appointment.objects.all())
+        found = 0
+        for appt in candidates:
+            expected = self.brute_force(appt)
+            with self.assertNumQueries(1):
+                conflict = appt.anyconflicts()
+            self.assertEqual(conflict, expected[0] if expected else False)
+            found += bool(expected)
+        # make sure both outcomes were exercised
+        self.assertTrue(0 < found < len(candidates))
+
+    def test_touching_appointments_conflict(self):
+        appt = Appointment.objects.first()
+        after = Appointment(start=appt.end, end=appt.end + datetime.timedelta(minutes=15),
+                            doctor=appt.doctor, hospital=self.hosp, patient=self.patients[0])
+        self.assertEqual(after.anyconflicts() is not False, appt.conflicts(after))
+        self.assertNotEqual(after.anyconflicts(), False)
+
+
+class testFreeSlots(TestCase):
+    def setUp(self):
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.doctors = [make_staff(Doctor, "doc%d" % i, self.hosp) for i in range(2)]
+        self.patient = make_patient("pat", self.hosp)
+        self.other = make_patient("other", self.hosp)
+        make_user("pat", "Patients")
+        self.tz = timezone.get_default_timezone()
+        self.day = datetime.date(2030, 3, 4)
+        rng = random.Random(11)
+        for i in range(30):
+            start = self.at(self.day + datetime.timedelta(days=rng.randrange(2)), 8) + \
+                datetime.timedelta(minutes=15 * rng.randrange(40))
+            appt = Appointment(start=start, end=start + datetime.timedelta(minutes=rng.choice(DURATIONS)),
+                               doctor=rng.choice(self.doctors), hospital=self.hosp,
+                               patient=rng.choice((self.patient, self.other, self.other)))
+            if appt.time_errors() is None:
+                appt.save()
+
+    def at(self, day, hour, minute=0):
+        return timezone.make_aware(datetime.datetime.combine(day, datetime.time(hour, minute)), self.tz)
+
+    def get_slots(self, **params):
+        self.client.login(username="pat", password="pw")
+        response = self.client.get('/freeslots/', params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())['slots']
+
+    def test_merge_bookings(self):
+        d = self.day
+        bookings = [(self.at(d, 8), self.at(d, 9)), (self.at(d, 8, 30), self.at(d, 8, 45)),
+                    (self.at(d, 9), self.at(d, 9, 15)), (self.at(d, 10), self.at(d, 11))]
+        self.assertEqual(merge_bookings(bookings), [(self.at(d, 8), self.at(d, 9, 15)),
+                                                    (self.at(d, 10), self.at(d, 11))])
+
+    def test_free_slots_skip_touching_bookings(self):
+        d = self.day
+        blocks = [(self.at(d, 9), self.at(d, 17))]
+        slots = free_slots(blocks, d, 30, self.at(d, 0))
+        # 08:30-09:00 touches the booking and 17:00-17:30 starts as it ends
+        self.assertEqual(slots, [(self.at(d, 8), self.at(d, 8, 30)),
+                                 (self.at(d, 8, 15), self.at(d, 8, 45)),
+                                 (self.at(d, 17, 15), self.at(d, 17, 45)),
+                                 (self.at(d, 17, 30), self.at(d, 18))])
+
+    def test_slots_are_exactly_the_valid_appointments(self):
+        slots = self.get_slots(hospital=self.hosp.pk, start=self.day.isoformat(),
+                               end=(self.day + datetime.timedelta(days=1)).isoformat())
+        found = set((slot['doctor'], slot['start'], slot['duration']) for slot in slots)
+        expected = set()
+        for day in (self.day, self.day + datetime.timedelta(days=1)):
+            for doctor in self.doctors:
+                for quarter in range(40):
+                    start = self.at(day, 8) + datetime.timedelta(minutes=15 * quarter)
+                    for duration in DURATIONS:
+                        appt = Appointment(start=start, end=start + datetime.timedelta(minutes=duration),
+                                           doctor=doctor, hospital=self.hosp, patient=self.patient)
+                        if appt.time_errors() is None:
+                            expected.add((doctor.pk, start.isoformat(), duration))
+        self.assertTrue(expected)
+        self.assertEqual(found, expected)
+
+    def test_one_doctor_one_duration(self):
+        slots = self.get_slots(doctor=self.doctors[0].pk, start=self.day.isoformat(), duration=45)
+        self.assertTrue(slots)
+        self.assertTrue(all(slot['doctor'] == self.doctors[0].pk and slot['duration'] == 45
+                            for slot in slots))
+        self.assertEqual(slots, sorted(slots, key=lambda slot: slot['start']))
+
+    def test_needs_doctor_or_hospital(self):
+        self.client.login(username="pat", password="pw")
+        response = self.client.get('/freeslots/', {'start': self.day.isoformat()})
+        self.assertEqual(response.status_code, 400)
+
+    def test_nurse_only_sees_own_patients_bookings(self):
+        elsewhere = make_patient("elsewhere", Hospital.objects.create(name="elsewhere"))
+        make_staff(Nurse, "nurse", self.hosp)
+        make_user("nurse", "Nurses")
+        self.client.login(username="nurse", password="pw")
+        params = {'hospital': self.hosp.pk, 'start': self.day.isoformat()}
+        self.assertEqual(self.client.get('/freeslots/', dict(params, patient=self.patient.pk)).status_code, 200)
+        response = self.client.get('/freeslots/', dict(params, patient=elsewhere.pk))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('patient', json.loads(response.content.decode())['errors'])
+
+    def test_superuser_without_person(self):
+        User.objects.create_superuser("root", "", "pw")
+        self.client.login(username="root", password="pw")
+        params = {'hospital': self.hosp.pk, 'start': self.day.isoformat()}
+        self.assertEqual(self.client.get('/freeslots/', params).status_code, 200)
+        self.assertEqual(self.client.get('/freeslots/', dict(params, patient=self.patient.pk)).status_code, 200)
+
+
+
+class testCalendarEvents(TestCase):
+    def setUp(self):
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.doctor = make_staff(Doctor, "doc", self.hosp)
+        make_user("doc", "Doctors")
+        self.patients = [make_patient("pat%d" % i, self.hosp) for i in range(2)]
+        make_user("pat0", "Patients")
+        # one appointment a day in March and April 2030, 14:00 UTC
+        first = datetime.datetime(2030, 3, 1, 14, tzinfo=datetime.timezone.utc)
+        Appointment.objects.bulk_create(
+            Appointment(start=first + datetime.timedelta(days=i),
+                        end=first + datetime.timedelta(days=i, minutes=30),
+                        doctor=self.doctor, hospital=self.hosp, patient=self.patients[i % 2])
+            for i in range(61))
+
+    def get_events(self, username, start, end):
+        self.client.login(username=username, password="pw")
+        response = self.client.get('/calendar/events/', {'start': start, 'end': end})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b''.join(response.streaming_content).decode())
+
+    def test_window(self):
+        events = self.get_events("doc", "2030-03-10", "2030-03-17")
+        self.assertEqual(len(events), 7)
+        self.assertEqual(events[0]['title'], "doc; pat1")
+        self.assertTrue(events[0]['start'].startswith("2030-03-10"))
+        self.assertEqual(self.get_events("doc", "2031-01-01", "2031-02-01"), [])
+
+    def test_patient_sees_own_appointments(self):
+        events = self.get_events("pat0", "2030-03-01", "2030-03-31")
+        self.assertEqual(len(events), 15)
+        self.assertContains(self.client.get('/calendar/'), '/calendar/events/')
+        self.assertTrue(all(event['title'] == "doc" for event in events))
+
+    def test_query_count_does_not_grow_with_events(self):
+        self.client.login(username="doc", password="pw")
+        counts = []
+        for end in ("2030-03-03", "2030-04-30"):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get('/calendar/events/', {'start': "2030-03-01", 'end': end})
+                b''.join(response.streaming_content)
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_bad_window(self):
+        self.client.login(username="doc", password="pw")
+        for params in ({}, {'start': "2030-03-01"}, {'start': "2030-03-01", 'end': "2030-02-01"},
+                       {'start': "2030-01-01", 'end': "2031-01-01"}, {'start': "soon", 'end': "later"}):
+            self.assertEqual(self.client.get('/calendar/events/', params).status_code, 400)
+
+
+class testPatientSearch(TestCase):
+    def setUp(self):
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.other_hosp = Hospital.objects.create(name="otherHosp")
+        make_staff(Doctor, "doc", self.hosp)
+        make_user("doc", "Doctors")
+        make_staff(Nurse, "nurse", self.hosp)
+        make_user("nurse", "Nurses")
+        make_patient("amason", self.hosp, name="Alice Mason")
+        make_patient("bmalice", self.hosp, name="Bob Malice")
+        make_patient("zed", self.other_hosp, name="Zed Alistair")
+        for i in range(30):
+            make_patient("filler%02d" % i, self.hosp, name="Filler %02d" % i)
+
+    def search(self, username, **params):
+        self.client.login(username=username, password="pw")
+        response = self.client.get('/searchpatients/', params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def names(self, data):
+        return [row['name'] for row in data['results']]
+
+    def test_prefix(self):
+        self.assertEqual(self.names(self.search("doc", q="ali")), ["Alice Mason"])
+        self.assertEqual(self.names(self.search("doc", q="bmal")), ["Bob Malice"])
+        self.assertEqual(self.names(self.search("doc", q="ZED")), ["Zed Alistair"])
+
+    def test_contains(self):
+        self.assertEqual(self.names(self.search("doc", q="ali", match="contains")),
+                         ["Alice Mason", "Bob Malice", "Zed Alistair"])
+
+    def test_nurse_sees_own_hospital(self):
+        self.assertEqual(self.names(self.search("nurse", q="ali", match="contains")),
+                         ["Alice Mason", "Bob Malice"])
+
+    def test_pages(self):
+        first = self.search("doc", q="filler")
+        second = self.search("doc", q="filler", page=2)
+        self.assertTrue(first['has_next'])
+        self.assertFalse(second['has_next'])
+        self.assertEqual(self.names(first) + self.names(second), ["Filler %02d" % i for i in range(30)])
+
+    def test_search_name_follows_name(self):
+        patient = Patient.objects.get(username="zed")
+        patient.name = "Zachary Alistair"
+        patient.save()
+        self.assertEqual(self.names(self.search("doc", q="zach")), ["Zachary Alistair"])
+
+    def test_prefix_search_uses_index(self):
+        sql, params = Person.search(Person.objects.all(), "ali").query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            steps = [str(row[-1]) for row in cursor.fetchall() if 'HealthNetApp_person' in str(row[-1])]
+        self.assertTrue(steps)
+        self.assertTrue(all('USING INDEX' in step for step in steps), steps)
+
+    def test_list_page_renders_first_page(self):
+        self.client.login(username="doc", password="pw")
+        response = self.client.get('/listpatients/')
+        self.assertContains(response, "Alice Mason")
+        self.assertEqual(len(response.context['patients']), 25)
+        self.assertTrue(response.context['has_next'])
+
+
+class testLookup(TestCase):
+    def setUp(self):
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.other_hosp = Hospital.objects.create(name="otherHosp")
+        self.doctor = make_staff(Doctor, "doc", self.hosp, name="Doctor Who")
+        make_user("doc", "Doctors")
+        make_staff(Nurse, "nurse", self.hosp)
+        make_user("nurse", "Nurses")
+        self.patient = make_patient("pat", self.hosp, name="Pat Here")
+        make_user("pat", "Patients")
+        self.far_patient = make_patient("far", self.other_hosp, name="Pat Elsewhere")
+        for i in range(30):
+            make_patient("many%02d" % i, self.hosp, name="Pat Many %02d" % i)
+
+    def lookup(self, username, kind, q):
+        self.client.login(username=username, password="pw")
+        return self.client.get('/lookup/%s/' % kind, {'q': q})
+
+    def test_top_matches(self):
+        results = json.loads(self.lookup("doc", "patients", "pat").content.decode())['results']
+        self.assertEqual(len(results), 20)
+        self.assertEqual(results[0], {'pk': self.far_patient.pk, 'name': "Pat Elsewhere"})
+
+    def test_scoped_to_caller(self):
+        names = [r['name'] for r in json.loads(self.lookup("nurse", "patients", "elsewhere").content.decode())['results']]
+        self.assertEqual(names, [])
+        self.assertEqual(self.lookup("pat", "patients", "pat").status_code, 403)
+        names = [r['name'] for r in json.loads(self.lookup("pat", "doctors", "doc").content.decode())['results']]
+        self.assertEqual(names, ["Doctor Who"])
+
+    def test_form_renders_only_selected_option(self):
+        self.client.login(username="pat", password="pw")
+        html = self.client.get('/sendmessage/').content.decode()
+        self.assertIn('data-lookup-url="/lookup/people/"', html)
+        self.assertNotIn("Pat Many", html)
+        form = MessageForm(initial={'destination': self.doctor})
+        html = str(form['destination'])
+        self.assertIn('<option value="%d" selected="selected">Doctor Who</option>' % self.doctor.pk, html)
+        self.assertEqual(html.count('<option'), 1)
+
+    def test_only_lookup_fields_load_remotely(self):
+        self.client.login(username="doc", password="pw")
+        html = self.client.get('/createappointment/').content.decode()
+        self.assertIn('remoteChosen("#id_patient")', html)
+        self.assertNotIn('remoteChosen("#id_doctor")', html)
+        self.assertIn('$("#id_doctor").chosen()', html)
+
+    def test_submitted_pk_is_validated(self):
+        data = {'hospital': self.hosp.pk, 'doctor': self.doctor.pk, 'date': '2030-03-04',
+                'start_time': '10:00', 'end_time': '10:30'}
+        form = DoctorAppointmentForm(dict(data, patient=self.far_patient.pk),
+                                     patient_list=Nurse.objects.get(username="nurse").list_patients())
+        self.assertIn('patient', form.errors)
+        form = DoctorAppointmentForm(dict(data, patient=self.patient.pk),
+                                     patient_list=Nurse.objects.get(username="nurse").list_patients())
+        self.assertTrue(form.is_valid(), form.errors)
+
+
+class testUnreadCounter(TransactionTestCase):
+    # a TransactionTestCase, so that the cache is invalidated on commit as in production
+    def setUp(self):
+        cache.clear()
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.doctor = make_staff(Doctor, "doc", self.hosp)
+        make_user("doc", "Doctors")
+        self.patient = make_patient("pat", self.hosp)
+        make_user("pat", "Patients")
+
+    def unread(self):
+        return Person.objects.get(pk=self.patient.pk).unread_messages
+
+    def test_send_and_read(self):
+        self.assertEqual(unread_count("pat"), 0)
+        messages = [inbox.send_message(self.doctor, self.patient, "hi", "body") for i in range(3)]
+        self.assertEqual(self.unread(), 3)
+        self.assertEqual(unread_count("pat"), 3)
+        self.assertTrue(inbox.mark_read(messages[0]))
+        self.assertFalse(inbox.mark_read(Message.objects.get(pk=messages[0].pk)))
+        self.assertEqual(self.unread(), 2)
+        self.assertEqual(unread_count("pat"), 2)
+
+    def test_views_update_counter(self):
+        self.client.login(username="doc", password="pw")
+        self.client.post('/sendmessage/', {'destination': self.patient.pk, 'subject': "s", 'body': "b"})
+        self.assertEqual(self.unread(), 1)
+        self.client.login(username="pat", password="pw")
+        self.client.get('/viewmessage/%d/' % Message.objects.get().pk)
+        self.assertEqual(self.unread(), 0)
+
+    def test_nav_badge_is_free_when_cached(self):
+        inbox.send_message(self.doctor, self.patient, "hi", "body")
+        user = User.objects.get(username="pat")
+        template = Template('{% load utils_extras %}{% if user|new_message %}{{ user|new_message }}{% endif %}')
+        self.assertEqual(template.render(Context({'user': user})), '1')
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(Context({'user': user})), '1')
+
+    def test_reconcile(self):
+        inbox.send_message(self.doctor, self.patient, "hi", "body")
+        unread_count("pat")
+        # drift: a message read behind the counter's back, and a bad count
+        Message.objects.update(read=True)
+        Person.objects.filter(pk=self.doctor.pk).update(unread_messages=4)
+        out = StringIO()
+        call_command('reconcile_unread_counts', stdout=out)
+        self.assertIn('fixed 2 unread message counters', out.getvalue())
+        self.assertEqual(self.unread(), 0)
+        self.assertEqual(unread_count("pat"), 0)
+        self.assertEqual(unread_count("doc"), 0)
+
+
+class testMessageEvents(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.doctor = make_staff(Doctor, "doc", self.hosp, name="Dr. Doc")
+        self.patient = make_patient("pat", self.hosp)
+        make_user("pat", "Patients")
+
+    def test_hub(self):
+        hub = Hub()
+        first, second = hub.subscribe(1), hub.subscribe(1)
+        other = hub.subscribe(2)
+        self.assertEqual(hub.publish(1, 'unread', {'count': 3}), 2)
+        self.assertEqual(first.get(0), ('unread', {'count': 3}))
+        self.assertEqual(second.get(0), ('unread', {'count': 3}))
+        self.assertIsNone(other.get(0))
+        first.close()
+        second.close()
+        self.assertFalse(hub.has_subscribers(1))
+        self.assertEqual(hub.publish(1, 'unread', {'count': 4}), 0)
+
+    def test_send_and_read_publish(self):
+        subscription = notifications.hub.subscribe(self.patient.pk)
+        try:
+            message = inbox.send_message(self.doctor, self.patient, "Results", "are in")
+            event, header = subscription.get(0)
+            self.assertEqual((event, header['subject'], header['source'], header['pk']),
+                             ('message', "Results", "Dr. Doc", message.pk))
+            self.assertEqual(subscription.get(0), ('unread', {'count': 1}))
+            inbox.mark_read(message)
+            self.assertEqual(subscription.get(0), ('unread', {'count': 0}))
+            self.assertIsNone(subscription.get(0))
+        finally:
+            subscription.close()
+
+    def test_broadcast_publishes(self):
+        other = make_patient("other", self.hosp)
+        subscription = notifications.hub.subscribe(self.patient.pk)
+        try:
+            inbox.broadcast(self.doctor, Person.objects.filter(pk__in=[self.patient.pk, other.pk]), "Closed", "today")
+            event, header = subscription.get(0)
+            message = Message.objects.get(destination=self.patient)
+            self.assertEqual((event, header['subject'], header['source'], header['pk']),
+                             ('message', "Closed", "Dr. Doc", message.pk))
+            self.assertEqual(subscription.get(0), ('unread', {'count': 1}))
+            self.assertIsNone(subscription.get(0))
+        finally:
+            subscription.close()
+
+    def test_stream(self):
+        self.client.login(username="pat", password="pw")
+        response = self.client.get('/messageevents/')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = iter(response.streaming_content)
+        self.assertIn(b'event: unread\ndata: {"count": 0}\n\n', next(stream))
+        self.assertTrue(notifications.hub.has_subscribers(self.patient.pk))
+        inbox.send_message(self.doctor, self.patient, "Hello", "there")
+        self.assertTrue(next(stream).startswith(b'event: message\ndata: '))
+        self.assertEqual(next(stream), b'event: unread\ndata: {"count": 1}\n\n')
+        response.close()
+        self.assertFalse(notifications.hub.has_subscribers(self.patient.pk))
+
+    def test_unread_stream_does_not_subscribe(self):
+        self.client.login(username="pat", password="pw")
+        response = self.client.get('/messageevents/')
+        self.assertFalse(notifications.hub.has_subscribers(self.patient.pk))
+        response.close()
+        self.assertFalse(notifications.hub.has_subscribers(self.patient.pk))
+
+    def test_only_inbox_pages_open_stream(self):
+        self.client.login(username="pat", password="pw")
+        self.assertContains(self.client.get('/listmessages/'), 'new EventSource')
+        self.assertNotContains(self.client.get('/', follow=True), 'new EventSource')
+
+
+class testConversations(TestCase):
+    def setUp(self):
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.doctor = make_staff(Doctor, "doc", self.hosp)
+        make_user("doc", "Doctors")
+        self.patient = make_patient("pat", self.hosp)
+        make_user("pat", "Patients")
+        self.stranger = make_patient("stranger", self.hosp)
+        make_user("stranger", "Patients")
+
+    def test_thread_subject(self):
+        self.assertEqual(Conversation.thread_subject("Re: RE:re: Results "), "Results")
+        self.assertEqual(Conversation.thread_subject("Results: re: them"), "Results: re: them")
+
+    def test_replies_share_a_conversation(self):
+        first = inbox.send_message(self.doctor, self.patient, "Results", "in")
+        self.client.login(username="pat", password="pw")
+        response = self.client.get('/reply/%d/' % first.pk)
+        self.assertEqual(response.context['form']['subject'].value(), "Re: Results")
+        self.client.post('/reply/%d/' % first.pk, {'destination': self.doctor.pk, 'subject': "Re: Results",
+                                                    'body': "thanks"})
+        reply = Message.objects.latest('id')
+        self.assertEqual(reply.conversation_id, first.conversation_id)
+        # a new message with the same subject joins the thread too
+        self.assertEqual(inbox.send_message(self.doctor, self.patient, "Results", "again").conversation_id,
+                         first.conversation_id)
+        self.assertNotEqual(inbox.send_message(self.doctor, self.patient, "Other", "x").conversation_id,
+                            first.conversation_id)
+
+    def test_reply_fetches_parent_once(self):
+        first = inbox.send_message(self.doctor, self.patient, "Results", "in")
+        self.client.login(username="pat", password="pw")
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/reply/%d/' % first.pk)
+        self.assertEqual(len([q for q in ctx.captured_queries if 'FROM "HealthNetApp_message"' in q['sql']]), 1)
+        self.client.login(username="stranger", password="pw")
+        self.assertEqual(self.client.get('/reply/%d/' % first.pk).status_code, 404)
+
+    def test_thread_pages(self):
+        start = timezone.now()
+        conversation = inbox.send_message(self.doctor, self.patient, "Long", "0").conversation
+        for i in range(1, 45):
+            Message.objects.create(source=self.patient if i % 2 else self.doctor,
+                                   destination=self.doctor if i % 2 else self.patient, subject="Re: Long",
+                                   body=str(i), date=start + datetime.timedelta(minutes=i),
+                                   conversation=conversation)
+        self.client.login(username="doc", password="pw")
+        bodies, cursor = [], None
+        while True:
+            data = json.loads(self.client.get('/conversation/%d/' % conversation.pk,
+                                              {'cursor': cursor} if cursor else {}).content.decode())
+            bodies += [m['body'] for m in data['messages']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(bodies, [str(i) for i in range(44, -1, -1)])
+        self.client.login(username="stranger", password="pw")
+        self.assertEqual(self.client.get('/conversation/%d/' % conversation.pk).status_code, 404)
+
+    def test_thread_query_uses_index(self):
+        sql, params = Message.objects.filter(conversation_id=1).select_related('source') \
+            .order_by('-date', '-id')[:21].query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [str(row[-1]) for row in cursor.fetchall()]
+        self.assertTrue(any('HealthNetApp_message USING INDEX' in step and 'conversation_id=?' in step
+                            for step in plan), plan)
+        self.assertFalse(any('TEMP B-TREE' in step for step in plan), plan)
+
+    def test_migration_backfill(self):
+        from importlib import import_module
+        from django.apps import apps
+        migration = import_module('HealthNetApp.migrations.0008_conversation')
+        now = timezone.now()
+        for i, (source, destination, subject) in enumerate([
+                (self.doctor, self.patient, "Results"), (self.patient, self.doctor, "Re: Results"),
+                (self.doctor, self.patient, "Other"), (self.stranger, self.doctor, "Results")]):
+            Message.objects.create(source=source, destination=destination, subject=subject, body="",
+                                   date=now + datetime.timedelta(minutes=i))
+        migration.thread_messages(apps, None)
+        threads = list(Message.objects.order_by('date').values_list('conversation_id', flat=True))
+        self.assertEqual(threads[0], threads[1])
+        self.assertEqual(len(set(threads)), 3)
+
+
+class testBroadcast(TestCase):
+    def setUp(self):
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.other_hosp = Hospital.objects.create(name="otherHosp")
+        self.admin = Administrator.objects.create(name="admin", date_of_birth="1985-01-01",
+                                                  contact_information="", username="admin")
+        make_user("admin", is_superuser=True)
+        self.nurse = make_staff(Nurse, "nurse", self.hosp)
+        make_user("nurse", "Nurses")
+        self.staff = [make_staff(Doctor, "doc%d" % i, self.hosp) for i in range(3)] + [self.nurse]
+        make_staff(Doctor, "elsewhere", self.other_hosp)
+        self.patients = [make_patient("pat%03d" % i, self.hosp) for i in range(300)]
+        self.patients.append(make_patient("admitted", self.other_hosp, admitted_to=self.hosp))
+        make_patient("outsider", self.other_hosp)
+
+    def test_audiences(self):
+        self.assertEqual(set(self.hosp.staff()), set(MedicalProfessional.objects.filter(pk__in=[s.pk for s in self.staff])))
+        self.assertEqual(set(p.pk for p in self.hosp.patients()), set(p.pk for p in self.patients))
+
+    def test_broadcast_to_patients(self):
+        with CaptureQueriesContext(connection) as ctx:
+            sent = inbox.broadcast(self.admin, self.hosp.patients(), "Flu shots", "Come get one", batch_size=200)
+        self.assertEqual(sent, 301)
+        # the recipient query, then an INSERT per SQLite-sized chunk and a MAX(pk) and an UPDATE per batch
+        self.assertLessEqual(len(ctx.captured_queries), 13)
+        self.assertEqual(Message.objects.filter(subject="Flu shots").count(), 301)
+        self.assertEqual(set(Person.objects.filter(unread_messages=1).values_list('pk', flat=True)),
+                         set(p.pk for p in self.patients))
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT rowid FROM "{}" WHERE rowid >= %s'.format(search.TABLE),
+                           [search.rowid(search.MESSAGE, 0)])
+            indexed = set(search.split_rowid(row[0])[1] for row in cursor.fetchall())
+        self.assertEqual(indexed, set(Message.objects.filter(subject="Flu shots").values_list('pk', flat=True)))
+
+    def test_view_logs_once(self):
+        self.client.login(username="nurse", password="pw")
+        before = LogEntry.objects.count()
+        response = self.client.post('/broadcast/', {'hospital': self.hosp.pk, 'audience': 'staff',
+                                                    'subject': "Meeting", 'body': "at noon"})
+        self.assertEqual(response.context['sent'], 3)  # everyone but the sender
+        self.assertEqual(LogEntry.objects.count(), before + 1)
+        self.assertIn("broadcast to 3 staff of testHosp", LogEntry.objects.latest('id').eventDescription)
+        # nurses can only broadcast to their own hospital
+        response = self.client.post('/broadcast/', {'hospital': self.other_hosp.pk, 'audience': 'staff',
+                                                    'subject': "Meeting", 'body': "at noon"})
+        self.assertIn('hospital', response.context['form'].errors)
+
+
+class testStatisticsCache(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.doctor = make_staff(Doctor, "doc", self.hosp)
+        self.patient = make_patient("pat", self.hosp)
+        make_user("admin", is_superuser=True)
+        self.client.login(username="admin", password="pw")
+        start = datetime.datetime(2030, 3, 4, 14, tzinfo=datetime.timezone.utc)
+        self.appointment = Appointment.objects.create(start=start, end=start + datetime.timedelta(minutes=30),
+                                                      doctor=self.doctor, hospital=self.hosp, patient=self.patient)
+
+    def stat_queries(self, metric):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/viewstatistics/', {'metric': metric, 'start': '2030-03-01',
+                                                           'end': '2030-03-31'})
+        return response, [q for q in ctx.captured_queries if 'HealthNetApp_appointment' in q['sql']
+                          or 'HealthNetApp_prescription' in q['sql']]
+
+    def test_repeat_views_are_cached(self):
+        response, queries = self.stat_queries('PatientAppointments')
+        self.assertTrue(queries)
+        self.assertEqual(list(response.context['elements']), [('pat', 1)])
+        response, queries = self.stat_queries('PatientAppointments')
+        self.assertEqual(queries, [])
+        self.assertEqual(list(response.context['elements']), [('pat', 1)])
+        counters = json.loads(self.client.get('/statistics_cache/').content.decode())
+        self.assertEqual((counters['hits'], counters['misses']), (1, 1))
+
+    def test_same_range_is_one_entry(self):
+        self.stat_queries('staylength')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/viewstatistics/', {'metric': 'staylength', 'start': '03/01/2030', 'end': '2030-03-31'})
+        self.assertFalse(any('HealthNetApp_appointment' in q['sql'] for q in ctx.captured_queries))
+
+    def test_writes_invalidate(self):
+        self.stat_queries('AppointmentAverages')
+        self.stat_queries('prescriptions')
+        self.appointment.end += datetime.timedelta(minutes=30)
+        self.appointment.save()
+        response, queries = self.stat_queries('AppointmentAverages')
+        self.assertTrue(queries)
+        self.assertEqual(response.context['length'], '60.0 Minutes')
+        # prescriptions did not change
+        self.assertEqual(self.stat_queries('prescriptions')[1], [])
+        self.appointment.delete()
+        response, queries = self.stat_queries('AppointmentAverages')
+        self.assertEqual(response.context['length'], '0 Minutes')
+
+    def test_admission_events_invalidate(self):
+        generation = statistics.statsGeneration('admissions')
+        log_event(self.patient.username, 'u', 'p', self.patient.pk, 'admitted_to', 'admitted')
+        self.assertEqual(statistics.statsGeneration('admissions'), generation)
+        admissions.change_admission(self.patient, self.hosp, 'scheduled checkup')
+        self.assertEqual(statistics.statsGeneration('admissions'), generation + 1)
+
+
+class testAppointmentLengthStats(TestCase):
+    '''
+    The appointment length statistics are computed in SQL; they must give
+    the same results as the old implementations, which did it in Python.
+    '''
+
+    @staticmethod
+    def legacy_patient_lengths(start, end):
+        appointments = statistics.getAppointments(start, end).values_list('patient__name', 'end', 'start') \
+            .order_by('patient__name')
+        lengths = []
+        for patient, appt in itertools.groupby(appointments, lambda x: x[0]):
+            durations = [(a[1] - a[2]).seconds / 60 for a in appt]
+            lengths.append([patient, str(int(sum(durations) / len(durations))) + ' Minutes'])
+        return lengths
+
+    @staticmethod
+    def legacy_hospital_length(start, end):
+        durations = [(e - s).seconds / 60 for e, s in statistics.getAppointments(start, end).values_list('end', 'start')]
+        if durations:
+            return str(math.fsum(durations) / len(durations)) + ' Minutes'
+        return '0 Minutes'
+
+    def setUp(self):
+        hosp = Hospital.objects.create(name="testHosp")
+        doctor = make_staff(Doctor, "doc", hosp)
+        # two patients share a name, and are reported together
+        patients = [make_patient("pat%d" % i, hosp, name="Pat %d" % (i % 5)) for i in range(6)]
+        rng = random.Random(17)
+        day = datetime.datetime(2030, 3, 1, 13, tzinfo=datetime.timezone.utc)
+        for i in range(200):
+            start = day + datetime.timedelta(days=rng.randrange(60), minutes=15 * rng.randrange(16))
+            length = datetime.timedelta(minutes=rng.choice((15, 30, 45, 60, 7, 13)))
+            Appointment.objects.create(start=start, end=start + length, doctor=doctor, hospital=hosp,
+                                       patient=rng.choice(patients))
+
+    def test_same_results(self):
+        day = datetime.date(2030, 3, 1)
+        for days in (1, 7, 30, 61):
+            start, end = day + datetime.timedelta(days=days // 2), day + datetime.timedelta(days=days)
+            self.assertEqual(statistics.patientAppointmentLengthStats(start, end),
+                             self.legacy_patient_lengths(start, end))
+            self.assertEqual(statistics.hospitalAppointmentLengthStats(start, end),
+                             self.legacy_hospital_length(start, end))
+
+    def test_no_appointments(self):
+        start, end = datetime.date(2031, 1, 1), datetime.date(2031, 2, 1)
+        self.assertEqual(statistics.patientAppointmentLengthStats(start, end), [])
+        self.assertEqual(statistics.hospitalAppointmentLengthStats(start, end), '0 Minutes')
+
+    def test_one_query_each(self):
+        with self.assertNumQueries(1):
+            statistics.patientAppointmentLengthStats(datetime.date(2030, 3, 1), datetime.date(2030, 5, 1))
+        with self.assertNumQueries(1):
+            statistics.hospitalAppointmentLengthStats(datetime.date(2030, 3, 1), datetime.date(2030, 5, 1))
+
+
+class testAppointmentRollup(TestCase):
+    def setUp(self):
+        self.hosp = Hospital.objects.create(name="testHosp")
+        self.doctor = make_staff(Doctor, "doc", self.hosp)
+        self.patient = make_patient("pat", self.hosp)
+        self.day = datetime.datetime(2030, 3, 4, 14, tzinfo=datetime.timezone.utc)
+
+    def book(self, start, minutes, patient=None):
+        return Appointment.objects.create(start=start, end=start + datetime.timedelta(minutes=minutes),
+                                          doctor=self.doctor, hospital=self.hosp, patient=patient or self.patient)
+
+    def rollup(self):
+        return sorted(AppointmentRollup.objects.values_list('day', 'patient__username', 'count', 'minutes'))
+
+    def test_incremental(self):
+        first = self.book(self.day, 30)
+        self.book(self.day + datetime.timedelta(hours=1), 15)
+        self.assertEqual(self.rollup(), [(datetime.date(2030, 3, 4), 'pat', 2, 45)])
+        # longer
+        first.end += datetime.timedelta(minutes=30)
+        first.save()
+        self.assertEqual(self.rollup(), [(datetime.date(2030, 3, 4), 'pat', 2, 75)])
+        # moved to another day
+        first.start += datetime.timedelta(days=1)
+        first.end += datetime.timedelta(days=1)
+        first.save()
+        self.assertEqual(self.rollup(), [(datetime.date(2030, 3, 4), 'pat', 1, 15),
+                                         (datetime.date(2030, 3, 5), 'pat', 1, 60)])
+        # cancelled; the emptied row goes away
+        first.delete()
+        self.assertEqual(self.rollup(), [(datetime.date(2030, 3, 4), 'pat', 1, 15)])
+
+    def test_local_day(self):
+        # 01:00 UTC is still the previous day in New York
+        self.book(datetime.datetime(2030, 3, 5, 1, tzinfo=datetime.timezone.utc), 15)
+        self.assertEqual(self.rollup(), [(datetime.date(2030, 3, 4), 'pat', 1, 15)])
+
+    def test_rebuild(self):
+        other = make_patient("other", self.hosp)
+        for i in range(5):
+            self.book(self.day + datetime.timedelta(days=i % 3, hours=i), 15 * (i % 4 + 1),
+                      patient=other if i % 2 else None)
+        incremental = self.rollup()
+        AppointmentRollup.objects.all().delete()
+        call_command('rebuild_appointment_rollup', '--chunk-size', '2', stdout=StringIO())
+        self.assertEqual(self.rollup(), incremental)
+        # rebuilding some days leaves the others alone
+        AppointmentRollup.objects.update(count=0)
+        call_command('rebuild_appointment_rollup', '--start', '2030-03-05', '--end', '2030-03-05', stdout=StringIO())
+        self.assertEqual([row for row in self.rollup() if row[2]],
+                         [row for row in incremental if row[0] == datetime.date(2030, 3, 5)])
+
+    def test_statistics_read_rollup(self):
+        self.book(self.day, 30)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(list(statistics.patientAppointmentStats(datetime.date(2020, 1, 1),
+                                                                     datetime.date(2040, 1, 1))), [('pat', 1)])
+            self.assertEqual(statistics.hospitalAppointmentStats(datetime.date(2020, 1, 1),
+                                                                 datetime.date(2040, 1, 1)), 1)
+        self.assertFalse(any('"HealthNetApp_appointment"' in q['sql'] for q in ctx.captured_queries))
+
+
+class testAppointmentDistributions(TestCase):
+    def setUp(self):
+        self.north = Hospital.objects.create(name="North")
+        self.south = Hospital.objects.create(name="South")
+        self.doctor = make_staff(Doctor, "doc", self.north)
+        self.patient = make_patient("pat", self.north)
+        make_user("admin", is_superuser=True)
+        self.client.login(username="admin", password="pw")
+
+    def book(self, hospital, start, minutes):
+        start = timezone.make_aware(start, timezone.get_default_timezone())
+        Appointment.objects.create(start=start, end=start + datetime.timedelta(minutes=minutes),
+                                   doctor=self.doctor, hospital=hospital, patient=self.patient)
+
+    def test_distributions(self):
+        lengths = [15, 30, 30, 45, 60, 60, 60, 15, 30, 45]
+        for i, minutes in enumerate(lengths):
+            # Monday 2030-03-04 (EST) and Monday 2030-03-11 (EDT), 09:00 local time
+            self.book(self.north if i < 7 else self.south,
+                      datetime.datetime(2030, 3, 4 + 7 * (i % 2), 9, 0), minutes)
+        self.book(self.south, datetime.datetime(2030, 3, 9, 17, 0), 15)
+        lengths.append(15)
+        stats = statistics.appointmentDistributions(datetime.date(2030, 3, 1), datetime.date(2030, 4, 1))
+        self.assertEqual(stats['count'], 11)
+        median, p90, p99 = numpy.percentile(lengths, [50, 90, 99])
+        self.assertEqual(stats['length'], {'median': median, 'p90': p90, 'p99': p99})
+        counts = stats['heatmap']['counts']
+        self.assertEqual(counts[0][9], 10)
+        self.assertEqual(counts[5][17], 1)
+        self.assertEqual(sum(map(sum, counts)), 11)
+        self.assertEqual(stats['histograms']['bins'], [0, 15, 30, 45, 60])
+        self.assertEqual(stats['histograms']['hospitals'], [
+            {'pk': self.north.pk, 'name': 'North', 'counts': [0, 1, 2, 1, 3]},
+            {'pk': self.south.pk, 'name': 'South', 'counts': [0, 2, 1, 1, 0]}])
+
+    def test_chunks(self):
+        for day in range(1, 8):
+            self.book(self.north, datetime.datetime(2030, 3, day, 10, 0), 15 * (day % 4 + 1))
+        hospitals, starts, minutes = statistics.appointmentArrays(datetime.date(2030, 3, 1),
+                                                                  datetime.date(2030, 4, 1), chunk_size=3)
+        self.assertEqual(sorted(minutes.tolist()), sorted(15.0 * (day % 4 + 1) for day in range(1, 8)))
+        self.assertEqual(set(hospitals.tolist()), {self.north.pk})
+
+    def test_empty(self):
+        stats = statistics.appointmentDistributions(datetime.date(2030, 3, 1), datetime.date(2030, 4, 1))
+        self.assertEqual(stats['count'], 0)
+        self.assertIsNone(stats['length'])
+        self.assertEqual(stats['histograms'], {'bins': [], 'hospitals': []})
+
+    def test_views(self):
+        self.book(self.north, datetime.datetime(2030, 3, 4, 9, 0), 30)
+        params = {'metric': 'AppointmentDistributions', 'start': '2030-03-01', 'end': '2030-04-01'}
+        response = self.client.get('/viewstatistics/', params)
+        self.assertContains(response, 'Median Length:</b> 30.0 Minutes')
+        params['format'] = 'json'
+        data = json.loads(self.client.get('/viewstatistics/', params).content.decode())
+        self.assertEqual(data['length']['p99'], 30.0)
+        self.assertEqual(data['heatmap']['counts'][0][9], 1)
+        params['start'] = 'nonsense'
+        self.assertEqual(self.client.get('/viewstatistics/', params).status_code, 400)
+
+
+class testAdmissionEvents(TestCase):
+    def setUp(self):
+        self.north = Hospital.objects.create(name="North")
+        self.south = Hospital.objects.create(name="South to East")
+        self.doctor = make_staff(Doctor, "doc", self.south)
+        make_user("doc", group="Doctors")
+        make_user("admin", is_superuser=True)
+        Administrator.objects.create(name="admin", date_of_birth="1985-01-01", contact_information="phone",
+                                     username="admin")
+        Group.objects.get_or_create(name="Patients")
+        self.patient = make_patient("pat", self.north)
+
+    def events(self):
+        return list(AdmissionEvent.objects.order_by('time', 'id').values_list(
+            'action', 'from_hospital__name', 'hospital__name', 'reason_code'))
+
+    def test_doctor_admits_transfers_discharges(self):
+        self.client.login(username="doc", password="pw")
+        url = '/admit_patient/{}/'.format(self.patient.pk)
+        self.client.post(url, {str(self.patient.pk): 'Admit to South to East', 'reason': 'emergency surgery'})
+        Patient.objects.filter(pk=self.patient.pk).update(admitted_to=self.north)
+        self.client.post(url, {str(self.patient.pk): 'Transfer'})
+        self.client.post(url, {str(self.patient.pk): 'Discharge'})
+        self.assertEqual(self.events(), [('a', None, 'South to East', 'emergency surgery'),
+                                         ('t', 'North', 'South to East', 'none'),
+                                         ('d', 'South to East', None, 'none')])
+        self.assertIsNone(Patient.objects.get(pk=self.patient.pk).admitted_to)
+
+    def test_admin_change_and_emergency_registration(self):
+        self.client.login(username="admin", password="pw")
+        self.client.post('/admit_patient/{}/'.format(self.patient.pk), {str(self.patient.pk): 'North'})
+        self.client.login(username="doc", password="pw")
+        self.client.post('/emergencyregistration/', {'username': 'walkin', 'password': 'secret'})
+        self.assertEqual(self.events(), [('a', None, 'North', 'none'), ('a', None, 'South to East', 'emergency')])
+
+    def test_statistics(self):
+        for i, reason in enumerate(['emergency surgery', 'scheduled checkup', 'emergency surgery', 'made up']):
+            patient = make_patient("p%d" % i, self.north)
+            admissions.change_admission(patient, self.north if i else self.south, reason)
+        admissions.change_admission(patient, self.south)
+        admissions.change_admission(patient, None)
+        start, end = datetime.date.today(), datetime.date.today() + datetime.timedelta(days=1)
+        self.assertEqual(statistics.hospitalAdmissionReasons(start, end),
+                         [['Emergency Surgery', 2], ['Other', 1], ['Scheduled Checkup', 1]])
+        self.assertEqual(statistics.hospitalAdmissionCounts(start, end), [('North', 3), ('South to East', 2)])
+        for queryset in (statistics.getAdmissions(start, end, 'a').values_list('reason_code').annotate(Count('id')),
+                         statistics.getAdmissions(start, end, 'a', 't').values_list('hospital').annotate(Count('id'))):
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+            self.assertIn('COVERING INDEX', plan)
+
+    def test_backfill(self):
+        other = make_patient("other", self.north, admitted_to=self.south)
+        person = Person.objects.get(username="pat")
+        descriptions = [
+            (self.patient, 'patient was admitted to North with reason "scheduled checkup"'),
+            (self.patient, 'the patient was transfered from North to South to East'),
+            (self.patient, 'the hospital the patient was addmitted to was changed'),
+            (self.patient, 'patient was admitted to North with reason "None"'),
+            (self.patient, 'the patient was discharged from North'),
+            (self.patient, 'something we cannot parse'),
+            (other, 'the hospital the patient was addmitted to was changed'),
+        ]
+        time = timezone.now() - datetime.timedelta(days=10)
+        for i, (patient, description) in enumerate(descriptions):
+            LogEntry.objects.create(user=person, time=time + datetime.timedelta(hours=i), action_type='u',
+                                    thing_type='p', thing_instance=patient.pk, thing_field='admitted_to',
+                                    eventDescription=description)
+        # recorded as it happened, so not backfilled
+        admissions.change_admission(other, None)
+        LogEntry.objects.create(user=person, time=timezone.now(), action_type='u', thing_type='p',
+                                thing_instance=other.pk, thing_field='admitted_to',
+                                eventDescription='the patient was discharged from South to East')
+        out = StringIO()
+        call_command('backfill_admission_events', stdout=out)
+        self.assertIn('created 6 admission events, skipped 1 log entries', out.getvalue())
+        self.assertEqual(self.events(), [
+            ('a', None, 'North', 'scheduled checkup'),
+            ('t', 'North', 'South to East', 'none'),
+            # the administrator discharged the patient: the next entry is an admission
+            ('d', 'South to East', None, 'none'),
+            ('a', None, 'North', 'none'),
+            ('d', 'North', None, 'none'),
+            # the next entry says the patient was at South to East
+            ('a', None, 'South to East', 'none'),
+            ('d', 'South to East', None, 'none'),
+        ])
+        call_command('backfill_admission_events', stdout=out)
+        self.assertEqual(AdmissionEvent.objects.count(), 7)
+
+
+class testCensus(TestCase):
+    def setUp(self):
+        self.north = Hospital.objects.create(name="North")
+        self.south = Hospital.objects.create(name="South")
+        self.patients = [make_patient("p%d" % i, self.north) for i in range(6)]
+        self.t0 = datetime.datetime(2030, 3, 4, 10, 0, tzinfo=datetime.timezone.utc)
+        rng = random.Random(22)
+        for i in range(60):
+            patient = rng.choice(self.patients)
+            hospital = rng.choice([self.north, self.south, None])
+            admissions.change_admission(patient, hospital, time=self.t0 + datetime.timedelta(minutes=37 * i))
+
+    def brute_force(self, time):
+        occupancy = {self.north.pk: 0, self.south.pk: 0}
+        for hospital, from_hospital in AdmissionEvent.objects.filter(time__lte=time).values_list(
+                'hospital_id', 'from_hospital_id'):
+            census.apply_change(occupancy, hospital, from_hospital)
+        return occupancy
+
+    def check_series(self, start, end):
+        hours, series = census.occupancy_series(start, end)
+        self.assertEqual(hours[0], census.floor_hour(start))
+        for i, hour in enumerate(hours):
+            expected = self.brute_force(hour + census.HOUR - datetime.timedelta(microseconds=1))
+            self.assertEqual(dict((pk, values[i]) for pk, values in series.items()), expected, hour)
+
+    def test_occupancy_at(self):
+        for minutes in (-5, 0, 1, 36, 37, 60, 61, 500, 1000, 2500, 5000):
+            time = self.t0 + datetime.timedelta(minutes=minutes)
+            self.assertEqual(census.occupancy_at(time), self.brute_force(time), minutes)
+
+    def test_series(self):
+        self.check_series(self.t0 - datetime.timedelta(hours=2), self.t0 + datetime.timedelta(hours=40))
+        self.check_series(self.t0 + datetime.timedelta(hours=13, minutes=20), self.t0 + datetime.timedelta(hours=15))
+
+    def test_incremental(self):
+        census.occupancy_at(self.t0)
+        self.assertEqual(census.extend(), 0)
+        later = self.t0 + datetime.timedelta(days=3)
+        admissions.change_admission(self.patients[0], self.south if self.patients[0].admitted_to != self.south
+                                    else self.north, time=later)
+        # only the new event is replayed
+        self.assertEqual(census.extend(), 1)
+        # an older event recorded late (e.g. by backfill_admission_events) is picked up too
+        patient = make_patient("late", self.north)
+        AdmissionEvent.objects.bulk_create([AdmissionEvent(patient=patient, hospital=self.south, action='a',
+                                                           time=self.t0 + datetime.timedelta(hours=30))])
+        self.check_series(self.t0, later)
+        # so are changed and deleted events
+        event = AdmissionEvent.objects.order_by('time')[5]
+        event.time = self.t0 - datetime.timedelta(hours=1)
+        event.save()
+        AdmissionEvent.objects.order_by('time')[20].delete()
+        self.check_series(self.t0 - datetime.timedelta(hours=2), later)
+
+    def test_up_to_date_queries(self):
+        census.occupancy_at(self.t0)
+        with CaptureQueriesContext(connection) as ctx:
+            census.occupancy_series(self.t0, self.t0 + datetime.timedelta(days=30))
+        # the state, new events, the occupancy before the range and the checkpoints in it
+        self.assertEqual(len([q for q in ctx.captured_queries if q['sql'].startswith('SELECT')]), 4)
+
+    def test_rebuild(self):
+        hours, series = census.occupancy_series(self.t0, self.t0 + datetime.timedelta(days=2))
+        CensusCheckpoint.objects.update(occupancy=99)
+        call_command('rebuild_census', stdout=StringIO())
+        self.assertEqual(census.occupancy_series(self.t0, self.t0 + datetime.timedelta(days=2)), (hours, series))
+
+    def test_endpoint(self):
+        make_user("admin", is_superuser=True)
+        self.client.login(username="admin", password="pw")
+        data = json.loads(self.client.get('/census/', {'at': '2030-03-04T12:00'}).content.decode())
+        at = timezone.make_aware(datetime.datetime(2030, 3, 4, 12, 0), timezone.get_default_timezone())
+        self.assertEqual(dict((h['pk'], h['occupancy']) for h in data['hospitals']), self.brute_force(at))
+        data = json.loads(self.client.get('/census/', {'start': '2030-03-04', 'end': '2030-03-05'}).content.decode())
+        self.assertEqual(len(data['hours']), 25)
+        self.assertEqual([h['name'] for h in data['hospitals']], ['North', 'South'])
+        self.assertEqual(len(data['hospitals'][0]['occupancy']), 25)
+        self.assertEqual(self.client.get('/census/', {'start': '2030-03-04', 'end': '2032-03-05'}).status_code, 400)
+        self.assertEqual(self.client.get('/census/', {'start': 'soon'}).status_code, 400)
+        self.assertContains(self.client.get('/viewstatistics/', {'metric': 'Census', 'days': '30'}), "census")
+
+
+class testAdmittedCounts(TestCase):
+    def setUp(self):
+        self.north = Hospital.objects.create(name="North")
+        self.south = Hospital.objects.create(name="South")
+        make_staff(Doctor, "doc", self.south)
+        make_user("doc", group="Doctors")
+        Group.objects.get_or_create(name="Patients")
+        self.patients = [make_patient("p%d" % i, self.north) for i in range(3)]
+
+    def counts(self):
+        return dict(Hospital.objects.values_list('name', 'admitted_count'))
+
+    def test_admit_transfer_discharge(self):
+        for patient in self.patients:
+            admissions.change_admission(patient, self.north)
+        self.assertEqual(self.counts(), {'North': 3, 'South': 0})
+        admissions.change_admission(self.patients[0], self.south)
+        admissions.change_admission(self.patients[1], None)
+        self.assertIsNone(admissions.change_admission(self.patients[2], self.north))
+        self.assertEqual(self.counts(), {'North': 1, 'South': 1})
+        # a stale copy of the patient is moved from where they really are
+        stale = Patient.objects.get(pk=self.patients[2].pk)
+        admissions.change_admission(self.patients[2], self.south)
+        admissions.change_admission(stale, None)
+        self.assertEqual(self.counts(), {'North': 0, 'South': 1})
+        self.patients[0].delete()
+        self.assertEqual(self.counts(), {'North': 0, 'South': 0})
+
+    def test_views(self):
+        self.client.login(username="doc", password="pw")
+        patient = self.patients[0]
+        url = '/admit_patient/{}/'.format(patient.pk)
+        self.client.post(url, {str(patient.pk): 'Admit to South', 'reason': 'emergency surgery'})
+        self.client.post('/emergencyregistration/', {'username': 'walkin', 'password': 'secret'})
+        self.assertEqual(self.counts(), {'North': 0, 'South': 2})
+        self.assertContains(self.client.get(url), '<td class="admitted-count">2</td>', html=False)
+        with self.assertNumQueries(4):
+            # the session, the user and their groups, then one query for the counts
+            response = self.client.get('/admitted_counts/')
+        self.assertEqual(json.loads(response.content.decode()),
+                         {'hospitals': [{'pk': self.north.pk, 'name': 'North', 'admitted': 0},
+                                        {'pk': self.south.pk, 'name': 'South', 'admitted': 2}]})
+        self.client.post(url, {str(patient.pk): 'Discharge'})
+        self.assertEqual(self.counts(), {'North': 0, 'South': 1})
+        make_user("p0", group="Patients")
+        self.client.login(username="p0", password="pw")
+        self.assertEqual(self.client.get('/admitted_counts/').status_code, 403)
+
+    def test_reconcile(self):
+        admissions.change_admission(self.patients[0], self.north)
+        # drift: an admission behind the counter's back, and a bad count
+        Patient.objects.filter(pk=self.patients[1].pk).update(admitted_to=self.north)
+        Hospital.objects.filter(pk=self.south.pk).update(admitted_count=5)
+        out = StringIO()
+        call_command('reconcile_admitted_counts', stdout=out)
+        self.assertIn('fixed 2 admitted patient counters', out.getvalue())
+        self.assertEqual(self.counts(), {'North': 2, 'South': 0})
+
+
+class testInbox(TestCase):
+    def setUp(self):
+        hosp = Hospital.objects.create(name="testHosp")
+        self.doctor = make_staff(Doctor, "doc", hosp)
+        self.patient = make_patient("pat", hosp)
+        make_user("pat", "Patients")
+        now = timezone.now()
+        # pairs of messages share a date, to exercise the id tie-breaker
+        for i in range(25):
+            Message.objects.create(source=self.doctor, destination=self.patient, subject="s%d" % i, body="",
+                                   date=now - datetime.timedelta(minutes=i // 2), read=i % 3 != 0)
+        Message.objects.create(source=self.patient, destination=self.doctor, subject="other", body="", date=now)
+        self.expected = list(Message.objects.filter(destination=self.patient).order_by('-date', '-id'))
+
+    def test_pages_are_one_query(self):
+        paginator = KeysetPaginator(self.patient.get_messages(), 10, 'date')
+        page = paginator.page()
+        for i in range(2):
+            with self.assertNumQueries(1):
+                page = paginator.page(page.next_cursor)
+                self.assertEqual([str(m.source) for m in page], ["doc"] * len(page))
+        unread = list(KeysetPaginator(self.patient.get_messages(True), 10, 'date').page())
+        self.assertEqual(unread, [m for m in self.expected if not m.read][:10])
+
+    def test_pages_read_the_index(self):
+        for unread_only in (False, True):
+            messages = self.patient.get_messages(unread_only)
+            for queryset in (messages[:11], messages.filter(date__lte=timezone.now()).filter(
+                    Q(date__lt=timezone.now()) | Q(id__lt=5))[:11]):
+                sql, params = queryset.query.sql_with_params()
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                    plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+                self.assertIn('INDEX', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_view(self):
+        self.client.login(username="pat", password="pw")
+        response = self.client.get('/listmessages/')
+        self.assertEqual(list(response.context['Messages']), self.expected[:10])
+        response = self.client.get('/listmessages/', {'cursor': response.context['Messages'].next_cursor})
+        self.assertEqual(list(response.context['Messages']), self.expected[10:20])
+        response = self.client.get('/listmessages/', {'unread': '1'})
+        self.assertEqual(list(response.context['Messages']), [m for m in self.expected if not m.read][:10])
+        self.assertContains(response, '<li class="active"><a href="/listmessages/?unread=1">Unread</a></li>')
+
+
+class testRecordSearch(TestCase):
+    def setUp(self):
+        self.north = Hospital.objects.create(name="North")
+        self.south = Hospital.objects.create(name="South")
+        self.doctor = make_staff(Doctor, "doc", self.south)
+        make_user("doc", "Doctors")
+        self.nurse = make_staff(Nurse, "nurse", self.north)
+        make_user("nurse", "Nurses")
+        self.mine = make_patient("mine", self.north)
+        self.theirs = make_patient("theirs", self.south)
+        for patient in (self.mine, self.theirs):
+            info = patient.medical_information
+            info.history = "Allergic to penicillin; <b>fevers</b> since childhood"
+            info.save()
+        self.test = MedicalTest.objects.create(title="Blood panel", testDate="2030-01-01", doctor=self.doctor,
+                                               hospital=self.south, results="Mild fever, low iron",
+                                               patient=self.theirs, pending=1)
+        Prescription.objects.create(prescribed_By=self.doctor, prescribed_To=self.mine, name="Amoxicillin",
+                                    start_Date="2030-01-01", end_Date="2030-01-10", usage="twice daily for fever")
+        inbox.send_message(self.doctor, self.nurse, "Fever ward", "Please check the fever ward")
+
+    def hits(self, text, person, patients=None, kind=None):
+        return [(hit_kind, patient) for hit_kind, pk, patient, title, snippet, score
+                in search.search(text, person.pk, patients, kind)]
+
+    def test_scoped_hits(self):
+        # the doctor sees every patient, and the message they sent
+        self.assertEqual(sorted(self.hits("fever", self.doctor)),
+                         [('h', self.mine.pk), ('h', self.theirs.pk), ('m', None), ('p', self.mine.pk),
+                          ('t', self.theirs.pk)])
+        # the nurse sees the patients of their hospital, and their own messages
+        self.assertEqual(sorted(self.hits("fever", self.nurse, self.nurse.list_patients())),
+                         [('h', self.mine.pk), ('m', None), ('p', self.mine.pk)])
+        self.assertEqual(self.hits("fever", self.nurse, self.nurse.list_patients(), 'm'), [('m', None)])
+        # title matches rank first
+        self.assertEqual(self.hits("fever", self.nurse, self.nurse.list_patients())[0], ('m', None))
+        self.assertEqual(self.hits("penicillin ALLERGIC", self.doctor), [('h', self.mine.pk), ('h', self.theirs.pk)]
+                         if self.mine.pk < self.theirs.pk else [('h', self.theirs.pk), ('h', self.mine.pk)])
+        for text in ('', '"', 'fever AND (', 'NEAR(fever', '*'):
+            self.assertIsInstance(self.hits(text, self.doctor), list)
+
+    def test_rank_window(self):
+        # only the newest matches of each kind are ranked; older ones come after them, unranked
+        with mock.patch.object(search, 'RANK_WINDOW', 1):
+            results = search.search("fever", self.doctor.pk)
+            self.assertEqual(sorted((hit[0], hit[2]) for hit in results[:4]),
+                             [('h', self.theirs.pk), ('m', None), ('p', self.mine.pk), ('t', self.theirs.pk)])
+            self.assertEqual([(hit[0], hit[2], hit[5]) for hit in results[4:]], [('h', self.mine.pk, None)])
+            # the window is taken from the nurse's patients only
+            hits = search.search("fever", self.nurse.pk, self.nurse.list_patients(), 'h')
+            self.assertEqual([(hit[0], hit[2]) for hit in hits], [('h', self.mine.pk)])
+            self.assertIsNotNone(hits[0][5])
+
+    def test_match_older_than_window(self):
+        # the nurse's only match is older than a full window of another hospital's matches
+        newer = []
+        for i in range(3):
+            patient = make_patient("south%d" % i, self.south)
+            patient.medical_information.history = "Fever"
+            patient.medical_information.save()
+            newer.append(patient.pk)
+        with mock.patch.object(search, 'RANK_WINDOW', 2):
+            self.assertEqual(self.hits("fever", self.nurse, self.nurse.list_patients(), 'h'), [('h', self.mine.pk)])
+            # the doctor's pages run from the two ranked matches on into the older ones, newest first
+            pages = [[hit[2] for hit in search.search("fever", self.doctor.pk, kind='h', limit=2, offset=offset)]
+                     for offset in (0, 2, 4)]
+            self.assertEqual(sorted(pages[0]), newer[1:])
+            self.assertEqual(pages[1] + pages[2], [newer[0], self.theirs.pk, self.mine.pk])
+            # further back than the scan window, the nurse's match is still found, unranked
+            with mock.patch.object(search, 'SCAN_WINDOW', 3):
+                hits = search.search("fever", self.nurse.pk, self.nurse.list_patients(), 'h')
+                self.assertEqual([(hit[2], hit[5]) for hit in hits], [(self.mine.pk, None)])
+
+    def test_signals_keep_index_current(self):
+        self.test.results = "Normal"
+        self.test.save()
+        self.assertNotIn(('t', self.theirs.pk), self.hits("fever", self.doctor))
+        self.assertEqual(self.hits("normal", self.doctor), [('t', self.theirs.pk)])
+        Prescription.objects.all().delete()
+        self.assertEqual(self.hits("amoxicillin", self.doctor), [])
+        self.theirs.delete()
+        self.assertEqual(self.hits("penicillin", self.doctor), [('h', self.mine.pk)])
+        Message.objects.all().delete()
+        self.assertEqual(self.hits("ward", self.nurse), [])
+        inbox.broadcast(self.doctor, Person.objects.filter(pk=self.nurse.pk), "Ward closed", "Use the east ward")
+        self.assertEqual(self.hits("east ward", self.nurse), [('m', None)])
+
+    def test_rebuild(self):
+        MedicalTest.objects.update(results="Anemia")
+        self.assertEqual(self.hits("anemia", self.doctor), [])
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('indexed 2 medical histories, 1 medical tests, 1 prescriptions, 1 messages', out.getvalue())
+        self.assertEqual(self.hits("anemia", self.doctor), [('t', self.theirs.pk)])
+        self.assertEqual(len(self.hits("fever", self.doctor)), 4)
+
+    def test_view(self):
+        self.client.login(username="nurse", password="pw")
+        response = self.client.get('/search/', {'q': 'fevers', 'format': 'json'})
+        results = json.loads(response.content.decode())['results']
+        self.assertEqual(sorted((r['kind'], r['patient'] or '') for r in results),
+                         [('h', 'mine'), ('m', ''), ('p', 'mine')])
+        history = next(r for r in results if r['kind'] == 'h')
+        self.assertEqual(history['url'], '/updatepatient/{}/'.format(self.mine.pk))
+        # the history's own markup is escaped; only the matches are marked
+        self.assertIn('&lt;b&gt;<mark>fevers</mark>&lt;/b&gt;', history['snippet'])
+        response = self.client.get('/search/', {'q': 'iron'})
+        self.assertContains(response, 'No records match')
+        self.client.login(username="doc", password="pw")
+        response = self.client.get('/search/', {'q': 'blood iron', 'kind': 't'})
+        self.assertContains(response, '<b><mark>Blood</mark> panel</b>')
+        self.assertContains(response, '<mark>iron</mark>')
+        make_user("mine", "Patients")
+        self.client.login(username="mine", password="pw")
+        self.assertEqual(self.client.get('/search/', {'q': 'fever'}).status_code, 302)
@@ -11,22 +11,32 @@ urlpatterns = [
     url(r'^login/?$', views.login, name='login'), # optional trailing slash to make ?next work (redirect from @login_required)
     url(r'^updatepatient/$', views.updatePatient, name='updatepatient'),
     url(r'^listpatients/$', views.listPatients, name='listpatients'),
+    url(r'^searchpatients/$', views.search_patients, name='searchpatients'),
+    url(r'^search/$', views.search_records, name='searchrecords'),
+    url(r'^lookup/(?P<kind>people|doctors|patients)/$', views.lookup, name='lookup'),
     url(r'^calendar/$', views.calendar, name='Calendar'),
+    url(r'^calendar/events/$', views.calendar_events, name='calendar_events'),
     url(r'^updatepatient/(?P<patient_pk>\d+)/$', views.updatePatientMedicalInformation,
         name='updatepatientmedicalinformation'),
     url(r'^updateappointment/(?P<appointment_pk>\d+)/$', views.update_appointment,
         name='update_appointment'),
     url(r'^createappointment/$', views.create_appointment, name='createappointment'),
+    url(r'^freeslots/$', views.free_slots, name='freeslots'),
     url(r'^cancelappointment/(?P<appointment_pk>\d+)/$', views.cancel_appointment,
         name='cancel_appointment'),
     url(r'^view_logs/$', views.view_logs, name='view_logs'),
     url(r'^view_logs/(?P<person_pk>\d+)/$', views.view_logs_by_user, name='view_logs_by_user'),
+    url(r'^export_logs/$', views.export_logs, name='export_logs'),
     url(r'^view_log_entry/(?P<log_entry_pk>\d+)/$', views.view_log_entry, name='view_log_entry'),
+    url(r'^audit_status/$', views.audit_status, name='audit_status'),
     url(r'^register_staff/$', views.register_staff, name='register_staff'),
     url(r'^listmessages/$', views.list_messages, name='listmessages'),
+    url(r'^messageevents/$', views.message_events, name='message_events'),
     url(r'^viewmessage/(?P<messageID>\d+)/$', views.view_message, name='viewmessage'),
     url(r'^sendmessage/$', views.send_message, name='sendmessage'),
+    url(r'^broadcast/$', views.broadcast_message, name='broadcast'),
     url(r'^reply/(?P<message_pk>\d+)/$', views.reply, name='reply'),
+    url(r'^conversation/(?P<conversation_pk>\d+)/$', views.conversation_messages, name='conversation'),
     url(r'^listTests/(?P<patient_pk>\d+)/$', views.listTests, name='listTests'),
     url(r'^removeTest/(?P<patient_pk>\d+)/(?P<test_pk>\d+)/$', views.removeTest, name='removeTest'),
     url(r'^receiveMedicalTest/(?P<patient_pk>\d+)/$', views.receiveMedicalTest, name='receiveMedicalTest'),
@@ -44,6 +54,9 @@ urlpatterns = [
     url(r'^d3Statistics/$', views.d3Statistics, name='Statistics'),
     url(r'^statisticscategories/$', views.system_statistics_categories, name='statisticscategories'),
     url(r'^viewstatistics/$', views.system_statistics, name='viewstatistics'),
+    url(r'^statistics_cache/$', views.statistics_cache_status, name='statistics_cache'),
+    url(r'^census/$', views.census_occupancy, name='census'),
+    url(r'^admitted_counts/$', views.admitted_counts, name='admitted_counts'),
     url(r'^emergencyregistration/$', views.emergency_register_patient, name='emergencyregistration'),
 ]
 urlpatterns+=static(settings.MEDIA_URL,document_root=settings.MEDIA_ROOT)
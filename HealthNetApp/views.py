@@ -7,27 +7,35 @@ purpose: the views for the HealthNetApp application
 from collections import defaultdict
 
 import json
-import random, string, datetime
+import random, string, datetime, time
 from datetime import date
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.db.utils import IntegrityError
 from django.contrib.auth.models import User
 from django.contrib.auth.models import Group
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from django.shortcuts import render, get_object_or_404, get_list_or_404
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404, JsonResponse, StreamingHttpResponse
 from django.contrib import auth
 from .forms import RegisterForm, LoginForm, ProfileForm, MedicalInformationForm, AppointmentForm, \
-    PatientAppointmentForm, DoctorAppointmentForm, StaffRegisterForm, PrescriptionForm, MessageForm, MedicalTestForm, CustomDateForm
+    PatientAppointmentForm, DoctorAppointmentForm, StaffRegisterForm, PrescriptionForm, MessageForm, MedicalTestForm, CustomDateForm, \
+    LogExportForm, FreeSlotForm, BroadcastForm
 
-from .models import Patient, LogEntry, MedicalInformation, Appointment, Doctor, Nurse, Prescription, Hospital, Message, MedicalTest, MedicalProfessional, Administrator
+from .models import Patient, LogEntry, LogRollup, MedicalInformation, Appointment, Doctor, Nurse, Prescription, Hospital, Message, MedicalTest, MedicalProfessional, Administrator, \
+    Conversation
 
 from django.views.generic import FormView, DetailView, ListView
+from . import admissions, census, inbox, search
 from .logger import *
+from .notifications import hub, format_event
+from .pagination import KeysetPaginator
+from .principal import get_principal
+from .scheduling import DURATIONS, find_free_slots
 from .statistics import *
 from django.core.exceptions import ValidationError
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db.models import Max, Q
 from django.core.validators import validate_email
 from django.views.decorators.http import require_GET, require_POST
 from os import path
@@ -41,7 +49,7 @@ def group_member(user, group):
     :param group: (string) The group name
     :return: True iff the given user is part of the given group
     '''
-    return user.groups.filter(name=group).exists()
+    return get_principal(user).in_group(group)
 
 
 def get_person_thing_type(user):
@@ -50,14 +58,7 @@ def get_person_thing_type(user):
     :param user: request.user
     :return: One of 'p', 'n', 'd', or 'a'
     '''
-    if group_member(user, 'Patients'):
-        return 'p'
-    elif group_member(user, 'Nurses'):
-        return 'n'
-    elif group_member(user, 'Doctors'):
-        return 'd'
-    else:
-        return 'a'
+    return get_principal(user).thing_type
 
 
 def get_person_thing_type_pkid(user):
@@ -66,15 +67,7 @@ def get_person_thing_type_pkid(user):
     :param user: request.user
     :return: A primary key
     '''
-    if group_member(user, 'Patients'):
-        return Patient.objects.get(username=user.username).pk
-    elif group_member(user, 'Nurses'):
-        return Nurse.objects.get(username=user.username).pk
-    elif group_member(user, 'Doctors'):
-        return Doctor.objects.get(username=user.username).pk
-    else:
-        #todo: actually return the person associated with the administrator
-        return 0
+    return get_principal(user).pkid
 
 
 def index(request):
@@ -155,7 +148,7 @@ def logout(request):
     '''
     logout the user. bring them to login page with redirect
     '''
-    person = get_object_or_404(Person, username=request.user.username)
+    person = request.principal.get_person_or_404(Person)
     ###################
     # log the logout
     #    if group_member(user, 'Patients'):
@@ -192,7 +185,7 @@ def login(request):
                     return HttpResponseRedirect(reverse('index'))
                 # Otherwise, If not admin:
                 # log the login.
-                person = get_object_or_404(Person, username=user.username)
+                person = get_principal(user).get_person_or_404(Person)
                 log_event(username, 'r', get_person_thing_type(user), get_person_thing_type_pkid(user), 'N/A', 'user has logged in')
                 if group_member(user, 'Patients'):
                     # Patients will want to see their profile;
@@ -225,7 +218,7 @@ def updatePatient(request):
     # get the patient object we will need to modify.
     user = request.user
     if group_member(user, 'Patients'):
-        patient = get_object_or_404(Patient, username=user.username)
+        patient = request.principal.get_person_or_404(Patient)
         prescriptions = Prescription.objects.filter(prescribed_To=patient)
     else:
         return HttpResponseRedirect(reverse('login'))
@@ -298,7 +291,7 @@ def exportInformation(request):
     '''
     if not group_member(request.user, 'Patients'):
         return HttpResponseRedirect(reverse('login'))
-    patient = get_object_or_404(Patient, username=request.user.username)
+    patient = request.principal.get_person_or_404(Patient)
     prescriptions = Prescription.objects.filter(prescribed_To=patient)
 
     # Create a dictionary to store the exportable data
@@ -345,7 +338,7 @@ def updatePatientMedicalInformation(request, patient_pk):
         # Patients can't write their own prescriptions
         return HttpResponseRedirect(reverse('login'))
     if group_member(request.user, 'Nurses'):
-        n = get_object_or_404(Nurse, username=request.user.username)
+        n = request.principal.get_person_or_404(Nurse)
         # Requirement 10: nurses can only view patient medical information in the hospital they work for.
         if p.preferred_hospital != n.hospital:
             return HttpResponseRedirect(reverse('login'))
@@ -434,7 +427,7 @@ def removeTest(request, patient_pk, test_pk):
 @require_POST
 def acceptPrescriptionForm(request, patient_pk):
     patient = get_object_or_404(Patient, pk=patient_pk)
-    doc = get_object_or_404(Doctor, username=request.user.username)
+    doc = request.principal.get_person_or_404(Doctor)
 
     form = PrescriptionForm(request.POST)
     if form.is_valid():
@@ -632,11 +625,11 @@ def admitPatient(request, patient_pk):
     if request.method == "GET":
         #if user is a medical professional, get the user's cooresponding medical_professional object
         if group_member(request.user, 'Nurses'):
-            mp = get_object_or_404(Nurse, username=request.user.username)
+            mp = request.principal.get_person_or_404(Nurse)
         elif group_member(request.user, 'Doctors'):
-            mp = get_object_or_404(Doctor, username=request.user.username)
+            mp = request.principal.get_person_or_404(Doctor)
         elif request.user.is_superuser:
-            mp = get_object_or_404(Administrator, username=request.user.username)
+            mp = request.principal.get_person_or_404(Administrator)
         #otherwise, the user is logged in as a patient
         else:
             #redirect them to the login page
@@ -668,10 +661,8 @@ def admitPatient(request, patient_pk):
             else:
                 hsptl = None
 
-            #admit/discharge the patient to the specified hospital, then save the change
-            patient.admitted_to = hsptl;
-            #save the change to the database
-            patient.save()
+            #admit/discharge the patient to the specified hospital, and record the change
+            admissions.change_admission(patient, hsptl)
 
             #log the patient hospital update
             log_event(request.user.username, 'u', 'p', patient.pk, 'admitted_to', 'the hospital the patient was addmitted to was changed')
@@ -697,10 +688,8 @@ def admitPatient(request, patient_pk):
             if ((patient.admitted_to is None) and (action[0:5] == 'Admit')):
                 #get the reason for admitting the patient (if applicable) - if not found, set value to 'None'
                 reason = request.POST.get('reason', 'None')
-                #set the patient's hospital to that of the user
-                patient.admitted_to = hsptl
-                #save the change to the database
-                patient.save()
+                #admit the patient to the user's hospital, and record the admission
+                admissions.change_admission(patient, hsptl, reason)
                 #log the patient hospital admission
                 log_event(request.user.username, 'u', 'p', patient.pk, 'admitted_to', 'patient was admitted to ' + hsptl.name + ' with reason \"' + reason + '\"')
 
@@ -708,20 +697,16 @@ def admitPatient(request, patient_pk):
             elif (group_member(request.user, 'Doctors') and (action == 'Transfer')):
                 #save the hosital the patient was previously admitted to
                 old_hsptl = patient.admitted_to
-                #set the patient's hospital to that of the user
-                patient.admitted_to = hsptl
-                #save the change to the database
-                patient.save()
+                #move the patient to the user's hospital, and record the transfer
+                admissions.change_admission(patient, hsptl)
                 #log the patient hospital transfer
                 log_event(request.user.username, 'u', 'p', patient.pk, 'admitted_to', 'the patient was transfered from ' + old_hsptl.name + ' to ' + hsptl.name)
 
 
             #otherwise, if the user is a doctor, and is discharging a patient from their own hospital
             elif group_member(request.user, 'Doctors') and (action == 'Discharge') and (patient.admitted_to == hsptl):
-                #set the patient to be admitted to no hospital
-                patient.admitted_to = None
-                #save the change to the database
-                patient.save()
+                #set the patient to be admitted to no hospital, and record the discharge
+                admissions.change_admission(patient, None)
                 #log the patient hospital discharge
                 log_event(request.user.username, 'u', 'p', patient.pk, 'admitted_to', 'the patient was discharged from ' + hsptl.name)
 
@@ -739,58 +724,253 @@ def listPatients(request):
     '''
     Doctors can view all of their current patients
     '''
-    # make sure logged in as Doctor or nurse
-    # Nurses can only view patient medical information in the hospital they work for.
+    queryset = visible_patients(request)
+    if queryset is None:
+        return HttpResponseRedirect(reverse('login'))
+    user = request.user
+
+    # Only the first page is rendered here; the search box pages through
+    # the rest with search_patients.
+    patients, has_next = patient_search_page(queryset, '', 'prefix', 1)
+    log_event(user.username, 'r', 'p', get_person_thing_type_pkid(user), 'N/A', 'user has viewed list of patients')
+    return render(request, 'ListPatients.html', {'patients': patients, 'has_next': has_next, 'user': user})
+
+
+# Patients per page of search results
+PATIENT_SEARCH_PAGE_SIZE = 25
+
+def visible_patients(request):
+    '''
+    The patients the logged-in user may look through.
+    Nurses can only view patient medical information in the hospital they work for.
+    :return: a Patient queryset, or None if the user may not list patients
+    '''
     if group_member(request.user, 'Nurses'):
-        mp = get_object_or_404(Nurse, username=request.user.username)
-        queryset = mp.list_patients()
+        return request.principal.get_person_or_404(Nurse).list_patients()
     elif group_member(request.user, 'Doctors'):
-        mp = get_object_or_404(Doctor, username=request.user.username)
-        queryset = mp.list_patients()
+        return request.principal.get_person_or_404(Doctor).list_patients()
     elif request.user.is_superuser:
-        mp = get_object_or_404(Administrator, username=request.user.username)
-        queryset = mp.list_patients()
+        return request.principal.get_person_or_404(Administrator).list_patients()
+    return None
+
+
+def patient_search_page(queryset, query, match, page):
+    '''
+    One page of patients matching a search.
+    Fetches one row more than the page size to tell if there is a next
+    page, so no COUNT(*) is needed.
+    :return: (list of patients, whether there is a next page)
+    '''
+    offset = (page - 1) * PATIENT_SEARCH_PAGE_SIZE
+    rows = list(Person.search(queryset, query, match)[offset:offset + PATIENT_SEARCH_PAGE_SIZE + 1])
+    return rows[:PATIENT_SEARCH_PAGE_SIZE], len(rows) > PATIENT_SEARCH_PAGE_SIZE
+
+
+@login_required
+@require_GET
+def search_patients(request):
+    '''
+    JSON search over the patients the user may see, by name or username.
+    GET parameters: q (the search text), match ('prefix', the default, or
+    'contains') and page (from 1).
+    '''
+    queryset = visible_patients(request)
+    if queryset is None:
+        return JsonResponse({'error': 'not allowed'}, status=403)
+    match = 'contains' if request.GET.get('match') == 'contains' else 'prefix'
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        page = 1
+    patients, has_next = patient_search_page(queryset, request.GET.get('q', ''), match, page)
+    return JsonResponse({'results': [{'pk': p.pk,
+                                      'name': p.name,
+                                      'username': p.username,
+                                      'url': reverse('updatepatientmedicalinformation', args=[p.pk])}
+                                     for p in patients],
+                         'page': page,
+                         'has_next': has_next})
+
+
+# How many matches lookup returns
+LOOKUP_LIMIT = 20
+
+@login_required
+@require_GET
+def lookup(request, kind):
+    '''
+    Typeahead lookup for the LookupSelect form fields: the first
+    LOOKUP_LIMIT people of the given kind whose name or username matches
+    the GET parameter q, out of those the user could choose in the form.
+    Short queries match prefixes, longer ones match anywhere.
+    :param kind: 'people' (message recipients), 'doctors' or 'patients'
+    '''
+    if kind == 'people':
+        queryset = Person.objects.all()
+    elif kind == 'doctors':
+        queryset = Doctor.objects.all()
     else:
-        return HttpResponseRedirect(reverse('login'))
-    user = request.user
+        queryset = visible_patients(request)
+        if queryset is None:
+            return JsonResponse({'error': 'not allowed'}, status=403)
+    query = request.GET.get('q', '')
+    match = 'contains' if len(query.strip()) >= 3 else 'prefix'
+    people = Person.search(queryset, query, match)[:LOOKUP_LIMIT]
+    return JsonResponse({'results': [{'pk': p.pk, 'name': str(p)} for p in people]})
 
-    log_event(user.username, 'r', 'p', get_person_thing_type_pkid(user), 'N/A', 'user has viewed list of patients')
-    return render(request, 'ListPatients.html', {'patients': queryset, 'user': user})
 
+# Hits per page of record search results
+RECORD_SEARCH_PAGE_SIZE = 20
+RECORD_KIND_NAMES = {search.HISTORY: 'Medical History', search.TEST: 'Medical Test',
+                     search.PRESCRIPTION: 'Prescription', search.MESSAGE: 'Message'}
 
 @login_required
-def calendar(request):
+@require_GET
+def search_records(request):
     '''
-    the calendar view used mainly for viewing appointments for a user
+    Full-text search over the medical histories, medical tests and
+    prescriptions of the patients the user may see (see visible_patients),
+    and the messages they sent or received, best matches first.
+    GET parameters: q (the search text), kind (only search one kind of
+    record: 'h', 't', 'p' or 'm'), page (from 1) and format ('json' for the
+    hits as JSON; otherwise the search page is rendered).
+    '''
+    patients = visible_patients(request)
+    if patients is None:
+        return HttpResponseRedirect(reverse('login'))
+    # doctors and administrators may see every patient, so their hits need no scoping
+    if not group_member(request.user, 'Nurses'):
+        patients = None
+    person = request.principal.person
+    query = request.GET.get('q', '')
+    kind = request.GET.get('kind') if request.GET.get('kind') in search.KINDS else None
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        page = 1
+    # one hit more than the page size tells if there is a next page
+    hits = search.search(query, person.pk, patients, kind, RECORD_SEARCH_PAGE_SIZE + 1,
+                         (page - 1) * RECORD_SEARCH_PAGE_SIZE)
+    has_next, hits = len(hits) > RECORD_SEARCH_PAGE_SIZE, hits[:RECORD_SEARCH_PAGE_SIZE]
+    names = dict(Patient.objects.filter(pk__in=set(hit[2] for hit in hits if hit[2] is not None))
+                 .values_list('pk', 'name'))
+    results = []
+    for hit_kind, pk, patient_pk, title, snippet, score in hits:
+        if hit_kind == search.HISTORY:
+            url = reverse('updatepatientmedicalinformation', args=[patient_pk])
+        elif hit_kind == search.TEST:
+            url = reverse('viewTestForm', args=[pk, 0])
+        elif hit_kind == search.PRESCRIPTION:
+            url = reverse('listPrescriptions', args=[patient_pk])
+        else:
+            url = reverse('viewmessage', args=[pk])
+        results.append({'kind': hit_kind, 'kind_name': RECORD_KIND_NAMES[hit_kind], 'pk': pk,
+                        'patient': names.get(patient_pk), 'title': title, 'snippet': snippet, 'url': url,
+                        'score': score})
+    if request.GET.get('format') == 'json':
+        return JsonResponse({'results': results, 'page': page, 'has_next': has_next})
+    return render(request, 'searchRecords.html', {'query': query, 'kind': kind, 'kinds': sorted(
+        RECORD_KIND_NAMES.items()), 'results': results, 'page': page, 'has_next': has_next})
+
+
+def calendar_person(request):
+    '''
+    The Person whose appointments the logged-in user sees on their calendar.
+    :return: a Patient, Doctor, Nurse or Administrator, or None if the user
+    has no calendar
     '''
-    appts = []
-    can_create = True
     if group_member(request.user, 'Patients'):
-        u = get_object_or_404(Patient, username=request.user.username)
-        if not u.can_create_appointment():
-            # Disable the new appointment button if a patient has outstanding appointments.
-            can_create = False
+        return request.principal.get_person_or_404(Patient)
     elif group_member(request.user, 'Doctors'):
-        u = get_object_or_404(Doctor, username=request.user.username)
+        return request.principal.get_person_or_404(Doctor)
     elif group_member(request.user, 'Nurses'):
-        u = get_object_or_404(Nurse, username=request.user.username)
+        return request.principal.get_person_or_404(Nurse)
     elif request.user.is_superuser:
-        u = get_object_or_404(Administrator, username=request.user.username)
-    else:
+        return request.principal.get_person_or_404(Administrator)
+    return None
+
+
+@login_required
+def calendar(request):
+    '''
+    the calendar view used mainly for viewing appointments for a user.
+    The appointments themselves are loaded by the calendar from
+    calendar_events, one visible date range at a time.
+    '''
+    u = calendar_person(request)
+    if u is None:
         return HttpResponseRedirect(reverse('login'))
+    # Disable the new appointment button if a patient has outstanding appointments.
+    can_create = not isinstance(u, Patient) or u.can_create_appointment()
+    return render(request, 'calendar.html', {'can_create': can_create})
+
+
+# The longest date range calendar_events will serve at once (the month view
+# asks for six weeks)
+CALENDAR_MAX_DAYS = 62
+
+def parse_calendar_bound(value):
+    '''
+    Parse a FullCalendar start/end parameter, which is either a date or a
+    datetime without a timezone (local time).
+    :return: an aware datetime, or None if the value is missing or invalid
+    '''
+    if not value:
+        return None
+    try:
+        bound = parse_datetime(value)
+        if bound is None:
+            day = parse_date(value)
+            if day is None:
+                return None
+            bound = datetime.datetime.combine(day, datetime.time.min)
+    except ValueError:
+        return None
+    if timezone.is_naive(bound):
+        bound = make_aware(bound, get_default_timezone())
+    return bound
+
+
+@login_required
+@require_GET
+def calendar_events(request):
+    '''
+    JSON event feed for the calendar: the user's appointments that overlap
+    the [start, end) range FullCalendar asks for. The events are encoded and
+    streamed one at a time rather than built up in memory.
+    '''
+    u = calendar_person(request)
+    if u is None:
+        return HttpResponseRedirect(reverse('login'))
+    start = parse_calendar_bound(request.GET.get('start'))
+    end = parse_calendar_bound(request.GET.get('end'))
+    if start is None or end is None or end <= start:
+        return JsonResponse({'error': 'start and end dates are required'}, status=400)
+    if end - start > datetime.timedelta(days=CALENDAR_MAX_DAYS):
+        return JsonResponse({'error': 'at most {} days can be requested at once'.format(CALENDAR_MAX_DAYS)},
+                            status=400)
     # Polymorphic / duck-typed list_appointments function differs in behavior
     # based on the type of logged-in user. See models.py.
-    for appointment in u.list_appointments():
-        print(appointment.start.time())
-        appts.append(
+    appointments = u.list_appointments().filter(end__gt=start, start__lt=end) \
+        .select_related('doctor', 'patient').order_by('start', 'pk')
+    return StreamingHttpResponse(stream_calendar_events(u, appointments), content_type='application/json')
+
+
+def stream_calendar_events(u, appointments):
+    '''
+    Yield a JSON array of FullCalendar events, one event per chunk.
+    '''
+    separator = '['
+    for appointment in appointments.iterator():
+        yield separator + json.dumps(
             {'title': u.appointment_title(appointment),
              'start': appointment.start.isoformat(),
              'end': appointment.end.isoformat(),
              'allDay': False,
              'url': reverse('update_appointment', kwargs={'appointment_pk': appointment.pk})
              })
-    return render(request, 'calendar.html', {'appointments': json.dumps(appts),
-                                             'can_create': can_create})
+        separator = ','
+    yield ']' if separator == ',' else '[]'
 
 
 @login_required
@@ -803,7 +983,7 @@ def update_appointment(request, appointment_pk):
     old_a_end = a.end
     # A patient can only update their appointments
     if group_member(request.user, 'Patients'):
-        p = get_object_or_404(Patient, username=request.user.username)
+        p = request.principal.get_person_or_404(Patient)
         if p != a.patient:
             return HttpResponseRedirect(reverse('login'))
     # Everyone else can update any appointment
@@ -853,7 +1033,7 @@ def cancel_appointment(request, appointment_pk):
     a = get_object_or_404(Appointment, pk=appointment_pk)
     if group_member(request.user, 'Patients'):
         # A patient can only cancel their own appointments
-        p = get_object_or_404(Patient, username=request.user.username)
+        p = request.principal.get_person_or_404(Patient)
         if p != a.patient:
             return HttpResponseRedirect(reverse('login'))
     elif group_member(request.user, 'Nurses'):
@@ -861,7 +1041,7 @@ def cancel_appointment(request, appointment_pk):
         return HttpResponseRedirect(reverse('login'))
     elif group_member(request.user, 'Doctors'):
         # A doctor can only cancel their own appointments
-        d = get_object_or_404(Doctor, username=request.user.username)
+        d = request.principal.get_person_or_404(Doctor)
         if d != a.doctor:
             return HttpResponseRedirect(reverse('login'))
     else:
@@ -885,11 +1065,15 @@ def create_appointment(request):
             form = PatientAppointmentForm(request.POST)
             if form.is_valid():
                 data = form.cleaned_data
-                p = get_object_or_404(Patient, username=request.user.username)
+                p = request.principal.get_person_or_404(Patient)
             else:
                 return render(request, 'CreateAppointment.html', {'form': form})
         else:
-            form = DoctorAppointmentForm(request.POST, patient_list=Patient.objects.all())
+            # only patients the user could have picked are accepted
+            patient_list = visible_patients(request)
+            if patient_list is None:
+                return HttpResponseRedirect(reverse('login'))
+            form = DoctorAppointmentForm(request.POST, patient_list=patient_list)
             if form.is_valid():
                 data = form.cleaned_data
                 p = data['patient']
@@ -916,24 +1100,74 @@ def create_appointment(request):
 
     else:
         if group_member(request.user, 'Patients'):
-            p = get_object_or_404(Patient, username=request.user.username)
+            p = request.principal.get_person_or_404(Patient)
             if not p.can_create_appointment():
                 return HttpResponseRedirect(reverse('Calendar'))
             form = PatientAppointmentForm(initial={'hospital': p.preferred_hospital})
             return render(request, 'CreateAppointment.html', {'form': form})
         elif group_member(request.user, 'Doctors'):
-            d = get_object_or_404(Doctor, username=request.user.username)
+            d = request.principal.get_person_or_404(Doctor)
             form = DoctorAppointmentForm(patient_list=d.list_patients(), initial={'hospital': d.hospital,
                                                                                   'doctor': d})
             return render(request, 'CreateAppointment.html', {'form': form})
         elif group_member(request.user, 'Nurses'):
-            n = get_object_or_404(Nurse, username=request.user.username)
+            n = request.principal.get_person_or_404(Nurse)
             form = DoctorAppointmentForm(patient_list=n.list_patients(), initial={'hospital': n.hospital})
             return render(request, 'CreateAppointment.html', {'form': form})
         else:
             return HttpResponseRedirect(reverse('login'))
 
 
+@login_required
+@require_GET
+def free_slots(request):
+    '''
+    JSON list of the free appointment slots of a doctor, or of every doctor
+    at a hospital, between two dates. A patient's own appointments are also
+    treated as booked, so every slot is one they could actually take.
+    Staff may pass the patient of their choice, out of the patients they may
+    see; superusers (who may see every patient) may pass any patient.
+    '''
+    form = FreeSlotForm(request.GET)
+    if request.GET.get('patient') and not request.user.is_superuser \
+            and not group_member(request.user, 'Patients'):
+        patients = visible_patients(request)
+        form.fields['patient'].queryset = patients if patients is not None else Patient.objects.none()
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    data = form.cleaned_data
+    if data['doctor']:
+        doctors = [data['doctor']]
+    else:
+        doctors = list(Doctor.objects.filter(hospital=data['hospital']).order_by('pk'))
+    if group_member(request.user, 'Patients'):
+        patient = request.principal.get_person_or_404(Patient)
+    else:
+        patient = data['patient']
+
+    tz = get_default_timezone()
+    range_start = make_aware(datetime.datetime.combine(data['start'], datetime.time.min), tz)
+    range_end = make_aware(datetime.datetime.combine(data['end'] + datetime.timedelta(days=1),
+                                                     datetime.time.min), tz)
+    booked = Q(doctor__in=doctors)
+    if patient is not None:
+        booked |= Q(patient=patient)
+    # one query for every booking that could block a slot, oldest first
+    rows = Appointment.objects.filter(booked, end__gte=range_start, start__lte=range_end) \
+        .order_by('start').values_list('doctor_id', 'patient_id', 'start', 'end')
+    bookings = [(None if patient is not None and patient_pk == patient.pk else doctor_pk, start, end)
+                for doctor_pk, patient_pk, start, end in rows]
+
+    durations = [data['duration']] if data['duration'] else DURATIONS
+    slots = find_free_slots(bookings, doctors, data['start'], data['end'], durations, timezone.now())
+    return JsonResponse({'slots': [{'doctor': doctor.pk,
+                                    'doctor_name': doctor.name,
+                                    'start': start.isoformat(),
+                                    'end': end.isoformat(),
+                                    'duration': duration}
+                                   for doctor, start, end, duration in slots]})
+
+
 @login_required
 def view_logs(request):
     '''
@@ -941,17 +1175,15 @@ def view_logs(request):
     '''
     #    if(user.is_superuser || user.is_staff):
     if request.user.is_staff or request.user.is_superuser:
-        queryset = LogEntry.objects.all().order_by('-time')
-        paginator = Paginator(queryset, 10) # 10 per page
-        page = request.GET.get('page')
-        try:
-            log_page = paginator.page(page)
-        except PageNotAnInteger:
-            log_page = paginator.page(1)
-        except EmptyPage: # out of range
-            log_page = paginator.page(paginator.num_pages)
-
-        return render(request, 'ListLogEntries.html', {'log_entries': log_page})
+        queryset = LogEntry.objects.select_related('user')
+        paginator = KeysetPaginator(queryset, 10, 'time') # 10 per page
+        log_page = paginator.page(request.GET.get('cursor'))
+        # Log entries are never deleted, so the highest id is a good
+        # estimate of how many there are, and is much cheaper than COUNT(*)
+        estimated_total = LogEntry.objects.aggregate(Max('id'))['id__max'] or 0
+
+        return render(request, 'ListLogEntries.html', {'log_entries': log_page,
+                                                       'estimated_total': estimated_total})
     else:
         return render(request, 'login.html', {'auth_error': 'Only administrators may view system logs.', 'form': LoginForm()})
 
@@ -963,20 +1195,58 @@ def view_logs_by_user(request, person_pk):
     '''
     if request.user.is_staff or request.user.is_superuser:
         person_object = get_object_or_404(Person, pk=person_pk)
-        queryset = LogEntry.objects.filter(user=person_object).order_by('-time')
-        paginator = Paginator(queryset, 10) # 10 per page
-        page = request.GET.get('page')
-        try:
-            log_page = paginator.page(page)
-        except PageNotAnInteger:
-            log_page = paginator.page(1)
-        except EmptyPage: # out of range
-            log_page = paginator.page(paginator.num_pages)
-        return render(request, 'ListLogEntries.html', {'log_entries': log_page, 'by_user': person_object.name})
+        queryset = LogEntry.objects.filter(user=person_object).select_related('user')
+        paginator = KeysetPaginator(queryset, 10, 'time') # 10 per page
+        log_page = paginator.page(request.GET.get('cursor'))
+        return render(request, 'ListLogEntries.html', {'log_entries': log_page, 'by_user': person_object.name,
+                                                       'by_user_pk': person_object.pk})
     else:
         return render(request, 'login.html', {'auth_error': 'Only administrators may view system logs.', 'form': LoginForm()})
 
 
+@login_required
+@require_GET
+def export_logs(request):
+    '''
+    admins can download the log entries matching some filters as CSV or
+    JSON Lines, optionally gzipped. The file is streamed as it is read
+    from the database, so any number of entries can be exported.
+    '''
+    if not (request.user.is_staff or request.user.is_superuser):
+        return HttpResponseRedirect(reverse('login'))
+    form = LogExportForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(form.errors.as_text(), status=400, content_type='text/plain')
+    data = form.cleaned_data
+
+    queryset = LogEntry.objects.all()
+    if data['user']:
+        queryset = queryset.filter(user=data['user'])
+    if data['action_type']:
+        queryset = queryset.filter(action_type=data['action_type'])
+    if data['thing_type']:
+        queryset = queryset.filter(thing_type=data['thing_type'])
+    if data['start']:
+        queryset = queryset.filter(time__gte=make_aware(datetime.datetime.combine(data['start'], datetime.time()),
+                                                        get_default_timezone()))
+    if data['end']:
+        queryset = queryset.filter(time__lt=make_aware(datetime.datetime.combine(data['end'] + datetime.timedelta(days=1),
+                                                                                 datetime.time()),
+                                                       get_default_timezone()))
+
+    if data['format'] == 'jsonl':
+        content, content_type, filename = export_jsonl(iter_log_entries(queryset)), 'application/x-ndjson', 'logs.jsonl'
+    else:
+        content, content_type, filename = export_csv(iter_log_entries(queryset)), 'text/csv', 'logs.csv'
+    if data['gzip']:
+        content, content_type, filename = gzip_stream(content), 'application/gzip', filename + '.gz'
+
+    resp = StreamingHttpResponse(content, content_type=content_type)
+    resp['Content-Disposition'] = 'attachment;filename=' + filename
+    log_event(request.user.username, 'r', get_person_thing_type(request.user), get_person_thing_type_pkid(request.user), 'logs', 'user has exported log entries')
+    return resp
+
+
 @login_required
 def register_staff(request):
     '''
@@ -1054,20 +1324,61 @@ def register_staff(request):
 @login_required
 def list_messages(request):
     '''
-    the user can list their messages in their inbox
+    the user can list their messages in their inbox, newest first.
+    GET parameter cursor selects the page (see KeysetPaginator), and unread=1
+    lists only the unread messages; each page is one query on the
+    (destination, date, id) or (destination, read, date, id) index, however
+    many messages the user has
     '''
-    recipient = get_object_or_404(Person, username=request.user.username)
-    messages = recipient.get_messages()
-    paginator = Paginator(messages, 10) # 10 per page
-    page = request.GET.get('page')
-    try:
-        message_page = paginator.page(page)
-    except PageNotAnInteger:
-        message_page = paginator.page(1)
-    except EmptyPage: # out of range
-        message_page = paginator.page(paginator.num_pages)
+    recipient = request.principal.get_person_or_404(Person)
+    unread_only = request.GET.get('unread') == '1'
+    paginator = KeysetPaginator(recipient.get_messages(unread_only), 10, 'date') # 10 per page
+    message_page = paginator.page(request.GET.get('cursor'))
     log_event(request.user.username, 'r', get_person_thing_type(request.user), get_person_thing_type_pkid(request.user), 'messages', 'the users messages were listed')
-    return render(request, 'listMessages.html', {'Messages':message_page})
+    return render(request, 'listMessages.html', {'Messages': message_page, 'unread_only': unread_only})
+
+# A message event stream is closed after this many seconds, and the browser
+# reconnects; this bounds how long a worker is tied up by one stream
+MESSAGE_EVENTS_DURATION = 300
+# Seconds between keep-alive comments while no events arrive
+MESSAGE_EVENTS_KEEPALIVE = 15
+
+@login_required
+@require_GET
+def message_events(request):
+    '''
+    Server-Sent Events stream of the user's message notifications: an
+    'unread' event with their unread message count (sent first, and again
+    whenever it changes) and a 'message' event with the header of each new
+    message sent to them.
+    '''
+    person = request.principal.get_person_or_404(Person)
+    response = StreamingHttpResponse(stream_message_events(person.pk, request.user.username),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def stream_message_events(person_pk, username):
+    '''
+    Yield a person's message events in the SSE format until
+    MESSAGE_EVENTS_DURATION has passed or the client goes away. The person is
+    only subscribed once the stream is read, so a response that is never
+    streamed leaves no subscription behind.
+    '''
+    subscription = hub.subscribe(person_pk)
+    try:
+        yield 'retry: 5000\n' + format_event('unread', {'count': inbox.unread_count(username)})
+        deadline = time.monotonic() + MESSAGE_EVENTS_DURATION
+        while time.monotonic() < deadline:
+            event = subscription.get(MESSAGE_EVENTS_KEEPALIVE)
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield format_event(*event)
+    finally:
+        subscription.close()
+
 
 @login_required
 def view_message(request, messageID):
@@ -1077,53 +1388,118 @@ def view_message(request, messageID):
     :param messageID: the id of the message to click
     '''
     message = get_object_or_404(Message, pk=messageID)
-    user = get_object_or_404(Person, username=request.user.username)
-    if message.destination != user:
+    user = request.principal.get_person_or_404(Person)
+    if message.destination_id != user.pk:
         raise Http404("No message for you")
-    message.read = True
-    message.save()
+    inbox.mark_read(message)
     log_event(request.user.username, 'r', 'm', messageID, 'All', 'The message was viewed')
     return render(request, 'ViewMessage.html',{'Message':message})
 
 
 @login_required
-def send_message(request):
+def send_message(request, parent=None):
     '''
     send a message to another user in the message
+    :param parent: the Message being replied to, if any
     '''
     if request.method == 'POST':
         form = MessageForm(request.POST)
         if form.is_valid():
             data = form.cleaned_data
-            sender = get_object_or_404(Person, username=request.user.username)
+            sender = request.principal.get_person_or_404(Person)
             receiver = data['destination']
-            message = Message.objects.create(destination=receiver,
-                                   source=sender,
-                                   subject=data['subject'],
-                                   body=data['body'],
-                                   date=timezone.now() )
+            # a reply to the other participant continues the parent's conversation
+            conversation = None
+            if parent is not None and parent.conversation is not None \
+                    and parent.conversation.has_participant(receiver):
+                conversation = parent.conversation
+            message = inbox.send_message(sender, receiver, data['subject'], data['body'], conversation)
             log_event(request.user.username, 'c', 'm', message.pk, 'All', 'A message was created and sent')
             return HttpResponseRedirect('/app/listmessages')
     else:
         form = MessageForm()
     return render(request, 'SendMessage.html', {'form': form})
 
+@login_required
+def broadcast_message(request):
+    '''
+    send one message to all the staff or all the patients of a hospital.
+    Administrators can broadcast to any hospital, doctors and nurses only
+    to their own.
+    '''
+    if request.user.is_superuser:
+        hospitals = Hospital.objects.all()
+    elif group_member(request.user, 'Doctors') or group_member(request.user, 'Nurses'):
+        hospitals = Hospital.objects.filter(pk=request.principal.get_person_or_404(MedicalProfessional).hospital_id)
+    else:
+        return HttpResponseRedirect(reverse('login'))
+    sent = None
+    if request.method == 'POST':
+        form = BroadcastForm(request.POST)
+        form.fields['hospital'].queryset = hospitals
+        if form.is_valid():
+            data = form.cleaned_data
+            hospital = data['hospital']
+            recipients = hospital.staff() if data['audience'] == 'staff' else hospital.patients()
+            sender = request.principal.get_person_or_404(Person)
+            sent = inbox.broadcast(sender, recipients, data['subject'], data['body'])
+            # one entry for the whole broadcast rather than one per message
+            log_event(request.user.username, 'c', 'm', hospital.pk, data['audience'],
+                      'A message was broadcast to {} {} of {}: {}'.format(
+                          sent, data['audience'], hospital.name, data['subject'])[:200])
+            form = BroadcastForm()
+            form.fields['hospital'].queryset = hospitals
+    else:
+        form = BroadcastForm()
+        form.fields['hospital'].queryset = hospitals
+    return render(request, 'Broadcast.html', {'form': form, 'sent': sent})
+
 @login_required
 def reply(request, message_pk):
     '''
     reply to a message that was received
     '''
+    parent = get_object_or_404(Message.objects.select_related('source', 'destination', 'conversation'),
+                               pk=message_pk)
+    user = request.principal.get_person_or_404(Person)
+    if user.pk not in (parent.source_id, parent.destination_id):
+        raise Http404("No message for you")
     if request.method == 'POST':
-        return send_message(request)
-    else:
-        # Ugly hack
-        MessageForm.base_fields['destination'].initial=Message.objects.get(pk=message_pk).source
-        MessageForm.base_fields['subject'].initial="Re: " + Message.objects.get(pk=message_pk).subject
-        form = MessageForm()
-        MessageForm.base_fields['destination'].initial = None
-        MessageForm.base_fields['subject'].initial = None
+        return send_message(request, parent)
+    # reply to the other participant; "Re: " is only added once
+    other = parent.destination if parent.source_id == user.pk else parent.source
+    form = MessageForm(initial={'destination': other,
+                                'subject': "Re: " + Conversation.thread_subject(parent.subject)})
     return render(request, 'SendMessage.html', {'form': form})
 
+@login_required
+@require_GET
+def conversation_messages(request, conversation_pk):
+    '''
+    JSON page of the messages of a conversation, newest first, for one of
+    its participants. GET parameter cursor selects the page (see
+    KeysetPaginator); each page is one query on the (conversation, date, id)
+    index.
+    '''
+    conversation = get_object_or_404(Conversation, pk=conversation_pk)
+    user = request.principal.get_person_or_404(Person)
+    if not conversation.has_participant(user):
+        raise Http404("No conversation for you")
+    messages = Message.objects.filter(conversation=conversation).select_related('source')
+    page = KeysetPaginator(messages, 20, 'date').page(request.GET.get('cursor'))
+    return JsonResponse({'subject': conversation.subject,
+                         'messages': [{'pk': m.pk,
+                                       'source': str(m.source),
+                                       'source_pk': m.source_id,
+                                       'destination_pk': m.destination_id,
+                                       'subject': m.subject,
+                                       'body': m.body,
+                                       'date': m.date.isoformat(),
+                                       'read': m.read}
+                                      for m in page],
+                         'next_cursor': page.next_cursor,
+                         'previous_cursor': page.previous_cursor})
+
 @login_required
 @require_GET
 def d3Statistics(request):
@@ -1146,7 +1522,7 @@ def d3Statistics(request):
         dateRange[1] = end
     if not form.is_valid():
         return render(request, 'D3Logger.html',{'data': None, 'form': form})
-    return render(request, 'D3Logger.html',{'data': json.dumps(LogEntry.parse(dateRange)), 'form': form})
+    return render(request, 'D3Logger.html',{'data': json.dumps(LogRollup.parse(dateRange)), 'form': form})
 
 
 
@@ -1175,7 +1551,6 @@ def system_statistics(request):
         if days.isdigit():
             start = datetime.date.today() - datetime.timedelta(days=int(days))
             end = datetime.date.today()
-            print("+++++++++++", start, end)
         else:
             raise Http404('bad day count')
     # Checks if both dates were provided, if not uses 10000 as terminal boundaries
@@ -1188,12 +1563,16 @@ def system_statistics(request):
 
 
     form = CustomDateForm(request.GET)
+    if form.is_valid() and not days:
+        # normalized to dates, which is also what the cache is keyed on
+        start = form.cleaned_data['start'] or start
+        end = form.cleaned_data['end'] or end
 
     if metric ==  'prescriptions':
         heading = ['Name', 'Amount of Prescriptions']
         prescriptions = []
         if form.is_valid():
-            prescriptions = prescriptionStats(start, end)
+            prescriptions = cachedStat(metric, start, end, lambda: list(prescriptionStats(start, end)))
         return render(request, 'StatisticsTable.html', {'form':form, 'heading':heading,'elements': prescriptions})
 
 
@@ -1201,30 +1580,53 @@ def system_statistics(request):
         heading = ['Patient', 'Number of Appointments']
         appointments = []
         if form.is_valid():
-            appointments = patientAppointmentStats(start, end)
+            appointments = cachedStat(metric, start, end, lambda: list(patientAppointmentStats(start, end)))
         return render(request, 'StatisticsTable.html', {'form':form,'heading':heading,'elements': appointments})
 
     elif metric == 'staylength':
         heading = ['Patient', 'Average Length of Appointment']
         avgAppLength = []
         if form.is_valid():
-            avgAppLength = patientAppointmentLengthStats(start, end)
+            avgAppLength = cachedStat(metric, start, end, lambda: patientAppointmentLengthStats(start, end))
         return render(request, 'StatisticsTable.html', {'form':form,'heading':heading,'elements': avgAppLength})
 
     elif metric == 'AppointmentAverages':
         appointmentCount = None
         avgAppLength = 0
         if form.is_valid():
-            appointmentCount = hospitalAppointmentStats(start, end)
-            avgAppLength = hospitalAppointmentLengthStats(start, end)
+            appointmentCount, avgAppLength = cachedStat(metric, start, end, lambda: (
+                hospitalAppointmentStats(start, end), hospitalAppointmentLengthStats(start, end)))
         return render(request, 'StatisticsPanel.html',{'form':form, 'length':avgAppLength, 'count':appointmentCount})
 
+    elif metric == 'AppointmentDistributions':
+        distributions = None
+        if form.is_valid():
+            distributions = cachedStat(metric, start, end, lambda: appointmentDistributions(start, end))
+        # the charts on the page are drawn from the same data, as JSON
+        if request.GET.get('format') == 'json':
+            if distributions is None:
+                return JsonResponse({'errors': form.errors}, status=400)
+            return JsonResponse(distributions)
+        return render(request, 'StatisticsDistributions.html', {'form': form, 'distributions': distributions,
+                                                                'start': start, 'end': end})
+
     elif metric == 'AdmissionReasons':
         heading = ['Admission Reason', 'Amount of Admissions']
         admissionReasons = []
         if form.is_valid():
-            admissionReasons = hospitalAdmissionReasons(start, end)
+            admissionReasons = cachedStat(metric, start, end, lambda: hospitalAdmissionReasons(start, end))
         return render(request, 'StatisticsTable.html', {'form':form,'heading':heading,'elements': admissionReasons})
+    elif metric == 'Census':
+        # the chart is drawn from census_occupancy
+        return render(request, 'StatisticsCensus.html', {'form': form, 'start': start, 'end': end,
+                                                         'valid': form.is_valid()})
+
+    elif metric == 'AdmissionCounts':
+        heading = ['Hospital', 'Amount of Admissions']
+        admissionCounts = []
+        if form.is_valid():
+            admissionCounts = cachedStat(metric, start, end, lambda: hospitalAdmissionCounts(start, end))
+        return render(request, 'StatisticsTable.html', {'form':form,'heading':heading,'elements': admissionCounts})
     else:
         raise Http404(metric+": Not a Stat")
 
@@ -1251,6 +1653,83 @@ def view_log_entry(request, log_entry_pk):
     return render(request, 'viewLogEntry.html', {'entry': entry})
 
 
+@login_required
+@require_GET
+def audit_status(request):
+    '''
+    report the state of the buffered audit log writer as JSON
+    '''
+    if not (request.user.is_staff or request.user.is_superuser):
+        return HttpResponseRedirect(reverse('login'))
+    writer = get_audit_writer()
+    if writer is None:
+        return JsonResponse({'buffered': False})
+    status = writer.stats()
+    status['buffered'] = True
+    return JsonResponse(status)
+
+
+@login_required
+@require_GET
+def statistics_cache_status(request):
+    '''
+    report the statistics cache hit and miss counts as JSON
+    '''
+    if not (request.user.is_staff or request.user.is_superuser):
+        return HttpResponseRedirect(reverse('login'))
+    return JsonResponse(statsCacheCounters())
+
+
+# the longest occupancy series served at once, in days of hours
+CENSUS_MAX_DAYS = 366
+
+@login_required
+@require_GET
+def census_occupancy(request):
+    '''
+    hospital occupancy as JSON, for the census chart:
+    ?at=<datetime> gives each hospital's occupancy at that time;
+    ?start=<date or datetime>&end=<date or datetime> gives its hourly occupancy over that range
+    '''
+    if not (request.user.is_staff or request.user.is_superuser):
+        return HttpResponseRedirect(reverse('login'))
+    names = dict(Hospital.objects.values_list('pk', 'name'))
+
+    if 'at' in request.GET:
+        at = parse_calendar_bound(request.GET['at'])
+        if at is None:
+            return JsonResponse({'error': 'at must be a date or datetime'}, status=400)
+        occupancy = census.occupancy_at(at)
+        return JsonResponse({'time': at.isoformat(),
+                             'hospitals': [{'pk': pk, 'name': names.get(pk, ''), 'occupancy': occupancy[pk]}
+                                           for pk in sorted(occupancy)]})
+
+    start = parse_calendar_bound(request.GET.get('start'))
+    end = parse_calendar_bound(request.GET.get('end'))
+    if start is None or end is None or end < start:
+        return JsonResponse({'error': 'start and end must be dates or datetimes, start first'}, status=400)
+    if end - start > datetime.timedelta(days=CENSUS_MAX_DAYS):
+        return JsonResponse({'error': 'at most {} days at once'.format(CENSUS_MAX_DAYS)}, status=400)
+    hours, series = census.occupancy_series(start, end)
+    return JsonResponse({'hours': [hour.isoformat() for hour in hours],
+                         'hospitals': [{'pk': pk, 'name': names.get(pk, ''), 'occupancy': series[pk]}
+                                       for pk in sorted(series)]})
+
+
+@login_required
+@require_GET
+def admitted_counts(request):
+    '''
+    the number of patients admitted to each hospital right now, as JSON;
+    read from the hospitals' admitted patient counters, so this is one small query
+    '''
+    user = request.user
+    if not (group_member(user, 'Doctors') or group_member(user, 'Nurses') or user.is_staff or user.is_superuser):
+        return JsonResponse({'error': 'not allowed'}, status=403)
+    return JsonResponse({'hospitals': [{'pk': pk, 'name': name, 'admitted': count}
+                                       for pk, name, count in admissions.admitted_counts()]})
+
+
 @login_required
 def emergency_register_patient(request):
     '''
@@ -1325,8 +1804,7 @@ def emergency_register_patient(request):
             log_event(request.user.username, 'c', 'p', patient.pk, 'all', 'emergency patient was created')
 
             #admit the new patient to the user's (medical professional's) hospital
-            patient.admitted_to = hsptl
-            patient.save()
+            admissions.change_admission(patient, hsptl, 'emergency')
             #log the admission as an emergency admission
             log_event(request.user.username, 'u', 'p', patient.pk, 'admitted_to', 'patient was admitted to ' + hsptl.name + ' with reason \"emergency\"')
 
@@ -56,6 +56,7 @@ MIDDLEWARE_CLASSES = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'HealthNetApp.middleware.PrincipalMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -92,6 +93,38 @@ DATABASES = {
 }
 
 
+# Audit log
+# When AUDIT_LOG_BUFFERED is on, log_event queues entries in memory and a
+# background thread writes them in batches of up to AUDIT_LOG_BATCH_SIZE, at
+# least every AUDIT_LOG_FLUSH_INTERVAL seconds. When it is off (the default),
+# every entry is written immediately.
+
+AUDIT_LOG_BUFFERED = False
+AUDIT_LOG_BATCH_SIZE = 100
+AUDIT_LOG_FLUSH_INTERVAL = 2.0
+
+
+# Caching
+# Unread message counts (see HealthNetApp/inbox.py) and statistics (see
+# HealthNetApp/statistics.py) are cached. The local memory cache is per
+# process, so with several worker processes a value may be up to
+# UNREAD_CACHE_TIMEOUT / STATS_CACHE_TIMEOUT seconds stale; use a shared
+# cache such as memcached in production.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+UNREAD_CACHE_TIMEOUT = 300
+
+# Cached statistics are dropped when the data they are computed from
+# changes (see HealthNetApp/signals.py), and after STATS_CACHE_TIMEOUT
+# seconds in any case.
+STATS_CACHE_TIMEOUT = 3600
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -0,0 +1,65 @@
+"""
+filename: bench_census.py
+purpose: time building the hospital census checkpoints from a long admission
+history, extending them with one new event, and answering occupancy queries
+from them.
+
+usage: python benchmarks/bench_census.py [admission events, default 200000]
+"""
+
+import datetime, random, sys
+
+from common import test_database, measure
+
+from HealthNetApp import census
+from HealthNetApp.models import AdmissionEvent, Hospital, Patient, MedicalInformation
+
+FIRST = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+YEARS = 5
+
+
+def setup(count):
+    hospitals = [Hospital.objects.create(name='Hospital %d' % i) for i in range(10)]
+    patients = [Patient.objects.create(name='p%d' % i, username='p%d' % i, date_of_birth='1980-01-01',
+                                       contact_information='', preferred_hospital=hospitals[0], insurance_id='0',
+                                       medical_information=MedicalInformation.objects.create(history=''),
+                                       emergency_contact='') for i in range(1000)]
+    rng = random.Random(22)
+    where = {}
+    events = []
+    span = datetime.timedelta(days=365 * YEARS).total_seconds()
+    for i in range(count):
+        patient = rng.choice(patients)
+        old = where.get(patient.pk)
+        new = None if old is not None and rng.random() < 0.6 else rng.choice(hospitals)
+        if new == old:
+            continue
+        action = 'a' if old is None else ('d' if new is None else 't')
+        events.append(AdmissionEvent(patient=patient, hospital=new, from_hospital=old, action=action,
+                                     time=FIRST + datetime.timedelta(seconds=span * i / count)))
+        where[patient.pk] = new
+    AdmissionEvent.objects.bulk_create(events)
+    return hospitals, patients, len(events)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    with test_database():
+        hospitals, patients, created = setup(count)
+        print('{} admission events over {} years, {} hospitals'.format(created, YEARS, len(hospitals)))
+        last = FIRST + datetime.timedelta(days=365 * YEARS)
+        with measure('first build (replay everything)'):
+            census.extend()
+        AdmissionEvent.objects.create(patient=patients[0], hospital=hospitals[1], action='a', time=last)
+        with measure('extend with one new event'):
+            census.extend()
+        with measure('extend, nothing new'):
+            census.extend()
+        for label, time in (('occupancy at T (mid-history)', FIRST + datetime.timedelta(days=900, minutes=17)),
+                            ('occupancy at T (latest)', last)):
+            with measure(label):
+                census.occupancy_at(time)
+        for label, days in (('series, 1 week', 7), ('series, 1 month', 30), ('series, 1 year', 365)):
+            start = FIRST + datetime.timedelta(days=400)
+            with measure(label):
+                census.occupancy_series(start, start + datetime.timedelta(days=days))
@@ -0,0 +1,67 @@
+"""
+filename: bench_conflicts.py
+purpose: time Appointment.anyconflicts for a doctor with years of booked
+appointments, against the old load-everything-and-compare implementation.
+
+usage: python benchmarks/bench_conflicts.py [years of history, default 5]
+"""
+
+import datetime, random, sys
+
+from common import test_database, measure
+
+from django.db import connection
+from django.db.models import Q
+
+from HealthNetApp.models import Appointment, Doctor, Hospital, Patient, MedicalInformation
+
+
+def legacy_anyconflicts(appt):
+    for other in Appointment.objects.filter(Q(doctor=appt.doctor) | Q(patient=appt.patient)):
+        if other == appt: continue
+        if appt.conflicts(other):
+            return other
+    return False
+
+
+def setup(years):
+    hosp = Hospital.objects.create(name='Bench General')
+    doctor = Doctor.objects.create(name='doc', username='doc', date_of_birth='1980-01-01',
+                                   contact_information='', hospital=hosp)
+    patients = [Patient.objects.create(name='p%d' % i, username='p%d' % i, date_of_birth='1980-01-01',
+                                       contact_information='', preferred_hospital=hosp, insurance_id='0',
+                                       medical_information=MedicalInformation.objects.create(history=''),
+                                       emergency_contact='') for i in range(200)]
+    # eight 30-minute appointments every weekday
+    rows = []
+    day = datetime.datetime(2030, 1, 1, 13, tzinfo=datetime.timezone.utc) - datetime.timedelta(days=365 * years)
+    for d in range(365 * years):
+        if (day + datetime.timedelta(days=d)).weekday() >= 5:
+            continue
+        for slot in range(8):
+            start = day + datetime.timedelta(days=d, hours=slot)
+            rows.append((start, start + datetime.timedelta(minutes=30), doctor.pk, hosp.pk,
+                         random.choice(patients).pk))
+    with connection.cursor() as cursor:
+        cursor.executemany('INSERT INTO "HealthNetApp_appointment" (start, "end", doctor_id, hospital_id, patient_id) '
+                           'VALUES (%s, %s, %s, %s, %s)', rows)
+    return doctor, hosp, patients[0], len(rows)
+
+
+if __name__ == '__main__':
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with test_database():
+        doctor, hosp, patient, count = setup(years)
+        print('{} appointments booked for one doctor'.format(count))
+        # the last booked day has appointments at 13:00-13:30, 14:00-14:30, ...
+        last_day = datetime.datetime(2029, 12, 31, tzinfo=datetime.timezone.utc)
+        for label, start in (('free slot', last_day + datetime.timedelta(hours=15, minutes=35)),
+                             ('taken slot', last_day + datetime.timedelta(hours=15, minutes=15))):
+            appt = Appointment(start=start, end=start + datetime.timedelta(minutes=15),
+                               doctor=doctor, hospital=hosp, patient=patient)
+            with measure('anyconflicts, ' + label):
+                new = appt.anyconflicts()
+            with measure('legacy anyconflicts, ' + label):
+                old = legacy_anyconflicts(appt)
+            assert new == old, (new, old)
+            print('{:<40} {}'.format('', 'conflict' if new else 'no conflict'))
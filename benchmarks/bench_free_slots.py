@@ -0,0 +1,52 @@
+"""
+filename: bench_free_slots.py
+purpose: time the free slot finder for a whole hospital over a month, with
+most of every doctor's day already booked.
+
+usage: python benchmarks/bench_free_slots.py [doctors, default 20]
+"""
+
+import datetime, json, random, sys
+
+from common import test_database, measure
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+
+from HealthNetApp.models import Doctor, Hospital, Patient, MedicalInformation
+
+
+def setup(doctors):
+    hosp = Hospital.objects.create(name='Bench General')
+    doctors = [Doctor.objects.create(name='doc%d' % i, username='doc%d' % i, date_of_birth='1980-01-01',
+                                     contact_information='', hospital=hosp) for i in range(doctors)]
+    patient = Patient.objects.create(name='p', username='p', date_of_birth='1980-01-01',
+                                     contact_information='', preferred_hospital=hosp, insurance_id='0',
+                                     medical_information=MedicalInformation.objects.create(history=''),
+                                     emergency_contact='')
+    # 13:00-23:00 UTC is 08:00-18:00 in America/New_York; book about 3/4 of it
+    rows = []
+    first = datetime.datetime(2030, 1, 1, 13, tzinfo=datetime.timezone.utc)
+    for d in range(31):
+        for doctor in doctors:
+            for quarter in range(0, 40, 2):
+                if random.random() < 0.75:
+                    start = first + datetime.timedelta(days=d, minutes=15 * quarter)
+                    rows.append((start, start + datetime.timedelta(minutes=30), doctor.pk, hosp.pk, patient.pk))
+    with connection.cursor() as cursor:
+        cursor.executemany('INSERT INTO "HealthNetApp_appointment" (start, "end", doctor_id, hospital_id, patient_id) '
+                           'VALUES (%s, %s, %s, %s, %s)', rows)
+    return hosp, len(rows)
+
+
+if __name__ == '__main__':
+    doctors = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with test_database():
+        hosp, count = setup(doctors)
+        print('{} appointments booked for {} doctors'.format(count, doctors))
+        client = Client()
+        client.force_login(User.objects.create_superuser('admin', '', 'pw'))
+        with measure('free slots, hospital, one month'):
+            response = client.get('/freeslots/', {'hospital': hosp.pk, 'start': '2030-01-01', 'end': '2030-01-31'})
+        print('{:<40} {} slots'.format('', len(json.loads(response.content.decode())['slots'])))
@@ -0,0 +1,83 @@
+"""
+filename: bench_inbox.py
+purpose: time inbox pages of a person with a large inbox, as list_messages
+served them before (Paginator: a COUNT(*) plus an OFFSET query, and one query
+per row for its sender) and now (KeysetPaginator over Person.get_messages:
+one query per page, however deep).
+
+usage: python benchmarks/bench_inbox.py [messages, default 100000]
+"""
+
+import datetime, random, sys
+
+from common import test_database, measure
+
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.utils import timezone
+
+from HealthNetApp.models import Person, Message
+from HealthNetApp.pagination import KeysetPaginator
+
+PER_PAGE = 10
+
+
+def setup(count):
+    people = [Person.objects.create(name='person%d' % i, username='person%d' % i, date_of_birth='1980-01-01',
+                                    contact_information='') for i in range(50)]
+    reader = people[0]
+    rng = random.Random(24)
+    now = timezone.now()
+    batch = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for i in range(count):
+            # half of the messages are to the reader, the rest to everyone else
+            destination = reader if i % 2 == 0 else rng.choice(people[1:])
+            batch.append((rng.choice(people).pk, destination.pk, 'subject %d' % i, '', rng.random() < 0.9,
+                          now - datetime.timedelta(seconds=i * 30)))
+            if len(batch) == 10000 or i == count - 1:
+                cursor.executemany('INSERT INTO "HealthNetApp_message" '
+                                   '(source_id, destination_id, subject, body, read, date) '
+                                   'VALUES (%s, %s, %s, %s, %s, %s)', batch)
+                batch = []
+    return reader
+
+
+def legacy_page(reader, number):
+    # as list_messages paged before: the template printed each message's sender
+    page = Paginator(Message.objects.filter(destination=reader).order_by('-date'), PER_PAGE).page(number)
+    return [(str(m.source), m.subject) for m in page]
+
+
+def keyset_walk(paginator, pages):
+    '''
+    :return: the cursor of the page after following next_cursor pages times
+    '''
+    cursor = None
+    for i in range(pages):
+        cursor = paginator.page(cursor).next_cursor
+    return cursor
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with test_database():
+        reader = setup(count)
+        total = Message.objects.filter(destination=reader).count()
+        print('{} messages, {} to the reader'.format(count, total))
+        last = (total + PER_PAGE - 1) // PER_PAGE
+        for number in (1, last // 2, last):
+            with measure('legacy page {}'.format(number)):
+                legacy_page(reader, number)
+
+        for unread_only in (False, True):
+            paginator = KeysetPaginator(reader.get_messages(unread_only), PER_PAGE, 'date')
+            # cursors for the first, a middle and the last page, found by walking the inbox
+            rows = total if not unread_only else Message.objects.filter(destination=reader, read=False).count()
+            pages = (rows + PER_PAGE - 1) // PER_PAGE
+            for label, cursor in (('first', None), ('middle', keyset_walk(paginator, pages // 2)),
+                                  ('last', keyset_walk(paginator, pages - 1))):
+                with measure('keyset {}{} page'.format('unread ' if unread_only else '', label)):
+                    page = paginator.page(cursor)
+                    [(str(m.source), m.subject) for m in page]
+                assert label != 'last' or not page.has_next()
@@ -0,0 +1,136 @@
+"""
+filename: bench_indexes.py
+purpose: show the SQLite query plan of each hot query in views.py and
+statistics.py without and with the index pack (the indexes added to its
+tables from migration 0006 on), and check that none of them still scans a
+whole table. Both plans are taken at the latest migration; the
+"without" plans drop the pack's indexes in a transaction that is rolled back.
+
+usage: python benchmarks/bench_indexes.py
+Exits with status 1 if any hot query still does a full table scan.
+"""
+
+import datetime, re, sys
+
+from common import test_database
+
+from django.db import connection, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from HealthNetApp import statistics
+from HealthNetApp.models import Person, Patient, Nurse, Hospital, Appointment, Message, LogEntry, LogRollup, \
+    MedicalInformation, Prescription
+
+# the migration before the index pack
+BEFORE = '0005_person_search'
+# the models whose indexes the pack changed
+INDEXED = (Appointment, LogEntry, Message, Prescription)
+
+# "SCAN t" (or "SCAN TABLE t" on older SQLite) without an index is a full scan
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?(\S+)(?! USING)(?!.*INDEX)')
+
+
+def hot_queries(patient, nurse):
+    '''
+    :return: list of (label, queryset) for the queries run on hot paths
+    '''
+    now = timezone.now()
+    week = now + datetime.timedelta(days=7)
+    month_ago = now - datetime.timedelta(days=30)
+    return [
+        ('principal: Patient by username', Patient.objects.filter(username='someone')),
+        ('patient search by prefix', Person.search(Person.objects.all(), 'ali')[:26]),
+        ('nav badge: unread messages',
+         Message.objects.filter(destination=patient, read=False).values('id')),
+        ('inbox page', Message.objects.filter(destination=patient).order_by('-date', '-id')[:10]),
+        ('calendar feed (doctor)',
+         Appointment.objects.filter(end__gt=now, start__lt=week).order_by('start', 'pk')),
+        ('calendar feed (nurse)', nurse.list_appointments().filter(end__gt=now, start__lt=week)),
+        ('appointment conflicts',
+         Appointment.objects.filter(Q(doctor_id=1) | Q(patient_id=patient.pk), end__gte=now,
+                                    end__lt=week, start__lte=week).order_by('start', 'id')[:1]),
+        ('patient can_create_appointment',
+         Appointment.objects.filter(patient=patient, start__gt=now).values('id')[:1]),
+        ('statistics: getAppointments', statistics.getAppointments(month_ago, now)),
+        # as patientAppointmentStats ran before it read AppointmentRollup (migration 0009)
+        ('statistics: appointments per patient',
+         statistics.getAppointments(month_ago, now).values_list('patient__name').annotate(count=Count('patient'))),
+        ('statistics: prescriptionStats', statistics.prescriptionStats(month_ago.date(), now.date())),
+        ('statistics: admission reasons log',
+         LogEntry.objects.filter(time__gte=month_ago, time__lte=now, action_type='u', thing_type='p',
+                                 thing_field='admitted_to').values_list('eventDescription', flat=True)),
+        ('view_logs page', LogEntry.objects.order_by('-time', '-id')[:11]),
+        ('view_logs_by_user page', LogEntry.objects.filter(user=patient).order_by('-time', '-id')[:11]),
+        ('export_logs by type and date',
+         LogEntry.objects.filter(action_type='u', thing_type='p', time__gte=month_ago).order_by('pk')[:2000]),
+        ('d3Statistics rollup', LogRollup.objects.filter(day__gte=month_ago.date(), day__lt=now.date())),
+    ]
+
+
+def pack_indexes():
+    '''
+    :return: names of the indexes in the database that the models have now but did not have at BEFORE
+    '''
+    before = MigrationLoader(connection).project_state(('HealthNetApp', BEFORE)).apps
+    names = []
+    with connection.cursor() as cursor:
+        for model in INDEXED:
+            columns = lambda fields: tuple(model._meta.get_field(field).column for field in fields)
+            old = set(columns(fields) for fields in before.get_model('HealthNetApp', model.__name__)._meta.index_together)
+            new = set(columns(fields) for fields in model._meta.index_together) - old
+            cursor.execute('PRAGMA index_list("{}")'.format(model._meta.db_table))
+            for index in [row[1] for row in cursor.fetchall()]:
+                cursor.execute('PRAGMA index_info("{}")'.format(index))
+                if tuple(row[2] for row in cursor.fetchall()) in new:
+                    names.append(index)
+    return names
+
+
+def plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [str(row[-1]) for row in cursor.fetchall()]
+
+
+def full_scans(steps):
+    return [step for step in steps if FULL_SCAN.match(step)]
+
+
+def report(title, queries):
+    print('=' * 78)
+    print(title)
+    print('=' * 78)
+    scanning = []
+    for label, queryset in queries:
+        steps = plan(queryset)
+        scans = full_scans(steps)
+        print('{} {}'.format('SCAN' if scans else 'ok  ', label))
+        for step in steps:
+            print('       ' + step)
+        if scans:
+            scanning.append(label)
+    print('{} of {} hot queries do a full table scan'.format(len(scanning), len(queries)))
+    return scanning
+
+
+if __name__ == '__main__':
+    with test_database():
+        hosp = Hospital.objects.create(name='Bench General')
+        patient = Patient.objects.create(name='p', username='p', date_of_birth='1980-01-01',
+                                         contact_information='', preferred_hospital=hosp, insurance_id='0',
+                                         medical_information=MedicalInformation.objects.create(history=''),
+                                         emergency_contact='')
+        nurse = Nurse.objects.create(name='n', username='n', date_of_birth='1980-01-01',
+                                     contact_information='', hospital=hosp)
+        indexes = pack_indexes()
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for index in indexes:
+                    cursor.execute('DROP INDEX "{}"'.format(index))
+            report('without the index pack ({} indexes dropped)'.format(len(indexes)), hot_queries(patient, nurse))
+            transaction.set_rollback(True)
+        remaining = report('with the index pack', hot_queries(patient, nurse))
+    sys.exit(1 if remaining else 0)
@@ -0,0 +1,122 @@
+"""
+filename: bench_length_stats.py
+purpose: time the appointment statistics over growing date ranges of a large
+appointment table, against the old implementations that scanned Appointment
+(and, for the length statistics, pulled every appointment into Python).
+The new ones read the AppointmentRollup daily totals. Reports wall time and
+peak Python memory of each.
+
+usage: python benchmarks/bench_length_stats.py [appointments, default 1000000]
+"""
+
+import datetime, math, random, sys, time, tracemalloc
+from io import StringIO
+from itertools import groupby
+
+from common import test_database
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Avg, Count
+
+from HealthNetApp import statistics
+from HealthNetApp.models import Doctor, Hospital, Patient, MedicalInformation
+
+FIRST_DAY = datetime.datetime(2020, 1, 1, 13, tzinfo=datetime.timezone.utc)
+YEARS = 10
+
+
+def legacy_patient_counts(start, end):
+    return sorted(statistics.getAppointments(start, end).values_list('patient__name').annotate(
+        count=Count('patient')))
+
+
+def legacy_hospital_count(start, end):
+    return statistics.getAppointments(start, end).values_list('patient__name').annotate(
+        count=Count('patient')).aggregate(average=Avg('count'))['average']
+
+
+def patient_counts(start, end):
+    # ties are ordered differently; compare sorted by name
+    return sorted(statistics.patientAppointmentStats(start, end))
+
+
+def legacy_patient_lengths(start, end):
+    appointments = statistics.getAppointments(start, end).values_list('patient__name', 'end', 'start') \
+        .order_by('patient__name')
+    lengths = []
+    for patient, appt in groupby(appointments, lambda x: x[0]):
+        counter = 0
+        total = 0
+        for duration in appt:
+            counter += 1
+            total += (duration[1] - duration[2]).seconds / 60
+        lengths.append([patient, str(int(total / counter)) + ' Minutes'])
+    return lengths
+
+
+def legacy_hospital_length(start, end):
+    appointment_times = statistics.getAppointments(start, end).values_list('end', 'start')
+    if len(appointment_times) > 0:
+        durations = [(times[0] - times[1]).seconds / 60 for times in appointment_times]
+        return str(math.fsum(durations) / len(durations)) + ' Minutes'
+    return '0 Minutes'
+
+
+def setup(count):
+    hosp = Hospital.objects.create(name='Bench General')
+    doctors = [Doctor.objects.create(name='doc%d' % i, username='doc%d' % i, date_of_birth='1980-01-01',
+                                     contact_information='', hospital=hosp) for i in range(20)]
+    patients = [Patient.objects.create(name='p%d' % i, username='p%d' % i, date_of_birth='1980-01-01',
+                                       contact_information='', preferred_hospital=hosp, insurance_id='0',
+                                       medical_information=MedicalInformation.objects.create(history=''),
+                                       emergency_contact='') for i in range(500)]
+    rng = random.Random(18)
+    days = 365 * YEARS
+    batch = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for i in range(count):
+            start = FIRST_DAY + datetime.timedelta(days=i * days // count, minutes=15 * rng.randrange(16))
+            batch.append((start, start + datetime.timedelta(minutes=rng.choice((15, 30, 45, 60))),
+                          rng.choice(doctors).pk, hosp.pk, rng.choice(patients).pk))
+            if len(batch) == 10000 or i == count - 1:
+                cursor.executemany('INSERT INTO "HealthNetApp_appointment" '
+                                   '(start, "end", doctor_id, hospital_id, patient_id) VALUES (%s, %s, %s, %s, %s)',
+                                   batch)
+                batch = []
+    # the rows above were inserted without signals
+    call_command('rebuild_appointment_rollup', stdout=StringIO())
+
+
+def run(function, start, end):
+    '''
+    :return: (result, seconds, peak bytes allocated by Python)
+    '''
+    tracemalloc.start()
+    t = time.perf_counter()
+    result = function(start, end)
+    elapsed = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with test_database():
+        setup(count)
+        print('{} appointments over {} years'.format(count, YEARS))
+        print('{:<12} {:<10} {:>12} {:>12}   {:>12} {:>12}'.format('range', 'stat', 'sql ms', 'sql KiB',
+                                                                  'legacy ms', 'legacy KiB'))
+        first = FIRST_DAY.date()
+        for label, days in (('1 week', 7), ('1 month', 30), ('1 year', 365), ('10 years', 365 * YEARS)):
+            start, end = first, first + datetime.timedelta(days=days)
+            for stat, new, old in (('patients', patient_counts, legacy_patient_counts),
+                                   ('average', statistics.hospitalAppointmentStats, legacy_hospital_count),
+                                   ('lengths', statistics.patientAppointmentLengthStats, legacy_patient_lengths),
+                                   ('length', statistics.hospitalAppointmentLengthStats, legacy_hospital_length)):
+                result, new_time, new_peak = run(new, start, end)
+                expected, old_time, old_peak = run(old, start, end)
+                assert result == expected, (label, stat)
+                print('{:<12} {:<10} {:>12.1f} {:>12.0f}   {:>12.1f} {:>12.0f}'.format(
+                    label, stat, new_time * 1000, new_peak / 1024, old_time * 1000, old_peak / 1024))
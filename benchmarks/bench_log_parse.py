@@ -0,0 +1,69 @@
+"""
+filename: bench_log_parse.py
+purpose: time LogEntry.parse (the d3Statistics tree) and count its queries
+as the audit log grows. The old row-by-row implementation is run too, at
+the sizes where it finishes in reasonable time, and both trees are checked
+to be identical.
+
+usage: python benchmarks/bench_log_parse.py [max rows, default 1000000]
+"""
+
+import random, sys, datetime
+
+from common import test_database, measure
+
+from django.db import connection
+from django.utils import timezone
+
+from HealthNetApp.models import LogEntry, Person
+
+
+def legacy_parse(dateRange):
+    '''
+    The original LogEntry.parse: one Python iteration (and one user query)
+    per log entry.
+    '''
+    logs = LogEntry.objects.filter(time__range=(dateRange[0], dateRange[1]))
+    logList = [" Log ", [0, 0], {}]
+    for log in logs:
+        elements = str(log).split(' ')
+        if elements[2] in LogEntry.tree_nouns:
+            logList = LogEntry.parseLog(logList, elements[1], LogEntry.tree_nouns[elements[2]])
+    return logList
+
+
+def insert_logs(count, person_pks, start):
+    '''
+    Append count random log entries, bypassing the ORM for speed.
+    '''
+    rows = []
+    for i in range(count):
+        rows.append((random.choice(person_pks),
+                     start + datetime.timedelta(seconds=random.randrange(86400 * 365)),
+                     random.choice('crud'), random.choice('pdnavhrtm'),
+                     random.randrange(1000), 'N/A', 'benchmark'))
+    with connection.cursor() as cursor:
+        cursor.executemany('INSERT INTO "HealthNetApp_logentry" '
+                           '(user_id, time, action_type, thing_type, thing_instance, thing_field, "eventDescription") '
+                           'VALUES (%s, %s, %s, %s, %s, %s, %s)', rows)
+
+
+if __name__ == '__main__':
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with test_database():
+        person_pks = [Person.objects.create(name='p%d' % i, username='p%d' % i, date_of_birth='1980-01-01',
+                                            contact_information='').pk for i in range(20)]
+        start = timezone.now() - datetime.timedelta(days=365)
+        dateRange = [start - datetime.timedelta(days=1), timezone.now() + datetime.timedelta(days=1)]
+        total = 0
+        size = 1000
+        while size <= max_rows:
+            insert_logs(size - total, person_pks, start)
+            total = size
+            with measure('parse, {} rows'.format(total)):
+                tree = LogEntry.parse(dateRange)
+            if total <= 1000:
+                with measure('legacy parse, {} rows'.format(total)):
+                    legacy = legacy_parse(dateRange)
+                assert legacy == tree, 'trees differ'
+            size *= 10
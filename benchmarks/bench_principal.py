@@ -0,0 +1,57 @@
+"""
+filename: bench_principal.py
+purpose: count the queries the login, calendar and listPatients pages run,
+with and without the per-request Principal cache.
+
+usage: python benchmarks/bench_principal.py
+"""
+
+from common import test_database, measure
+
+from django.contrib.auth.models import User, Group
+from django.test import Client
+
+from HealthNetApp import views
+from HealthNetApp.principal import Principal, get_principal
+from HealthNetApp.templatetags import utils_extras
+from HealthNetApp.models import Hospital, Nurse, Doctor, Patient, MedicalInformation
+
+
+def setup():
+    for name in ('Patients', 'Nurses', 'Doctors'):
+        Group.objects.create(name=name)
+    hosp = Hospital.objects.create(name='Bench General')
+    for model, group in ((Nurse, 'Nurses'), (Doctor, 'Doctors')):
+        username = group.lower()
+        model.objects.create(name=username, username=username, date_of_birth='1980-01-01',
+                             contact_information='', hospital=hosp)
+        User.objects.create_user(username, '', 'pw').groups.add(Group.objects.get(name=group))
+    for i in range(50):
+        Patient.objects.create(name='patient%d' % i, username='patient%d' % i, date_of_birth='1980-01-01',
+                               contact_information='', preferred_hospital=hosp, insurance_id='0',
+                               medical_information=MedicalInformation.objects.create(history=''),
+                               emergency_contact='')
+
+
+def run(label):
+    for username in ('nurses', 'doctors'):
+        client = Client()
+        with measure('{} {} login'.format(label, username)) as ctx:
+            client.post('/app/login/', {'username': username, 'password': 'pw'})
+        groups = [q for q in ctx.captured_queries if 'auth_user_groups' in q['sql']]
+        print('{:<40} {:>6} group queries'.format('', len(groups)))
+        for url in ('/app/calendar/', '/app/listpatients/'):
+            with measure('{} {} {}'.format(label, username, url)) as ctx:
+                client.get(url)
+            groups = [q for q in ctx.captured_queries if 'auth_user_groups' in q['sql']]
+            print('{:<40} {:>6} group queries'.format('', len(groups)))
+
+
+if __name__ == '__main__':
+    with test_database():
+        setup()
+        # Emulate the old behaviour: every helper call resolves the user again.
+        views.get_principal = utils_extras.get_principal = Principal
+        run('uncached')
+        views.get_principal = utils_extras.get_principal = get_principal
+        run('cached')
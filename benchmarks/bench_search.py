@@ -0,0 +1,98 @@
+"""
+filename: bench_search.py
+purpose: time record searches over a large full-text index, for words that
+match few, some and many documents, as a doctor (every patient's records)
+and as a nurse (the records of one hospital's patients).
+
+usage: python benchmarks/bench_search.py [documents, default 2000000]
+"""
+
+import random, sys, time
+
+from common import test_database
+
+from django.db import connection, transaction
+
+from HealthNetApp import search
+from HealthNetApp.models import Doctor, Hospital, Nurse, MedicalInformation
+
+HOSPITALS = 20
+PATIENTS = 20000
+# (word, share of documents containing it)
+PROBES = (('tachycardia', 0.0001), ('hypertension', 0.01), ('fever', 0.1))
+
+
+def text(rng, vocabulary, words):
+    return ' '.join(rng.choice(vocabulary) for i in range(words))
+
+
+def setup(count):
+    hospitals = [Hospital.objects.create(name='Hospital %d' % i) for i in range(HOSPITALS)]
+    doctor = Doctor.objects.create(name='doc', username='doc', date_of_birth='1980-01-01', contact_information='',
+                                   hospital=hospitals[0])
+    nurse = Nurse.objects.create(name='nurse', username='nurse', date_of_birth='1980-01-01', contact_information='',
+                                 hospital=hospitals[0])
+    info = MedicalInformation.objects.create(history='')
+    rng = random.Random(25)
+    vocabulary = ['word%d' % i for i in range(20000)]
+    with transaction.atomic(), connection.cursor() as cursor:
+        people = []
+        for i in range(PATIENTS):
+            people.append(('p%d' % i, 'p%d' % i, 'p%d' % i, '1980-01-01', '', 0))
+        cursor.executemany('INSERT INTO "HealthNetApp_person" '
+                           '(name, username, search_name, date_of_birth, contact_information, unread_messages) '
+                           'VALUES (%s, %s, %s, %s, %s, %s)', people)
+        cursor.execute('SELECT MAX(id) FROM "HealthNetApp_person"')
+        first = cursor.fetchone()[0] - PATIENTS + 1
+        cursor.executemany('INSERT INTO "HealthNetApp_patient" (person_ptr_id, preferred_hospital_id, insurance_id, '
+                           'medical_information_id, emergency_contact) VALUES (%s, %s, %s, %s, %s)',
+                           [(first + i, hospitals[i % HOSPITALS].pk, '0', info.pk, '') for i in range(PATIENTS)])
+        # the documents are written straight to the index; they need no rows of their own to be searched
+        batch = []
+        for i in range(count):
+            words = text(rng, vocabulary, 20).split()
+            for word, share in PROBES:
+                if rng.random() < share:
+                    words[rng.randrange(len(words))] = word
+            batch.append((search.rowid(search.TEST, i + 1), 'Test %d' % i, ' '.join(words), '',
+                          first + rng.randrange(PATIENTS)))
+            if len(batch) == 10000:
+                search.write(cursor, batch)
+                batch = []
+        search.write(cursor, batch)
+        cursor.execute('INSERT INTO "{0}" ("{0}") VALUES (\'optimize\')'.format(search.TABLE))
+    return doctor, nurse
+
+
+def best_of(function, runs=5):
+    times = []
+    for i in range(runs):
+        t = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - t)
+    return result, min(times)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    with test_database():
+        t = time.perf_counter()
+        doctor, nurse = setup(count)
+        print('indexed {} documents in {:.0f} s'.format(count, time.perf_counter() - t))
+        print('{:<14} {:>10} {:>12} {:>12}'.format('word', 'matches', 'doctor ms', 'nurse ms'))
+        for word, share in PROBES:
+            hits, doctor_time = best_of(lambda: search.search(word, doctor.pk))
+            nurse_hits, nurse_time = best_of(lambda: search.search(word, nurse.pk, nurse.list_patients()))
+            assert len(hits) == 20 or share * count < 20
+            print('{:<14} {:>10} {:>12.1f} {:>12.1f}'.format(word, int(share * count), doctor_time * 1000,
+                                                             nurse_time * 1000))
+        # a page past the ranked matches, into the older ones, if there are enough of them
+        word, share = PROBES[-1]
+        if share * count > search.RANK_WINDOW + 20:
+            hits, doctor_time = best_of(lambda: search.search(word, doctor.pk, offset=search.RANK_WINDOW))
+            nurse_hits, nurse_time = best_of(lambda: search.search(word, nurse.pk, nurse.list_patients(),
+                                                                   offset=search.RANK_WINDOW))
+            assert len(hits) == 20 and hits[0][5] is None
+            assert len(nurse_hits) == 20 or share * count / HOSPITALS < search.RANK_WINDOW + 20
+            print('{:<14} {:>10} {:>12.1f} {:>12.1f}'.format(word + ' older', '', doctor_time * 1000,
+                                                             nurse_time * 1000))
@@ -0,0 +1,45 @@
+"""
+filename: common.py
+purpose: shared setup for the HealthNet benchmark scripts. Each benchmark
+runs against a throwaway test database, never against db.sqlite3.
+"""
+
+import os, sys, time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'HealthNetProject.settings')
+
+import django
+django.setup()
+
+from django.db import connection
+from django.test.utils import setup_test_environment, CaptureQueriesContext
+
+
+@contextmanager
+def test_database():
+    '''
+    Create (and afterwards destroy) a fresh test database with every
+    migration applied.
+    '''
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+@contextmanager
+def measure(label):
+    '''
+    Print the wall time and number of queries run inside the block.
+    Query counts are only exact up to Django's query log size (9000).
+    '''
+    connection.queries_log.clear()
+    with CaptureQueriesContext(connection) as ctx:
+        t = time.perf_counter()
+        yield ctx
+        elapsed = time.perf_counter() - t
+    print('{:<40} {:>6} queries {:>10.2f} ms'.format(label, len(ctx.captured_queries), elapsed * 1000))